@@ -149,7 +149,72 @@ class Interpolater(object):
         #for li in range(len(nstepss)):
         nstepss[0]+=1
 
-    def interpolateAndRender(self,frame_offset=0,galaxy=None):
+    def depositVolumeGrid(
+        self,
+        snapdict,
+        snapnum,
+        datadir,
+        quantity_name,
+        ngrid=128,
+        grid_half_width=None,
+        second_moments=False):
+        """ Deposits the gas onto a 3D grid once, big enough to hold every frame of 
+            the interpolation, so that each frame (whatever its camera angle) is 
+            projected from the grid rather than from every particle.
+
+            Input:
+
+                snapdict -- gas snapshot dictionary
+                snapnum -- snapshot number
+                datadir -- directory for the GasStudio's files
+                quantity_name -- name of the quantity to mass weight onto the grid
+                ngrid = 128 -- number of cells along each side of the grid
+                grid_half_width = None -- radius of the region each frame sees,
+                    defaults to the bounding sphere of the largest frame so that
+                    every camera angle fits in the grid
+                second_moments = False -- deposit quantity^2 too, for frames that
+                    project second moments
+
+            Output:
+
+                volume_grid -- VolumeGrid to pass to each frame's GasStudio"""
+
+        if grid_half_width is None:
+            half_widths = dict([
+                (interp_kwarg,np.max(np.concatenate(getattr(self,interp_kwarg))))
+                for interp_kwarg in ['frame_half_widths','frame_half_thicknesss']
+                if hasattr(self,interp_kwarg)])
+            if not len(half_widths):
+                raise ValueError("Pass a grid_half_width, no frame sizes are interpolated")
+            half_width = half_widths.get('frame_half_widths',max(half_widths.values()))
+            half_thickness = half_widths.get('frame_half_thicknesss',max(half_widths.values()))
+            ## the corners of a rotated (square) frame reach out to its bounding sphere
+            grid_half_width = np.sqrt(2*half_width**2+half_thickness**2)
+
+        ## cover every frame center too
+        if hasattr(self,'frame_centers'):
+            frame_centers = np.concatenate(self.frame_centers)
+        else:
+            frame_centers = np.zeros((1,3))
+        center = 0.5*(frame_centers.min(axis=0)+frame_centers.max(axis=0))
+        grid_half_width += np.max(frame_centers.max(axis=0)-center)
+
+        grid_studio = GasStudio(
+            datadir,
+            snapnum,
+            datadir,
+            grid_half_width,
+            grid_half_width,
+            frame_center=center,
+            snapdict=snapdict,
+            quantity_name=quantity_name,
+            second_moments=second_moments)
+
+        return grid_studio.depositVolumeGrid(
+            ngrid=ngrid,
+            half_width=grid_half_width)
+
+    def interpolateAndRender(self,frame_offset=0,galaxy=None,ngrid=None,grid_half_width=None):
 
         if galaxy is None:
             snapdir = "/scratch/projects/xsede/GalaxiesOnFIRE/metal_diffusion/m12i_res7100/output"
@@ -188,6 +253,17 @@ class Interpolater(object):
         ## don't remove these lines, they perform some form of dark arts
         ##  that helps the garbage collector its due
 
+        ## deposit the gas onto a 3D grid once, optionally
+        global_volume_grid_name = None
+        if ngrid is not None:
+            global_volume_grid_name = 'volume_grid_%03d'%snapnum
+            globals()[global_volume_grid_name] = self.depositVolumeGrid(
+                wrapper_dict,snapnum,studio_datadir,
+                render_kwargs['quantity_name'],
+                ngrid=ngrid,
+                grid_half_width=grid_half_width,
+                second_moments=render_kwargs.get('second_moments',False))
+
         frame_num = frame_offset
         for interp_i,nsteps in enumerate(self.nstepss):
             im_param_kwargs = []
@@ -205,14 +281,23 @@ class Interpolater(object):
                 itertools.repeat(studio_datadir), ## datadir
                 itertools.repeat(snapnum), ## snapnum for projection file to be saved to
                 itertools.repeat(global_this_snapdict_name), ## what to look up in globals() for gas
-                im_param_kwargs) ##
+                im_param_kwargs, ##
+                itertools.repeat(global_volume_grid_name)) ## what to look up in globals() for the grid
 
             these_axs = [worker_function(*arg) for arg in args]
 
+        if global_volume_grid_name is not None:
+            globals().pop(global_volume_grid_name)
 
         return these_axs
 
-    def interpolateAndRenderMultiprocessing(self,frame_offset=0,galaxy=None,nproc=None):
+    def interpolateAndRenderMultiprocessing(
+        self,
+        frame_offset=0,
+        galaxy=None,
+        nproc=None,
+        ngrid=None,
+        grid_half_width=None):
 
         if nproc is None:
             nproc = multiprocessing.cpu_count()-1
@@ -262,6 +347,17 @@ class Interpolater(object):
                 loud=True)
             del galaxy
             globals()[global_this_snapdict_name] = wrapper_dict
+
+            ## deposit the gas onto a 3D grid once (before the pool forks), optionally
+            global_volume_grid_name = None
+            if ngrid is not None:
+                global_volume_grid_name = 'volume_grid_%03d'%snapnum
+                globals()[global_volume_grid_name] = self.depositVolumeGrid(
+                    wrapper_dict,snapnum,studio_datadir,
+                    render_kwargs['quantity_name'],
+                    ngrid=ngrid,
+                    grid_half_width=grid_half_width,
+                    second_moments=render_kwargs.get('second_moments',False))
             ## don't remove these lines, they perform some form of dark arts
             ##  that helps the garbage collector its due
             locals().keys()
@@ -289,7 +385,8 @@ class Interpolater(object):
                     itertools.repeat(studio_datadir), ## datadir
                     itertools.repeat(snapnum), ## snapnum for projection file to be saved to
                     itertools.repeat(global_this_snapdict_name), ## what to look up in globals() for gas
-                    im_param_kwargs) ##
+                    im_param_kwargs, ##
+                    itertools.repeat(global_volume_grid_name)) ## what to look up in globals() for the grid
 
                 this_nprocs = min(nproc,len(im_param_kwargs))
                 print("Starting a pool of %d processes..."%this_nprocs)
@@ -309,6 +406,7 @@ class Interpolater(object):
             ##  memory object. globals() must be purged before the shm_buffers
             ##  are unlinked or python will crash.
             globals().pop(global_this_snapdict_name)
+            globals().pop('volume_grid_%03d'%snapnum,None)
             del wrapper_dict
             for shm_buffer in shm_buffers:
                 ## handle case where multiprocessing isn't used
@@ -325,7 +423,8 @@ def worker_function(
     datadir,
     snapnum,
     global_this_snapdict_name,
-    im_param_kwargs):
+    im_param_kwargs,
+    global_volume_grid_name=None):
 
     ## read the unique global name for the relevant snapshot dictionary
     ##  TODO: could I handle time interpolation right here by checking if 
@@ -337,6 +436,10 @@ def worker_function(
     this_snapdict = globals()[global_this_snapdict_name]
 
     frame_num = im_param_kwargs.pop('frame_num')
+
+    ## project from the deposited grid rather than the particles
+    if global_volume_grid_name is not None:
+        im_param_kwargs['volume_grid'] = globals()[global_volume_grid_name]
     ## initialize the GasStudio instance
     my_studio = this_class(
         datadir,
@@ -5,7 +5,6 @@ import h5py
 import matplotlib 
 matplotlib.use('Agg') 
 import numpy as np 
-import ctypes
 
 ## abg_python imports
 from abg_python.all_utils import filterDictionary
@@ -13,6 +12,10 @@ from abg_python.plot_utils import addColorbar
 
 ## firestudio imports
 import firestudio.utils.gas_utils.my_colour_maps as mcm 
+from firestudio.utils.gas_utils import projection
+from firestudio.utils.gas_utils.volume_grid import VolumeGrid
+from firestudio.utils.gas_utils.raw_maps import collapse_slabs
+from firestudio.utils.hsml_cache import get_particle_keys,load_cached_hsml,save_cached_hsml
 from firestudio.studios.studio import Studio
 
 class GasStudio(Studio):
@@ -38,7 +41,12 @@ class GasStudio(Studio):
             with hue determined by `quantity_name` and saturation by density
 
         quantity_name='Temperature' - the name of the quantity that you're mass weighting
-            should match whatever array you're passing in as quantity
+            should match whatever array you're passing in as quantity. Can be a list of
+            names, in which case every quantity is projected in the same pass and 
+            the first one is used to produce the image
+        second_moments=False - also project the mass weighted quantity^2 maps
+            (saved, never logged, as massWeighted<Quantity>SquaredMap) so that 
+            dispersions can be computed as sqrt(<q^2>-<q>^2)
 
         cmap='viridis' - string name for cmap to use 
         use_colorbar=False - flag for whether to plot a colorbar at all
@@ -49,6 +57,55 @@ class GasStudio(Studio):
         snapdict=None - Dictionary-like holding gas snapshot data, open from disk if None
         use_hsml=True - Flag to use the provided Hsml argument (implemented to test speedup)
         intermediate_file_name = "proj_maps" ##  the name of the file to save maps to
+        nthreads=None - number of threads to project image tiles with the 
+            hsml_project routine (whose output does not depend on nthreads, and 
+            matches findHsmlAndProject's), None projects on a single thread
+        hybrid=False - bin particles smaller than a pixel with a cloud-in-cell deposit
+            and only send resolved particles through the hsml_project kernel loop
+        fast_math=False - evaluate and scatter the kernel in loops that vectorize, 
+            which only changes the rounding of the maps, see 
+            kernel_bindings.FAST_MATH_TOLERANCE
+        mip_tolerance=None - deposit particles whose smoothing length spans more than
+            2*mip_tolerance pixels onto coarser levels of an image pyramid, which are 
+            upsampled and summed at the end. Larger values are more accurate (and slower),
+            None deposits every particle at full resolution
+        chunk_size=None - stream the snapshot from disk in chunks of (at most) chunk_size 
+            particles, culling, rotating, and projecting each chunk into the same maps,
+            so that memory use is set by chunk_size rather than by the snapshot size.
+            Requires smoothing lengths in the snapshot. None loads the whole snapshot
+        snapchunks=None - iterable of dictionary-like chunks of gas snapshot data (each
+            holding Coordinates, Masses, SmoothingLength, and the quantities) to 
+            stream through instead of reading the snapshot
+        histogram=False - quick-look projection that bins each particle into the pixel
+            that contains it, ignoring the smoothing lengths
+        cache_hsml=True - if the snapshot has no smoothing lengths, keep the ones the 
+            neighbor search computes (in the snapdict and, by ParticleIDs, in a 
+            per-snapshot file next to the projection file) so later frames of the 
+            same snapshot can skip the search. The search then covers the frame 
+            padded by its largest smoothing length, see findFrameHsml
+        ptype=0 - particle type of snapdict. The smoothing lengths of collisionless 
+            particles (1, 2, or 4) that don't have any are found with an HsmlEngine
+            (see Studio.getHsmlEngine) over every particle in snapdict, queried
+            for just those in the frame with nthreads threads and cached by ParticleIDs
+        slab_edges=None - increasing z boundaries of a stack of slabs to project in a 
+            single pass (instead of one render per frame_depth/frame_center[2]), each
+            particle's mass is split between the slabs its kernel overlaps (histogram
+            bins it into the slab it's in, mip_tolerance applies as usual). Writes
+            (nslab,npix_x,npix_y) totalMassSlabsMap and columnDensitySlabsMap (etc.)
+            stacks to their own setup (with the slab_edges in its name), the image 
+            is made from the sum of the slabs
+        volume_grid=None - VolumeGrid (see depositVolumeGrid) the gas was deposited onto
+            once, frames are then projected by rotating and summing its cells rather
+            than re-depositing every particle
+        raw_maps_only=False - only write the raw maps (totalMassMap, and 
+            totalMassTimes<Quantity>Map holding sum(mass*quantity)), which add linearly 
+            across slabs, particle types, and image tiles (see loadRawMaps and
+            firestudio.utils.gas_utils.raw_maps). The column density and mass weighted 
+            maps are then made from them with conv_fac and take_log_of_quantity when 
+            the image is produced. (The raw maps are always written, and are what 
+            produceImage reads when a setup has them)
+        auto_plan=False - pick the backend, nthreads, and chunk_size with planProjection
+            (from the estimated cost of the frame) right before projecting
     """ + "------- Studio\n" + Studio.__doc__
 
     def __init__(
@@ -69,6 +126,20 @@ class GasStudio(Studio):
         use_colorbar = False,
         use_hsml = True, ## flag to use the smoothing lengths passed
         snapdict = None, ## provide an open snapshot dictionary to save time opening
+        nthreads = None, ## number of threads to project image tiles with
+        second_moments = False, ## project mass weighted quantity^2 maps too
+        hybrid = False, ## cloud-in-cell deposit sub-pixel particles
+        fast_math = False, ## vectorized kernel evaluation
+        mip_tolerance = None, ## deposit large particles on coarser image levels
+        chunk_size = None, ## stream the snapshot in chunks of this many particles
+        snapchunks = None, ## iterable of snapshot data chunks to stream through
+        histogram = False, ## bin particles into pixels, ignoring smoothing lengths
+        auto_plan = False, ## let planProjection choose how to project
+        cache_hsml = True, ## reuse the smoothing lengths computed for this snapshot
+        slab_edges = None, ## z boundaries of slabs to project in one pass
+        volume_grid = None, ## deposit-once 3D grid to project frames from
+        raw_maps_only = False, ## don't write the converted maps, only the raw sums
+        ptype = 0, ## particle type of snapdict
         **kwargs):
 
         ## image limits and units
@@ -78,13 +149,33 @@ class GasStudio(Studio):
 
         ## what is the quantity we want to make a 2 color image with?
         ##  (or 1 color mass weighted map)
+        if type(quantity_name) == list:
+            ## project all of them, make the image from the first
+            self.quantity_names = quantity_name
+            quantity_name = quantity_name[0]
+        else:
+            self.quantity_names = [quantity_name]
         self.quantity_name=quantity_name
+        self.second_moments = second_moments
         self.take_log_of_quantity=take_log_of_quantity
         self.single_image = single_image
         self.cmap = cmap
         self.use_colorbar = use_colorbar
 
         self.use_hsml = use_hsml
+        self.nthreads = nthreads
+        self.hybrid = hybrid
+        self.fast_math = fast_math
+        self.mip_tolerance = mip_tolerance
+        self.chunk_size = chunk_size
+        self.snapchunks = snapchunks
+        self.histogram = histogram
+        self.auto_plan = auto_plan
+        self.cache_hsml = cache_hsml
+        self.slab_edges = slab_edges
+        self.volume_grid = volume_grid
+        self.raw_maps_only = raw_maps_only
+        self.ptype = ptype
 
         ## call Studio's init
         super().__init__(
@@ -118,25 +209,113 @@ class GasStudio(Studio):
 ####### projectImage implementation #######
     def projectImage(self,image_names):
 
+        if self.auto_plan:
+            self.planProjection()
+
+        slabs = False
+        if self.volume_grid is not None:
+            ## rotate and sum an already deposited grid
+            raw_maps = self.projectVolumeGrid()
+        elif self.slab_edges is not None:
+            ## project a stack of slabs in z in one pass, only the slabs' maps
+            ##  are written, produceImage collapses them
+            raw_maps = self.loadAndGetSlabImageGrid()
+            slabs = True
+        elif self.chunk_size is not None or self.snapchunks is not None:
+            ## project the snapshot a chunk at a time
+            raw_maps = self.streamImageGrid()
+        else:
+            raw_maps = self.loadAndGetImageGrid()
+
+        ## write every map in a single transaction, the projection file 
+        ##  is only held open while they're written
+        with self.projectionFileTransaction():
+            self.writeRawMaps(raw_maps,slabs=slabs)
+
+    def planProjection(
+        self,
+        nthreads=None,
+        max_seconds=None,
+        max_particles=None,
+        allow_histogram=False):
+        """ Estimates the cost of this frame (see Studio.estimateCost) and sets 
+            the backend (serial or threaded tiles, hybrid binning, or the quick 
+            histogram), nthreads, and chunk_size to project it with. A backend 
+            that approximates the projection differently moves the frame to its
+            own setup, see getProjectionMode.
+
+            Input:
+
+                nthreads = None -- most threads to use, None uses every cpu
+                max_seconds = None -- time budget, frames that won't fit it are
+                    warned about
+                max_particles = None -- most particles to read into memory at once,
+                    larger snapshots are streamed (if they aren't already open)
+                allow_histogram = False -- let frames that won't fit max_seconds
+                    fall back to the quick histogram, which changes the image
+
+            Output:
+
+                plan -- dictionary returned by projection.plan_projection"""
+
+        plan = projection.plan_projection(
+            self.estimateCost(),
+            nthreads=nthreads,
+            max_seconds=max_seconds,
+            max_particles=max_particles,
+            allow_histogram=allow_histogram)
+
+        mode = self.getProjectionMode()
+        self.nthreads = plan['nthreads']
+        self.hybrid = plan['backend'] == 'hybrid'
+        self.histogram = plan['backend'] == 'histogram'
+        if self.getProjectionMode() != mode:
+            ## the plan approximates the projection differently, 
+            ##  so its maps belong to a different setup
+            self.identifyThisSetup()
+
+        ## an open snapshot is already in memory, no point streaming it
+        if (plan['chunk_size'] is not None and 
+            self.snapdict is None and self.snapchunks is None):
+            self.chunk_size = plan['chunk_size']
+
+        print("Projecting with the %s backend on %d thread(s), ~%.1f s"%(
+            plan['backend'],plan['nthreads'],plan['seconds']))
+
+        return plan
+
+    def getSnapshotKeys(self):
+        """ keys of the snapshot to open to project the gas """
+        return (['Coordinates',
+            'Masses',
+            'Velocities',
+            'SmoothingLength',
+            'ParticleIDs']+
+            self.quantity_names)
+
+    def getFrameBoundingSphere(self):
+        """ Center and radius of the sphere around frame_center that holds the frame,
+            or the (padded) slabs, before it's rotated."""
+
+        center,radius = super().getFrameBoundingSphere()
+        if self.slab_edges is not None:
+            ## see loadAndGetSlabImageGrid
+            Hmax = 0.5*(self.Xmax-self.Xmin)
+            depth = np.max(np.abs(np.array(self.slab_edges)-center[2]))+Hmax
+            radius = np.sqrt(radius**2 + max(depth**2-self.frame_depth**2,0))
+        return center,radius
+
+    def loadAndGetImageGrid(self):
+        """ Projects the gas in this frame, returning the raw (totalMassMap,
+            weightedQuantityMap) maps, see getRawImageGrid."""
+
         ## open snapshot data if necessary
         if self.snapdict is None:
-            self.openSnapshot(
-                keys_to_extract = 
-                    ['Coordinates',
-                    'Masses',
-                    'Velocities',
-                    self.quantity_name,
-                    'SmoothingLength'])
+            self.openSnapshot(keys_to_extract=self.getSnapshotKeys())
 
         ## unpack the snapshot data from the snapdict
         Coordinates = self.snapdict['Coordinates']
         Masses = self.snapdict['Masses']
-        Quantity = self.snapdict[self.quantity_name]
-
-        if 'SmoothingLength' in self.snapdict and self.use_hsml:
-            Hsml = self.snapdict['SmoothingLength']
-        else:
-            Hsml = None
 
         BoxSize = self.snapdict['BoxSize']
 
@@ -145,8 +324,24 @@ class GasStudio(Studio):
 
         pos = Coordinates[ind_box].astype(np.float32)
         mass = Masses[ind_box].astype(np.float32)
-        quantity = Quantity[ind_box].astype(np.float32)
-        hsml = Hsml[ind_box].astype(np.float32) if Hsml is not None else Hsml
+        ## stack multiple quantities as Nquantities x N
+        if len(self.quantity_names) == 1:
+            quantity = self.snapdict[self.quantity_name][ind_box].astype(np.float32)
+        else:
+            quantity = np.array([
+                self.snapdict[quantity_name][ind_box] 
+                for quantity_name in self.quantity_names],dtype=np.float32)
+        hsml = self.loadFrameHsml(ind_box)
+        if self.cachingHsml() and not np.any(hsml) and not self.histogram:
+            ## search before rotating, over a padded frame, so the smoothing 
+            ##  lengths cached for other frames don't depend on this one's edges
+            hsml = self.findFrameHsml(
+                ind_box,
+                self.Xmin,self.Xmax,
+                self.Ymin,self.Ymax,
+                self.Zmin,self.Zmax,
+                ## the largest smoothing length, see getRawImageGrid
+                Hmax=0.5*(self.Xmax-self.Xmin))
 
         frame_center = self.frame_center.astype(np.float32)
 
@@ -156,35 +351,546 @@ class GasStudio(Studio):
         pos = self.rotateEuler(self.theta,self.phi,self.psi,pos)
 
         ## make the actual C call
-        columnDensityMap, massWeightedQuantityMap = getImageGrid(
+        raw_maps = getRawImageGrid(
             BoxSize,
             self.Xmin,self.Xmax,
             self.Ymin,self.Ymax,
             self.Zmin,self.Zmax,
             self.npix_x,self.npix_y,
             pos,mass,quantity,
+            hsml = hsml,
+            nthreads = self.nthreads,
+            second_moments = self.second_moments,
+            hybrid = self.hybrid,
+            fast_math = self.fast_math,
+            mip_tolerance = self.mip_tolerance,
+            histogram = self.histogram)
+
+        return raw_maps
+
+    def loadAndGetSlabImageGrid(self):
+        """ Projects the gas into the slabs between consecutive slab_edges (in z)
+            with a single walk over the particles' kernels, see 
+            projection.hsml_project_slabs.
+
+            Output:
+
+                totalMassSlabsMap -- (nslab,npix_x,npix_y) sum(mass) in each slab
+                weightedQuantitySlabsMap -- (Nmaps,nslab,npix_x,npix_y) sum(mass*quantity)
+                    (then sum(mass*quantity^2), if second_moments) in each slab"""
+
+        if self.chunk_size is not None or self.snapchunks is not None:
+            raise NotImplementedError("Can't stream the snapshot into slab maps")
+
+        ## open snapshot data if necessary
+        if self.snapdict is None:
+            self.openSnapshot(
+                keys_to_extract = 
+                    ['Coordinates',
+                    'Masses',
+                    'SmoothingLength',
+                    'ParticleIDs']+
+                    self.quantity_names)
+
+        slab_edges = np.asarray(self.slab_edges,dtype=np.float64)
+        if slab_edges.ndim != 1 or slab_edges.size < 2 or np.any(np.diff(slab_edges) <= 0):
+            raise ValueError("slab_edges must be (at least 2) increasing z boundaries")
+
+        ## cull to the slabs, padded by the largest smoothing length the
+        ##  neighbor search hands out so every kernel that reaches in is kept
+        Hmax = 0.5*(self.Xmax-self.Xmin)
+        Zmin,Zmax = self.Zmin,self.Zmax
+        self.Zmin,self.Zmax = slab_edges[0]-Hmax,slab_edges[-1]+Hmax
+        try:
+            ind_box = self.cullFrameIndices(self.snapdict['Coordinates'])
+            pos = self.snapdict['Coordinates'][ind_box].astype(np.float32)
+            hsml = self.loadFrameHsml(ind_box)
+            if (hsml is None or not np.any(hsml)) and not self.histogram:
+                hsml = self.findFrameHsml(
+                    ind_box,
+                    self.Xmin,self.Xmax,
+                    self.Ymin,self.Ymax,
+                    self.Zmin,self.Zmax,
+                    Hmax=Hmax)
+        finally:
+            self.Zmin,self.Zmax = Zmin,Zmax
+
+        mass = self.snapdict['Masses'][ind_box].astype(np.float32)
+        quantity = np.array([
+            self.snapdict[quantity_name][ind_box] 
+            for quantity_name in self.quantity_names],dtype=np.float32)
+        if self.second_moments:
+            quantity = np.concatenate([quantity,quantity**2])
+
+        ## rotate by euler angles if necessary
+        pos = self.rotateEuler(self.theta,self.phi,self.psi,pos)
+
+        print('------------------------------------------')
+        slabMassMaps,slabWeightedQuantityMaps = projection.hsml_project_slabs(
+            pos[:,0],pos[:,1],pos[:,2],hsml,
+            mass,quantity,
+            self.Xmin,self.Xmax,
+            self.Ymin,self.Ymax,
+            self.npix_x,self.npix_y,
+            slab_edges,
+            nthreads = 1 if self.nthreads is None else self.nthreads,
+            hybrid = self.hybrid,
+            fast_math = self.fast_math,
+            mip_tolerance = self.mip_tolerance,
+            histogram = self.histogram)
+        print('------------------------------------------')
+
+        return slabMassMaps,slabWeightedQuantityMaps.reshape(-1,*slabMassMaps.shape)
+
+    def depositVolumeGrid(
+        self,
+        ngrid=128,
+        half_width=None,
+        zblock=8):
+        """ Deposits the gas around frame_center onto a cube of cells once, so that 
+            frames of the same snapshot from any camera angle can be projected from 
+            the grid (at a cost set by ngrid rather than the number of particles).
+            Binds and returns the VolumeGrid.
+
+            Input:
+
+                ngrid = 128 -- number of cells along each side of the grid
+                half_width = None -- half-width of the grid, defaults to the radius
+                    of the frame's bounding sphere so that it holds the frame
+                    whatever the camera angle
+                zblock = 8 -- number of z layers deposited together
+
+            Output:
+
+                volume_grid -- the VolumeGrid, can be passed to other GasStudio 
+                    instances of the same snapshot with the volume_grid kwarg"""
+
+        if half_width is None:
+            ## the corners of a rotated frame reach out to its bounding sphere
+            half_width = self.getFrameBoundingSphere()[1]
+
+        ## open snapshot data if necessary
+        if self.snapdict is None:
+            self.openSnapshot(
+                keys_to_extract = 
+                    ['Coordinates',
+                    'Masses',
+                    'SmoothingLength',
+                    'ParticleIDs']+
+                    self.quantity_names)
+
+        ## particles inside the cube
+        Coordinates = self.snapdict['Coordinates']
+        ind_box = np.all(np.abs(Coordinates-self.frame_center) < half_width,axis=1)
+
+        pos = Coordinates[ind_box].astype(np.float32)
+        hsml = self.loadFrameHsml(ind_box)
+        if hsml is None or not np.any(hsml):
+            xmin,ymin,zmin = self.frame_center-half_width
+            xmax,ymax,zmax = self.frame_center+half_width
+            hsml = self.findFrameHsml(
+                ind_box,
+                xmin,xmax,
+                ymin,ymax,
+                zmin,zmax,
+                Hmax=half_width)
+
+        quantity = np.array([
+            self.snapdict[quantity_name][ind_box] 
+            for quantity_name in self.quantity_names],dtype=np.float32)
+        if len(self.quantity_names) == 1:
+            quantity = quantity[0]
+
+        self.volume_grid = VolumeGrid(
+            pos,hsml,
+            self.snapdict['Masses'][ind_box],
+            quantity,
+            self.frame_center,
+            half_width,
+            ngrid=ngrid,
+            zblock=zblock,
+            nthreads=1 if self.nthreads is None else self.nthreads,
+            second_moments=self.second_moments)
+
+        return self.volume_grid
+
+    def projectVolumeGrid(self):
+        """ Projects this frame from the deposited volume_grid, returning the same
+            raw (totalMassMap,weightedQuantityMap) maps as loadAndGetImageGrid."""
+
+        nquantities = self.volume_grid.nquantities
+        if nquantities != len(self.quantity_names):
+            raise ValueError("volume_grid holds %d quantities, not %d"%(
+                nquantities,len(self.quantity_names)))
+        if self.second_moments and not self.volume_grid.second_moments:
+            raise ValueError(
+                "volume_grid was deposited without second_moments, deposit it"+
+                " with a second_moments GasStudio")
+
+        print('------------------------------------------')
+        raw_maps = self.volume_grid.project(
+            self.frame_center,
+            self.theta,self.phi,self.psi,
+            self.Xmin,self.Xmax,
+            self.Ymin,self.Ymax,
+            self.Zmin,self.Zmax,
+            self.npix_x,self.npix_y,
+            hybrid = self.hybrid,
+            fast_math = self.fast_math)
+        print('------------------------------------------')
+
+        if self.volume_grid.second_moments and not self.second_moments:
+            ## drop the sum(mass*quantity^2) maps
+            totalMassMap,weightedQuantityMap = raw_maps
+            raw_maps = totalMassMap,weightedQuantityMap[:nquantities]
+
+        return raw_maps
+
+    def loadFrameHsml(self,ind_box):
+        """ Returns the smoothing lengths of the particles in ind_box, from the 
+            snapdict or (if cachingHsml) from the hsml cache. If any are missing,
+            returns a zero-filled array for the neighbor search to fill."""
+
+        hsml = None
+        if 'SmoothingLength' in self.snapdict and self.use_hsml:
+            hsml = self.snapdict['SmoothingLength'][ind_box].astype(np.float32)
+
+        ## collisionless particles get theirs from their neighbors in the whole snapdict
+        if self.ptype != 0 and self.use_hsml and (hsml is None or not np.all(hsml > 0)):
+            engine = self.getHsmlEngine(
+                self.snapdict,self.ptype,
+                nthreads=self.nthreads if self.nthreads is not None else 1)
+            return engine.query(ind_box)
+
+        ## look for smoothing lengths computed by an earlier frame
+        if self.cachingHsml() and (hsml is None or not np.all(hsml > 0)):
+            hsml = load_cached_hsml(self.hsml_cache_file,self.getHsmlCacheKeys(ind_box))
+
+        if hsml is not None and not np.all(hsml > 0):
+            ## compute all of them in the same neighbor search
+            hsml[:] = 0
+
+        return hsml
+
+    def cachingHsml(self):
+        """ whether the smoothing lengths the neighbor search computes are kept """
+        return self.cache_hsml and self.use_hsml and 'ParticleIDs' in self.snapdict
+
+    def getHsmlCacheKeys(self,indices):
+        """ keys of the particles in indices in the hsml cache """
+        return get_particle_keys(
+            self.snapdict['ParticleIDs'][indices],
+            self.snapdict['ParticleChildIDsNumber'][indices] 
+            if 'ParticleChildIDsNumber' in self.snapdict else None)
+
+    def saveFrameHsml(self,indices,hsml):
+        """ Writes the smoothing lengths findFrameHsml computed for the particles in
+            indices back into the snapdict and the hsml cache (if cachingHsml)."""
+
+        if not self.cachingHsml():
+            return
+
+        if 'SmoothingLength' not in self.snapdict:
+            self.snapdict['SmoothingLength'] = np.zeros(
+                self.snapdict['Masses'].shape[0],dtype=np.float32)
+        self.snapdict['SmoothingLength'][indices] = hsml
+        save_cached_hsml(self.hsml_cache_file,self.getHsmlCacheKeys(indices),hsml)
+
+    def findFrameHsml(
+        self,
+        ind_box,
+        Xmin,Xmax,
+        Ymin,Ymax,
+        Zmin,Zmax,
+        Hmax):
+        """ Neighbor searches for the smoothing lengths of the particles in ind_box,
+            which lie inside the (unrotated) box Xmin..Zmax, over the box padded by 
+            Hmax (the largest smoothing length the search hands out to particles
+            that have few neighbors) so that those near its edges find their 
+            neighbors outside of it. The smoothing lengths that don't depend on 
+            the edges of the padded box, those of particles whose neighbors are
+            all inside of it, are saved (see saveFrameHsml) for other frames.
+
+            Output:
+
+                hsml -- float32 smoothing lengths of the particles in ind_box"""
+
+        Coordinates = self.snapdict['Coordinates']
+        lows = np.array([Xmin,Ymin,Zmin])-Hmax
+        highs = np.array([Xmax,Ymax,Zmax])+Hmax
+        ind_padded = np.all((Coordinates > lows) & (Coordinates < highs),axis=1)
+        pos = Coordinates[ind_padded].astype(np.float32)
+
+        hsml = projection.find_hsml(
+            self.snapdict['BoxSize'],
+            lows[0],highs[0],
+            lows[1],highs[1],
+            lows[2],highs[2],
+            pos,
+            Hmax=Hmax)
+
+        ## distance from each particle to the nearest edge of the padded box
+        edge_distance = np.min(np.minimum(pos-lows,highs-pos),axis=1)
+        in_padded = np.flatnonzero(ind_padded)
+        unbiased = hsml < edge_distance
+        self.saveFrameHsml(in_padded[unbiased],hsml[unbiased])
+
+        return hsml[ind_box[ind_padded]]
+
+    def streamImageGrid(self):
+        """ Projects the gas one chunk of particles at a time, culling and rotating 
+            each chunk and accumulating it into the same raw sum(mass) and
+            sum(mass*quantity) maps."""
+
+        if self.snapchunks is not None:
+            chunks = self.snapchunks
+        else:
+            chunks = self.openSnapshotChunks(
+                ptype = self.ptype,
+                keys_to_extract = 
+                    ['Coordinates',
+                    'Masses',
+                    'SmoothingLength']+
+                    self.quantity_names,
+                chunk_size = self.chunk_size)
+
+        nquantities = len(self.quantity_names)
+        nmaps = 2*nquantities if self.second_moments else nquantities
+
+        ## the maps every chunk is added to
+        totalMassMap = np.zeros((self.npix_x,self.npix_y),dtype=np.float32)
+        weightedQuantityMap = np.zeros((nmaps,self.npix_x,self.npix_y),dtype=np.float32)
+
+        print('------------------------------------------')
+        for chunk in chunks:
+            ## cull the particles outside the frame and cast to float32
+            Coordinates = chunk['Coordinates']
+            ind_box = self.cullFrameIndices(Coordinates)
+            if not np.any(ind_box):
+                continue
+
+            if 'SmoothingLength' not in chunk and not self.histogram:
+                raise KeyError(
+                    "Streaming projection needs SmoothingLength in the snapshot chunks")
+
+            pos = Coordinates[ind_box].astype(np.float32)
+            mass = chunk['Masses'][ind_box].astype(np.float32)
+            hsml = (chunk['SmoothingLength'][ind_box].astype(np.float32) 
+                if 'SmoothingLength' in chunk else None)
+            quantity = np.array([
+                chunk[quantity_name][ind_box] 
+                for quantity_name in self.quantity_names],dtype=np.float32)
+            if self.second_moments:
+                quantity = np.concatenate([quantity,quantity**2])
+
+            ## rotate by euler angles if necessary
+            pos = self.rotateEuler(self.theta,self.phi,self.psi,pos)
+
+            projectWeightedMaps(
+                pos,hsml,mass,quantity,
+                self.Xmin,self.Xmax,
+                self.Ymin,self.Ymax,
+                self.npix_x,self.npix_y,
+                Zmin = self.Zmin,Zmax = self.Zmax,
+                ## the largest smoothing length, see getRawImageGrid
+                Hmax = 0.5*(self.Xmax-self.Xmin),
+                nthreads = 1 if self.nthreads is None else self.nthreads,
+                hybrid = self.hybrid,
+                fast_math = self.fast_math,
+                mip_tolerance = self.mip_tolerance,
+                histogram = self.histogram,
+                out = (totalMassMap,weightedQuantityMap),
+                accumulate = True)
+        print('------------------------------------------')
+
+        return totalMassMap,weightedQuantityMap
+
+    def writeRawMaps(self,raw_maps,slabs=False):
+        """ Writes the raw sum(mass) and sum(mass*quantity) maps to this setup in the 
+            projection file, as totalMassMap and totalMassTimes<Quantity>Map (and
+            totalMassTimes<Quantity>SquaredMap, if second_moments), along with the
+            converted maps made from them (unless raw_maps_only).
+
+            Input:
+
+                raw_maps -- (totalMassMap,weightedQuantityMap) pair
+                slabs = False -- whether these are (nslab,npix_x,npix_y) maps of the 
+                    slabs between slab_edges, written as *SlabsMap (with slab_edges)"""
+
+        totalMassMap,weightedQuantityMap = raw_maps
+        suffix = 'SlabsMap' if slabs else 'Map'
+
+        ## one sum(mass*quantity) map per name, then the sum(mass*quantity^2) maps
+        weightedQuantityMap = np.reshape(weightedQuantityMap,(-1,*np.shape(totalMassMap)))
+        image_names = ['totalMassTimes%s'%quantity_name.title() 
+            for quantity_name in self.quantity_names]
+        if self.second_moments:
+            image_names += [image_name+'Squared' for image_name in image_names]
+
+        if slabs:
+            self.writeImageGrid(
+                np.asarray(self.slab_edges,dtype=np.float64),
+                'slab_edges',
+                overwrite=self.overwrite)
+
+        self.writeImageGrid(
+            totalMassMap,
+            'totalMass'+suffix,
+            overwrite=self.overwrite)
+
+        for image_name,this_weightedQuantityMap in zip(image_names,weightedQuantityMap):
+            self.writeImageGrid(
+                this_weightedQuantityMap,
+                image_name+suffix,
+                overwrite=self.overwrite)
+
+        if not self.raw_maps_only:
+            self.writeMaps(self.convertRawMaps(raw_maps),slabs=slabs)
+
+    def loadRawMaps(self,slabs=False):
+        """ Reads this setup's raw maps back from the projection file, e.g. to 
+            compose them with those of other setups (see firestudio.utils.gas_utils.raw_maps).
+
+            Input:
+
+                slabs = False -- read the maps of the slabs between slab_edges
+
+            Output:
+
+                totalMassMap -- sum(mass) in each pixel
+                weightedQuantityMap -- (Nmaps,...) sum(mass*quantity) (then 
+                    sum(mass*quantity^2), if second_moments) in each pixel"""
+
+        suffix = 'SlabsMap' if slabs else 'Map'
+        image_names = ['totalMassTimes%s'%quantity_name.title() 
+            for quantity_name in self.quantity_names]
+        if self.second_moments:
+            image_names += [image_name+'Squared' for image_name in image_names]
+
+        with h5py.File(self.projection_file, "r") as handle:
+            this_group=handle[self.this_setup_id]
+            totalMassMap = np.array(this_group['totalMass'+suffix])
+            weightedQuantityMap = np.array([
+                this_group[image_name+suffix] for image_name in image_names])
+
+        return totalMassMap,weightedQuantityMap
+
+    def convertRawMaps(self,raw_maps):
+        """ Converts raw maps (of this frame, or of its slabs) to the (log) column density 
+            and mass weighted quantity maps with this studio's conv_fac and 
+            take_log_of_quantity, see convertRawImageGrid."""
+
+        totalMassMap,weightedQuantityMap = raw_maps
+        return convertRawImageGrid(
+            totalMassMap,weightedQuantityMap,
+            self.Xmin,self.Xmax,
+            self.Ymin,self.Ymax,
+            self.npix_x,self.npix_y,
+            len(self.quantity_names),
             self.take_log_of_quantity,
-            conv_fac = self.conv_fac,
-            hsml = hsml)
+            self.conv_fac,
+            self.second_moments)
+
+    def writeMaps(self,maps,slabs=False):
+        columnDensityMap, massWeightedQuantityMaps = maps[:2]
+        suffix = 'SlabsMap' if slabs else 'Map'
+
+        ## put the quantity maps in a list, one per name
+        if len(self.quantity_names) == 1:
+            massWeightedQuantityMaps = [massWeightedQuantityMaps]
 
         ## write the output to an .hdf5 file
         self.writeImageGrid(
             columnDensityMap,
-            'columnDensityMap',
+            'columnDensity'+suffix,
             overwrite=self.overwrite)
 
-        self.writeImageGrid(
-            massWeightedQuantityMap, 
-            "massWeighted%sMap"%self.quantity_name.title(),
-            overwrite=self.overwrite)
+        for quantity_name,massWeightedQuantityMap in zip(
+            self.quantity_names,massWeightedQuantityMaps):
+            self.writeImageGrid(
+                massWeightedQuantityMap, 
+                "massWeighted%s"%quantity_name.title()+suffix,
+                overwrite=self.overwrite)
+
+        if self.second_moments:
+            massWeightedSquaredQuantityMaps = maps[2]
+            if len(self.quantity_names) == 1:
+                massWeightedSquaredQuantityMaps = [massWeightedSquaredQuantityMaps]
+
+            for quantity_name,massWeightedSquaredQuantityMap in zip(
+                self.quantity_names,massWeightedSquaredQuantityMaps):
+                self.writeImageGrid(
+                    massWeightedSquaredQuantityMap, 
+                    "massWeighted%sSquared"%quantity_name.title()+suffix,
+                    overwrite=self.overwrite)
+
+    def getProjectionMode(self):
+        """ Suffix that tells the approximate projections (histogram, hybrid, and
+            mip_tolerance) apart in the setup id, empty for the exact one """
+
+        if self.histogram:
+            return "_histogram"
+
+        mode = ""
+        if self.hybrid:
+            mode += "_hybrid"
+        if self.mip_tolerance is not None:
+            mode += "_mip%g"%self.mip_tolerance
+        return mode
+
+    def identifyThisSetup(self):
+        """ Like Studio.identifyThisSetup, but a stack of slabs is its own setup,
+            and so is each approximation of the projection (see getProjectionMode) """
+
+        super().identifyThisSetup()
+        if self.slab_edges is not None:
+            self.this_setup_id += "_slabs%s"%(
+                "_".join(["%.2f"%edge for edge in np.round(self.slab_edges,decimals=2)]))
+        self.this_setup_id += self.getProjectionMode()
+        return self.this_setup_id
+
+    def checkProjectionFile(self,image_names):
+        """ Like Studio.checkProjectionFile, but the converted maps can also be
+            made (at read time) from the raw maps. A stack of slabs only has the 
+            slabs' (*SlabsMap) maps, see projectImage."""
+
+        suffix = 'Map'
+        if self.slab_edges is not None:
+            suffix = 'SlabsMap'
+            image_names = ['slab_edges']+[
+                image_name[:-len('Map')]+suffix if image_name.endswith('Map') else image_name
+                for image_name in image_names]
+
+        if super().checkProjectionFile(image_names):
+            return True
+
+        raw_image_names = ['totalMass'+suffix]+[
+            image_name.replace('massWeighted','totalMassTimes')
+            for image_name in image_names if image_name.startswith('massWeighted')]
+        if self.slab_edges is not None:
+            raw_image_names += ['slab_edges']
+        return super().checkProjectionFile(raw_image_names)
 
 ####### produceImage implementation #######
     def produceImage(self,image_names):
         ## open the hdf5 file and load the maps
         with h5py.File(self.projection_file, "r") as handle:
             this_group=handle[self.this_setup_id]
-            columnDensityMap = np.array(this_group['columnDensityMap'])
-            massWeightedQuantityMap = np.array(this_group['massWeighted%sMap'%self.quantity_name.title()])
+            has_raw_maps = self.slab_edges is not None or 'totalMassMap' in this_group.keys()
+            if not has_raw_maps:
+                columnDensityMap = np.array(this_group['columnDensityMap'])
+                massWeightedQuantityMap = np.array(this_group['massWeighted%sMap'%self.quantity_name.title()])
+
+        ## convert the raw maps with the current conv_fac and take_log_of_quantity
+        if has_raw_maps:
+            if self.slab_edges is not None:
+                ## sum the stack of slabs into the frame
+                raw_maps = collapse_slabs(*self.loadRawMaps(slabs=True))
+            else:
+                raw_maps = self.loadRawMaps()
+            columnDensityMap,massWeightedQuantityMap = self.convertRawMaps(raw_maps)[:2]
+            if len(self.quantity_names) > 1:
+                massWeightedQuantityMap = massWeightedQuantityMap[0]
 
         ## make sure that the maps we're loading are the correct shape
         try:
@@ -258,71 +964,269 @@ def getImageGrid(
     pos,mass,quantity,
     take_log_of_quantity,
     conv_fac,
-    hsml=None):
+    hsml=None,
+    nthreads=None,
+    second_moments=False,
+    hybrid=False,
+    fast_math=False,
+    mip_tolerance=None,
+    histogram=False,
+    out=None):
+    """ Projects the particles and converts the maps to (log) column density and 
+        mass weighted quantity, see getRawImageGrid and convertRawImageGrid."""
+
+    totalMassMap,weightedQuantityMap = getRawImageGrid(
+        BoxSize,
+        Xmin,Xmax,
+        Ymin,Ymax,
+        Zmin,Zmax,
+        npix_x,npix_y,
+        pos,mass,quantity,
+        hsml=hsml,
+        nthreads=nthreads,
+        second_moments=second_moments,
+        hybrid=hybrid,
+        fast_math=fast_math,
+        mip_tolerance=mip_tolerance,
+        histogram=histogram,
+        out=out)
+
+    return convertRawImageGrid(
+        totalMassMap,weightedQuantityMap,
+        Xmin,Xmax,
+        Ymin,Ymax,
+        npix_x,npix_y,
+        1 if quantity.ndim == 1 else quantity.shape[0],
+        take_log_of_quantity,
+        conv_fac,
+        second_moments)
+
+def getRawImageGrid(
+    BoxSize,
+    Xmin,Xmax,
+    Ymin,Ymax,
+    Zmin,Zmax,
+    npix_x,npix_y,
+    pos,mass,quantity,
+    hsml=None,
+    nthreads=None,
+    second_moments=False,
+    hybrid=False,
+    fast_math=False,
+    mip_tolerance=None,
+    histogram=False,
+    out=None):
+    """ Projects the particles into raw sum(mass) and sum(mass*quantity) (and 
+        sum(mass*quantity^2), if second_moments) maps, which (unlike the converted
+        maps) add linearly across slabs, particle types, and image tiles. out can 
+        hold the (totalMassMap,weightedQuantityMap) float32 arrays to fill in place,
+        to reuse them across many frames. A zero-filled hsml array is filled in 
+        place with the smoothing lengths the neighbor search computes.
+
+        Output:
+
+            totalMassMap -- sum(mass) in each pixel
+            weightedQuantityMap -- sum(mass*quantity) in each pixel, 
+                (Nmaps,npix_x,npix_y) for multiple quantities or second moments"""
 
     ## set c-routine variables
     desngb   = 32
-    Axis1    = 0
-    Axis2    = 1
-    Axis3    = 2
 
-    Hmax     = 0.5*(Xmax-Xmin)
+    ## multiple quantities (Nquantities x N) and second moments are projected 
+    ##  in a single pass by the tiled routine
+    single_quantity = quantity.ndim == 1
+    nquantities = 1 if single_quantity else quantity.shape[0]
+    if nthreads is None:
+        nthreads = 1
 
-    n_smooth = pos.shape[0]
+    if second_moments:
+        ## project sum(mass*quantity^2) alongside sum(mass*quantity)
+        quantity = np.concatenate([
+            quantity.reshape(nquantities,-1),
+            quantity.reshape(nquantities,-1)**2])
 
-    ## output array for sum along the line of sight
-    totalMassMap = np.zeros(shape = (npix_x,npix_y),dtype=np.float32)
+    Hmax     = 0.5*(Xmax-Xmin)
 
-    ## output array for average along the line of sight
-    massWeightedQuantityMap = np.zeros(shape = (npix_x,npix_y),dtype=np.float32)
-    
     ## create hsml output array
     if hsml is None:
         hsml = np.zeros(mass.shape[0],dtype=np.float32)
     else:
         print("Using provided smoothing lengths")
-    
-    c_f_p      = ctypes.POINTER(ctypes.c_float)
-    pos_p      = pos.ctypes.data_as(c_f_p)
-    hsml_p     = hsml.ctypes.data_as(c_f_p)
-    mass_p     = mass.ctypes.data_as(c_f_p)
-    quantity_p = quantity.ctypes.data_as(c_f_p)
-    w_f_p    = totalMassMap.ctypes.data_as(c_f_p)
-    q_f_p    = massWeightedQuantityMap.ctypes.data_as(c_f_p)
 
     print('------------------------------------------')
-    curpath = os.path.realpath(__file__)
-    curpath = os.path.split(curpath)[0] #split off this filename
-    curpath = os.path.split(curpath)[0] #split off studios direcotry
-    c_obj = ctypes.CDLL(os.path.join(
-        curpath,'utils','gas_utils','HsmlAndProject_cubicSpline/HsmlAndProject.so'))
-
-    #print(n_smooth)
-    #print(pos_p)
-    #print(hsml_p)
-    #print(mass_p)
-    #print(quantity_p)
-    #print(Xmin,Xmax)
-    #print(Ymin,Ymax)
-    #print(Zmin,Zmax)
-    #print(npix_x,npix_y)
-    #print(desngb)
-    #print(Axis1,Axis2,Axis3)
-    #print(Hmax,BoxSize)
-
-    c_obj.findHsmlAndProject(
-	ctypes.c_int(n_smooth), ## number of particles
-	pos_p,hsml_p,mass_p,quantity_p, ## position, mass, and "quantity" of particles
-        ctypes.c_float(Xmin.astype(np.float32)),ctypes.c_float(Xmax.astype(np.float32)), ## xmin/xmax
-	ctypes.c_float(Ymin.astype(np.float32)),ctypes.c_float(Ymax.astype(np.float32)), ## ymin/ymax
-	ctypes.c_float(Zmin.astype(np.float32)),ctypes.c_float(Zmax.astype(np.float32)), ## zmin/zmax
-        ctypes.c_int(npix_x),ctypes.c_int(npix_y), ## npixels
-	ctypes.c_int(desngb), ## neighbor depth
-        ctypes.c_int(Axis1),ctypes.c_int(Axis2),ctypes.c_int(Axis3), ## axes...?
-	ctypes.c_float(Hmax),ctypes.c_double(BoxSize), ## maximum smoothing length and size of box
-	w_f_p,q_f_p) ## pointers to output cell-mass and cell-mass-weighted-quantity
+    ## the tiled routine needs smoothing lengths up front, fill them
+    ##  in place with findHsmlAndProject's neighbor search
+    if not np.any(hsml) and not histogram:
+        hsml[:] = projection.find_hsml(
+            BoxSize,
+            Xmin,Xmax,
+            Ymin,Ymax,
+            Zmin,Zmax,
+            pos,
+            desngb=desngb,
+            Hmax=Hmax)
+
+    ## which deposits like findHsmlAndProject does
+    totalMassMap, weightedQuantityMap = projectWeightedMaps(
+        pos,hsml,mass,quantity,
+        Xmin,Xmax,
+        Ymin,Ymax,
+        npix_x,npix_y,
+        Zmin=Zmin,Zmax=Zmax,
+        Hmax=Hmax,
+        nthreads=nthreads,
+        hybrid=hybrid,
+        fast_math=fast_math,
+        mip_tolerance=mip_tolerance,
+        histogram=histogram,
+        out=out)
     print('------------------------------------------')
 
+    return totalMassMap,weightedQuantityMap
+
+def convertRawImageGrid(
+    totalMassMap,weightedQuantityMap,
+    Xmin,Xmax,
+    Ymin,Ymax,
+    npix_x,npix_y,
+    nquantities,
+    take_log_of_quantity,
+    conv_fac,
+    second_moments=False):
+    """ Converts raw sum(mass) and sum(mass*quantity) maps (of a frame, or of a 
+        stack of slabs) to (log) column density and mass weighted quantity maps
+        (and mass weighted quantity^2 maps, if second_moments). Multiple quantities
+        are returned as (Nquantities,...) arrays."""
+
+    massWeightedQuantityMap,massWeightedSquaredQuantityMap = getMassWeightedMaps(
+        totalMassMap,weightedQuantityMap,
+        nquantities,nquantities == 1,
+        second_moments)
+
+    maps = convertImageGrid(
+        totalMassMap,massWeightedQuantityMap,
+        Xmin,Xmax,
+        Ymin,Ymax,
+        npix_x,npix_y,
+        take_log_of_quantity,
+        conv_fac)
+
+    ## second moments are left linear so a dispersion can be
+    ##  computed as sqrt(<q^2> - <q>^2)
+    if second_moments:
+        return maps[0],maps[1],massWeightedSquaredQuantityMap
+   
+    return maps
+
+def projectWeightedMaps(
+    pos,hsml,mass,quantity,
+    Xmin,Xmax,
+    Ymin,Ymax,
+    npix_x,npix_y,
+    Zmin=None,Zmax=None,
+    Hmax=None,
+    nthreads=1,
+    hybrid=False,
+    fast_math=False,
+    mip_tolerance=None,
+    histogram=False,
+    out=None,
+    accumulate=False):
+    """ Projects sum(mass) and sum(mass*quantity) with the tiled hsml_project routine,
+        or just bins the particles into pixels if histogram is set. Like 
+        findHsmlAndProject, the particles outside Zmin-Zmax (if they're passed) 
+        are dropped and the smoothing lengths are limited to Hmax."""
+
+    ## cut to the (rotated) frame's depth
+    if Zmin is not None and Zmax is not None:
+        ind_z = (pos[:,2] >= np.float32(Zmin)) & (pos[:,2] <= np.float32(Zmax))
+        if not np.all(ind_z):
+            pos,mass,quantity = pos[ind_z],mass[ind_z],quantity[...,ind_z]
+            if hsml is not None:
+                hsml = hsml[ind_z]
+
+    if Hmax is not None and hsml is not None:
+        hsml = np.minimum(hsml,np.float32(Hmax))
+
+    ## quick look, ignores the smoothing lengths
+    if histogram:
+        return projection.histogram_project(
+            pos[:,0],pos[:,1],
+            mass,quantity,
+            Xmin,Xmax,
+            Ymin,Ymax,
+            npix_x,npix_y,
+            out=out,
+            accumulate=accumulate)
+
+    ## thread-parallel projection over image tiles, optionally
+    ##  binning sub-pixel particles without the kernel loop
+    if mip_tolerance is None:
+        return projection.hsml_project_tiled(
+            pos[:,0],pos[:,1],hsml,
+            mass,quantity,
+            Xmin,Xmax,
+            Ymin,Ymax,
+            npix_x,npix_y,
+            nthreads=nthreads,
+            hybrid=hybrid,
+            fast_math=fast_math,
+            out=out,
+            accumulate=accumulate)
+
+    ## and depositing large particles on coarser levels of an image pyramid
+    return projection.hsml_project_pyramid(
+        pos[:,0],pos[:,1],hsml,
+        mass,quantity,
+        Xmin,Xmax,
+        Ymin,Ymax,
+        npix_x,npix_y,
+        mip_tolerance=mip_tolerance,
+        nthreads=nthreads,
+        hybrid=hybrid,
+        fast_math=fast_math,
+        out=out,
+        accumulate=accumulate)
+
+def getMassWeightedMaps(
+    totalMassMap,weightedQuantityMap,
+    nquantities,single_quantity,
+    second_moments=False):
+    """ Turns sum(mass*quantity) (and sum(mass*quantity^2)) maps into mass weighted
+        quantity (and quantity^2) maps. The second is None without second moments."""
+
+    ## turn sum(mass*quantity) into the mass weighted quantity
+    massWeightedQuantityMap = np.zeros(weightedQuantityMap.shape,dtype=np.float32)
+    np.divide(
+        weightedQuantityMap,totalMassMap,
+        out=massWeightedQuantityMap,
+        where=totalMassMap>0)
+
+    massWeightedSquaredQuantityMap = None
+    if single_quantity and not second_moments:
+        massWeightedQuantityMap = massWeightedQuantityMap.reshape(totalMassMap.shape)
+    elif second_moments:
+        ## split off the mass weighted quantity^2 maps
+        massWeightedQuantityMap = massWeightedQuantityMap.reshape(2*nquantities,*totalMassMap.shape)
+        massWeightedQuantityMap,massWeightedSquaredQuantityMap = (
+            massWeightedQuantityMap[:nquantities],
+            massWeightedQuantityMap[nquantities:])
+        if single_quantity:
+            massWeightedQuantityMap = massWeightedQuantityMap[0]
+            massWeightedSquaredQuantityMap = massWeightedSquaredQuantityMap[0]
+
+    return massWeightedQuantityMap,massWeightedSquaredQuantityMap
+
+def convertImageGrid(
+    totalMassMap,massWeightedQuantityMap,
+    Xmin,Xmax,
+    Ymin,Ymax,
+    npix_x,npix_y,
+    take_log_of_quantity,
+    conv_fac):
+    """ Converts a total mass map to a log column density map and (optionally)
+        takes the log of the mass weighted quantity map."""
+
     # normalise by area of each pixel to get SFC density (column density)
     Acell = (Xmax-Xmin)/npix_x * (Ymax-Ymin)/npix_y
     columnDensityMap = totalMassMap/(Acell) # 10^10 Msun / kpc^-2 
@@ -348,7 +1252,7 @@ def getImageGrid(
 	'log10 minmax(massWeightedQuantityMap)',
 	np.min(massWeightedQuantityMap),
 	np.min(massWeightedQuantityMap))
-   
+
     return columnDensityMap,massWeightedQuantityMap
 
 
@@ -18,6 +18,8 @@ from abg_python.galaxy.metadata_utils import metadata_cache
 from firestudio.studios.studio import Studio
 
 from firestudio.utils.stellar_utils import raytrace_projection,load_stellar_hsml
+from firestudio.utils.stellar_utils.colors_sps.colors_table import colors_table
+from firestudio.utils.stellar_utils.lum_cache import get_particle_keys,get_band_lums_per_mass
 import firestudio.utils.stellar_utils.make_threeband_image as makethreepic
 
 
@@ -26,6 +28,7 @@ class StarStudio(Studio):
         attenuation along the line of sight. 
 
 * [`StarStudio.get_mockHubbleImage`](#starstudioget_mockhubbleimage) 
+* [`StarStudio.get_bandCube`](#starstudioget_bandcube) 
 * [`StarStudio.render`](#starstudiorender) 
 * [`Studio.__init__`](#studio__init__) 
 * [`Studio.set_ImageParams`](#studioset_imageparams)"""
@@ -53,6 +56,26 @@ class StarStudio(Studio):
                     defaults to the dynamic range between maxden and the 10th %'ile
                     of the image surface brightness
                 color_scheme_nasa = True -- flag for switching between Hubble vs. SDSS images
+                hybrid = False -- flag to deposit particles smaller than a pixel with 
+                    cloud-in-cell weights (in z order) rather than the full kernel loop
+                fast_math = False -- flag to evaluate the kernel and the attenuation in 
+                    vectorized loops, see kernel_bindings.FAST_MATH_TOLERANCE
+                nthreads = 1 -- number of threads to raytrace tiles of the image with,
+                    the image is the same for any number of threads
+                front_to_back = False -- flag to composite the nearest particles first
+                    and stop at pixels that have become opaque, much cheaper for 
+                    dusty (e.g. edge-on) disks
+                min_transmittance = 1e-4 -- transmittance (in every band) below which
+                    front_to_back treats a pixel as opaque
+                cache_lums = True -- flag to look up the stars' luminosities in each
+                    band once per snapshot and keep them (by ParticleIDs) in files 
+                    next to the projection file, later frames of the same snapshot
+                    memory-map them and only gather the stars in the frame
+                nslabs = None -- number of slabs of depth to raytrace the frame in,
+                    spooling them to disk so only a slab's particles are sorted and 
+                    staged at a time (see raytrace_projection.stellar_raytrace_streaming),
+                    None raytraces every particle in memory at once. can't be 
+                    combined with front_to_back
                 loud = True -- flagwhether print statements should show up on console.
             
             Output: 
@@ -70,7 +93,14 @@ starStudio.set_ImageParams(
         default_kwargs = {
             'maxden' : None, ## 
             'dynrange' : None, ## controls the saturation of the image in a non-obvious way
-            'color_scheme_nasa' : True} ## flag to use nasa colors (vs. SDSS if false)
+            'color_scheme_nasa' : True, ## flag to use nasa colors (vs. SDSS if false)
+            'hybrid' : False, ## flag to cloud-in-cell deposit sub-pixel particles
+            'fast_math' : False, ## flag to vectorize the kernel and attenuation
+            'nthreads' : 1, ## threads to raytrace image tiles with
+            'front_to_back' : False, ## flag to composite nearest first, stopping at opaque pixels
+            'min_transmittance' : 1e-4, ## transmittance of an opaque pixel
+            'cache_lums' : True, ## flag to keep the stars' luminosities between frames
+            'nslabs' : None} ## slabs of depth to raytrace out of core, None in memory
 
         for kwarg in list(kwargs.keys()):
             ## only set it here if it was passed
@@ -120,7 +150,14 @@ starStudio.set_ImageParams(
         default_kwargs = {
             'maxden' : 1.0e-2, ## 
             'dynrange' : 100.0, ## controls the saturation of the image in a non-obvious way
-            'color_scheme_nasa' : True} ## flag to use nasa colors (vs. SDSS if false)
+            'color_scheme_nasa' : True, ## flag to use nasa colors (vs. SDSS if false)
+            'hybrid' : False, ## flag to cloud-in-cell deposit sub-pixel particles
+            'fast_math' : False, ## flag to vectorize the kernel and attenuation
+            'nthreads' : 1, ## threads to raytrace image tiles with
+            'front_to_back' : False, ## flag to composite nearest first, stopping at opaque pixels
+            'min_transmittance' : 1e-4, ## transmittance of an opaque pixel
+            'cache_lums' : True, ## flag to keep the stars' luminosities between frames
+            'nslabs' : None} ## slabs of depth to raytrace out of core, None in memory
 
         ## print the current value, not the default value
         for arg in default_kwargs:
@@ -180,6 +217,15 @@ starStudio.set_ImageParams(
 
         return metal_mass_map*unit_factor,outs[0]*unit_factor,outs[1]*unit_factor,outs[2]*unit_factor
 
+    def getCompositingKey(self):
+        """ Suffix of the names the raytraced maps are cached under. front_to_back
+            drops the light behind opaque pixels, so its maps are cached apart 
+            from the back to front ones, for each min_transmittance."""
+
+        if not self.front_to_back:
+            return ''
+        return '_frontToBack%g'%self.min_transmittance
+
     def get_mockHubbleImage(
         self,
         use_metadata=True,
@@ -225,12 +271,15 @@ starStudio.set_ImageParams(
                 out_r -- total attenuated luminosity along LOS in pixel
                     in r band, in unknown units"""
 
+        ## cached separately for each way of compositing
+        compositing_key = self.getCompositingKey()
+
         @metadata_cache(
             self.this_setup_id,  ## hdf5 file group name
-            ['starMassesMap',
-                'attenUMap', ## TODO naming it this could be confusing if BAND_IDS is different...
-                'attenGMap',
-                'attenRMap'],
+            ['starMassesMap'+compositing_key,
+                'attenUMap'+compositing_key, ## TODO naming it this could be confusing if BAND_IDS is different...
+                'attenGMap'+compositing_key,
+                'attenRMap'+compositing_key],
             use_metadata=use_metadata,
             save_meta=save_meta,
             assert_cached=assert_cached,
@@ -246,6 +295,10 @@ starStudio.set_ImageParams(
                 star_pos, mstar, ages, metals, h_star,
                 gas_pos , mgas , gas_metals ,  h_gas) = self.prepareCoordinates(lums,nu_effs,BAND_IDS)
 
+            ## kept between frames of a movie
+            if getattr(self,'raytrace_staging',None) is None:
+                self.raytrace_staging = raytrace_projection.RaytraceStaging()
+
             ## do the actual raytracing
             gas_out,out_u,out_g,out_r = raytrace_ugr_attenuation(
                 star_pos[:,0],star_pos[:,1],star_pos[:,2],
@@ -258,7 +311,16 @@ starStudio.set_ImageParams(
                 QUIET=not self.master_loud,
                 xlim = (self.Xmin, self.Xmax),
                 ylim = (self.Ymin, self.Ymax),
-                zlim = (self.Zmin, self.Zmax)
+                zlim = (self.Zmin, self.Zmax),
+                hybrid = self.hybrid,
+                fast_math = self.fast_math,
+                nthreads = self.nthreads,
+                front_to_back = self.front_to_back,
+                min_transmittance = self.min_transmittance,
+                ## reuse the z order (and sorted copies) from the previous frame
+                staging = self.raytrace_staging,
+                ids = self.raytrace_ids,
+                nslabs = self.nslabs
                 )
 
             ## unit factor, output is in Lsun/kpc^2
@@ -266,6 +328,96 @@ starStudio.set_ImageParams(
             return gas_out*unit_factor, out_u*unit_factor, out_g*unit_factor, out_r*unit_factor
         return compute_mockHubbleImage(self,**kwargs)
 
+    def get_bandCube(
+        self,
+        use_metadata=True,
+        save_meta=True,
+        assert_cached=False,
+        loud=True,
+        BAND_IDS=None,
+        **kwargs, 
+        ):
+        """Projects starlight and approximates attenuatation along line of sight
+            in any number of bands at once, in a single pass through the particles.
+            The cube is cached under the current setup, so any three of its bands
+            can be combined into an image (see `render`'s `composite_bands`) 
+            without raytracing again.
+
+            Input:
+
+                use_metadata = True -- flag to search cache for result
+                save_meta = True -- flag to cache the result
+                assert_cached = False -- flag to require a cache hit
+                loud = True -- whether cache hits/misses should be announced
+                    to the console.
+
+                BAND_IDS = None -- indices of the luminosity bands to project, 
+                    see `get_mockHubbleImage`, defaults to SDSS u, g, and r
+                lums = None -- manual (Nbands,Nstars) input for luminosities
+                nu_effs = None -- manual input for effective frequency of input luminosity band
+
+            Output:
+
+                gas_out -- total mass along LOS in pixel, in unknown units
+                band_cube -- (Nbands,npix_x,npix_y) total attenuated luminosity 
+                    along LOS in pixel in each band, in Lsun/kpc^2"""
+
+        if BAND_IDS is None:
+            BAND_IDS=[1,2,3] ## used if corresponding column of lums is all 0s
+
+        ## cached separately for each combination of bands (and way of compositing)
+        bands_key = '_'.join(['%s'%band_id for band_id in BAND_IDS])+self.getCompositingKey()
+
+        @metadata_cache(
+            self.this_setup_id,  ## hdf5 file group name
+            ['bandCubeMassesMap_%s'%bands_key,
+                'bandCube_%s'%bands_key],
+            use_metadata=use_metadata,
+            save_meta=save_meta,
+            assert_cached=assert_cached,
+            loud=loud,
+            force_from_file=True)  ## read from cache file, not attribute of object
+        def compute_bandCube(self,lums=None,nu_effs=None):
+
+            # apply filters, rotations, unpack snapshot data, etc...
+            (kappas, lums,
+                star_pos, mstar, ages, metals, h_star,
+                gas_pos , mgas , gas_metals ,  h_gas) = self.prepareCoordinates(lums,nu_effs,BAND_IDS)
+
+            ## kept between frames of a movie
+            if getattr(self,'raytrace_staging',None) is None:
+                self.raytrace_staging = raytrace_projection.RaytraceStaging()
+
+            ## raytrace every band in one pass
+            gas_out,band_cube = raytrace_ugr_attenuation(
+                star_pos[:,0],star_pos[:,1],star_pos[:,2],
+                mstar,ages,metals,
+                h_star,
+                gas_pos[:,0],gas_pos[:,1],gas_pos[:,2],
+                mgas,gas_metals,h_gas,
+                kappas,lums,
+                pixels=self.pixels,
+                QUIET=not self.master_loud,
+                xlim = (self.Xmin, self.Xmax),
+                ylim = (self.Ymin, self.Ymax),
+                zlim = (self.Zmin, self.Zmax),
+                hybrid = self.hybrid,
+                fast_math = self.fast_math,
+                nthreads = self.nthreads,
+                front_to_back = self.front_to_back,
+                min_transmittance = self.min_transmittance,
+                ## reuse the z order (and sorted copies) from the previous frame
+                staging = self.raytrace_staging,
+                ids = self.raytrace_ids,
+                band_cube = True,
+                nslabs = self.nslabs
+                )
+
+            ## unit factor, output is in Lsun/kpc^2
+            unit_factor = 1e10/self.Acell
+            return gas_out*unit_factor, band_cube*unit_factor
+        return compute_bandCube(self,**kwargs)
+
 
     def prepareCoordinates(self,
         lums=None,
@@ -284,18 +436,13 @@ starStudio.set_ImageParams(
         if self.master_loud:
             print(np.sum(star_ind_box),'many star particles in volume')
         
-        ## try opening the stellar smoothing lengths, if we fail
-        ##  let's calculate them and save them to the projection 
-        ##  file
-
+        ## use the stellar smoothing lengths if there are any, otherwise 
+        ##  find those of the stars in the frame (and cache them)
         if "SmoothingLength" not in self.star_snapdict:
-            Hsml = self.get_HSML('star')
-            if Hsml.size != star_pos.shape[0]:
-                Hsml = self.get_HSML('star',use_metadata=False,save_meta=True)
+            h_star = self.getHsmlEngine(
+                self.star_snapdict,4,nthreads=self.nthreads).query(star_ind_box)
         else:
-            Hsml = self.star_snapdict['SmoothingLength'] ## kpc
-        ## attempt to pass these indices along
-        h_star = Hsml[star_ind_box].astype(np.float32)
+            h_star = self.star_snapdict['SmoothingLength'][star_ind_box].astype(np.float32) ## kpc
 
         ## and now filter the positions
         star_pos = star_pos[star_ind_box].astype(np.float32)
@@ -307,6 +454,14 @@ starStudio.set_ImageParams(
         ## apply frame mask to band luminosities
         if lums is not None:
             lums = lums[:,star_ind_box]
+        elif nu_effs is None and self.cache_lums and 'ParticleIDs' in self.star_snapdict:
+            ## gather the luminosity/mass in each band from the snapshot's cache
+            lums = self.getCachedLumsPerMass(BAND_IDS,star_ind_box)
+            nu_effs = [colors_table(
+                np.array([1.0]),np.array([1.0]), ## dummy values
+                BAND_ID=BAND_ID,
+                RETURN_NU_EFF=1,
+                QUIET=True) for BAND_ID in BAND_IDS]
 
         ## will fill any columns of lums with appropriate BAND_ID 
         ##  if nu_eff for that column is not None
@@ -326,6 +481,12 @@ starStudio.set_ImageParams(
         if self.master_loud:
             print(np.sum(gas_ind_box),'many gas particles in volume')
 
+        ## ids of the stars then the gas in the frame, their indices in the 
+        ##  snapshot, to match them to the previous frame's z order
+        self.raytrace_ids = np.concatenate([
+            np.flatnonzero(star_ind_box),
+            star_ind_box.size + np.flatnonzero(gas_ind_box)])
+
         ## unpack the gas information
         gas_pos = gas_pos[gas_ind_box].astype(np.float32)
 
@@ -337,7 +498,8 @@ starStudio.set_ImageParams(
         gas_metals[temperatures>1e5] = 0
 
         if "SmoothingLength" not in self.gas_snapdict:
-            h_gas = self.get_HSML('gas')
+            h_gas = self.getHsmlEngine(
+                self.gas_snapdict,0,nthreads=self.nthreads).query(gas_ind_box)
         else:
             h_gas = self.gas_snapdict['SmoothingLength'][gas_ind_box].astype(np.float32)
 
@@ -345,6 +507,31 @@ starStudio.set_ImageParams(
                 star_pos, mstar, ages, metals, h_star,
                 gas_pos , mgas , gas_metals ,  h_gas)
 
+    def getCachedLumsPerMass(self,BAND_IDS,star_ind_box):
+        """ L/M in each band of the stars in the frame, looked up once for every
+            star in the snapshot and cached (by ParticleIDs) in self.lum_cache_dir."""
+
+        star_keys = get_particle_keys(
+            self.star_snapdict['ParticleIDs'],
+            self.star_snapdict['ParticleChildIDsNumber'] 
+            if 'ParticleChildIDsNumber' in self.star_snapdict else None)
+
+        def compute_band_lums_per_mass(band_ids):
+            ## every star in the snapshot, the same way read_band_lums_from_tables would
+            if self.master_loud:
+                print('Caching L/M of',star_keys.size,'stars in bands',band_ids)
+            return raytrace_projection.lookup_band_lums_per_mass(
+                band_ids,
+                self.star_snapdict['AgeGyr'].astype(np.float32),
+                self.star_snapdict['Metallicity'][:,0].astype(np.float32))
+
+        return get_band_lums_per_mass(
+            self.lum_cache_dir,
+            BAND_IDS,
+            star_keys,
+            star_ind_box,
+            compute_band_lums_per_mass)
+
 ####### produceImage implementation #######
     def render(
         self,
@@ -358,6 +545,9 @@ starStudio.set_ImageParams(
                 ax = None -- axis to plot image to, if None will create a new figure
                 quick = False -- flag to use a simple 2d histogram (for comparison or
                     for quick iteration as the user defines the image parameters)
+                composite_bands = None -- indices (into BAND_IDS) of the three bands 
+                    to combine, bluest first, taken from the (cached) `get_bandCube` 
+                    rather than raytracing the three bands on their own
 
             Output:
 
@@ -389,9 +579,14 @@ starStudio.render(plt.gca())
     def __produceImage(
         self,
         quick=False,
+        composite_bands=None,
         **kwargs):
 
-        if not quick:
+        if composite_bands is not None:
+            ## pick the three bands out of the band cube
+            gas_out,band_cube = self.get_bandCube(**kwargs)
+            out_u,out_g,out_r = band_cube[list(composite_bands)]
+        elif not quick:
             gas_out,out_u,out_g,out_r = self.get_mockHubbleImage(**kwargs)
         else:
             gas_out,out_u,out_g,out_r = self.quick_get_mockHubbleImage(**kwargs)
@@ -574,6 +769,7 @@ starStudio.plotParameterGrid(
 
 append_function_docstring(StarStudio,StarStudio.set_ImageParams)
 append_function_docstring(StarStudio,StarStudio.get_mockHubbleImage)
+append_function_docstring(StarStudio,StarStudio.get_bandCube)
 append_function_docstring(StarStudio,StarStudio.render)
 append_function_docstring(StarStudio,StarStudio.predictParameters)
 append_function_docstring(StarStudio,StarStudio.plotParameterGrid)
@@ -592,6 +788,15 @@ def raytrace_ugr_attenuation(
     pixels = 1200,
     xlim = None, ylim = None, zlim = None,
     QUIET=False,
+    hybrid=False,
+    fast_math=False,
+    nthreads=1,
+    front_to_back=False,
+    min_transmittance=1e-4,
+    staging=None,
+    ids=None,
+    band_cube=False,
+    nslabs=None,
     ):
 
     ## setup boundaries to cut-out gas particles that lay outside
@@ -603,6 +808,27 @@ def raytrace_ugr_attenuation(
     if zlim is None:
         zlim = [np.min(z),np.max(z)]
 
+    if nslabs is not None:
+        ## composited far to near, slab by slab
+        if front_to_back:
+            raise ValueError("Can't raytrace front_to_back in slabs (nslabs=%d)"%nslabs)
+
+        return raytrace_projection.stellar_raytrace_streaming(
+            raytrace_projection.iter_stellar_particle_chunks(
+                x,y,z,
+                h_star,lums,
+                gx,gy,gz,
+                h_gas,mgas,gas_metals),
+            kappas,
+            xlim=xlim,ylim=ylim,zlim=zlim,
+            nslabs=nslabs,
+            pixels=pixels,
+            QUIET=QUIET,
+            hybrid=hybrid,
+            fast_math=fast_math,
+            nthreads=nthreads,
+            band_cube=band_cube)
+
     return raytrace_projection.stellar_raytrace(
         x,y,z,
         mstar,ages,metals,
@@ -613,7 +839,15 @@ def raytrace_ugr_attenuation(
         kappas,lums,
         xlim=xlim,ylim=ylim,zlim=zlim,
         pixels=pixels,
-        QUIET=QUIET) 
+        QUIET=QUIET,
+        hybrid=hybrid,
+        fast_math=fast_math,
+        nthreads=nthreads,
+        front_to_back=front_to_back,
+        min_transmittance=min_transmittance,
+        staging=staging,
+        ids=ids,
+        band_cube=band_cube) 
 
 __doc__  = ''
 __doc__ = append_string_docstring(__doc__,StarStudio)
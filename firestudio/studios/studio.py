@@ -1,5 +1,6 @@
 from __future__ import print_function
 import os
+import contextlib
 import numpy as np 
 import h5py
 
@@ -10,6 +11,13 @@ from abg_python.snapshot_utils import openSnapshot
 from abg_python.cosmo_utils import load_AHF
 from abg_python.cosmoExtractor import diskFilterDictionary
 
+from firestudio.utils.snapshot_chunks import iter_snapshot_chunks,get_snapshot_header,get_disk_orientation,iter_extracted_chunks
+from firestudio.utils.kernel_bindings import progress_hook
+from firestudio.utils.gas_utils.projection import estimate_projection_cost
+from firestudio.utils.gas_utils.volume_grid import get_rotation_matrix
+from firestudio.utils.hsml_cache import get_particle_keys
+from firestudio.utils.hsml_engine import HsmlEngine
+
 shared_kwargs = [
     'snapdir=', #--snapdir: place where snapshots live
     'snapstart=', #--snapstart : which snapshot to start the loop at
@@ -45,6 +53,14 @@ shared_kwargs = [
     'multiproc=', #--multiproc : how many processes should be run simultaneously, keep in mind memory constraints
 ]
 
+## camera (and annotation) parameters each renderBatch setup can change
+batch_setup_keys = [
+    'frame_center','frame_half_width','frame_depth', ## where the frame is
+    'theta','phi','psi', ## euler rotation angles
+    'aspect_ratio','pixels', ## shape and resolution of the image
+    'this_setup_id', ## string identifier in the intermediate projection file
+    'figure_label','scale_bar','scale_bar_length'] ## annotation
+
 class Studio(object):
     """ 
     Input:
@@ -74,6 +90,14 @@ class Studio(object):
             defaults to snapdir/../halo/ahf
         extract_galaxy=False - flag to extract the main galaxy using abg_python.cosmoExtractor
         intermediate_file_name=None - the name of the file to save maps to
+        progress_callback=None - called as progress_callback(kernel_name,ndone,ntotal) 
+            by the C kernels while a frame is projected, every progress_interval 
+            particles. A truthy return cancels the frame, raising 
+            kernel_bindings.KernelCancelled (see kernel_bindings.print_progress)
+        progress_interval=10000 - number of particles between calls to progress_callback
+        timeout=None - seconds after which projecting a frame is cancelled, raising 
+            TimeoutError. The neighbor search for missing smoothing lengths can't 
+            be interrupted, the frame is cancelled once it finishes
     """
     def __init__(
         self,
@@ -97,6 +121,9 @@ class Studio(object):
         ahf_path = None, ## path relative to snapdir where the halo files are stored
         extract_galaxy = False, ## uses halo center to extract region around main halo
         intermediate_file_name = None, ##  the name of the file to save maps to
+        progress_callback = None, ## reports the kernels' progress, can cancel them
+        progress_interval = 10000, ## particles between progress reports
+        timeout = None, ## seconds before a projection is cancelled
         **kwargs
         ):
         
@@ -142,12 +169,29 @@ class Studio(object):
         self.ahf_path = ahf_path
         self.extract_galaxy = extract_galaxy
 
+        ## per-render progress and timeout hook
+        self.progress_callback = progress_callback
+        self.progress_interval = progress_interval
+        self.timeout = timeout
+
         ## create, if necessary, directories to store intermediate and output files,
         ##  this could get crowded! sets self.image_dir and self.projection_dir
         self.makeOutputDirectories(datadir)
 
         h5name=h5prefix+intermediate_file_name+"_%03d.hdf5"% snapnum
         self.projection_file = os.path.join(self.projection_dir,h5name)
+        ## open handle while a projection is being written, see projectionFileTransaction
+        self.projection_handle = None
+
+        ## smoothing lengths computed for this snapshot, shared by every setup
+        self.hsml_cache_file = os.path.join(
+            self.projection_dir,h5prefix+"hsml_cache_%03d.hdf5"%snapnum)
+        ##  and the HsmlEngines (and their cache files) of each particle type
+        self.h5prefix = h5prefix
+        self.hsml_engines = {}
+        ## and the stars' luminosities in each band, see StarStudio.cache_lums
+        self.lum_cache_dir = os.path.join(
+            self.projection_dir,h5prefix+"lum_cache_%03d"%snapnum)
 
         ## determine the edges of our frame so we can cull the rest later
         self.computeFrameBoundaries()
@@ -169,25 +213,98 @@ class Studio(object):
 
         gs.update(wspace=0,hspace=-0.1) ## NOTE why doesn't hspace = 0 work???
 
-        ## do the face on view
-        self.scale_bar = 0
-        self.render(
-            axs[0],
-            image_names)
-
-        ## do the edge on view
-        self.figure_label = None
-        self.scale_bar = 1
-
         ## set figure size extended for the edgeon view
         fig.set_size_inches(6,9)
-        self.render(
-            axs[1],
-            image_names,
-            edgeon=True)
+
+        ## do the face on view then the edge on view (rotated by theta = 90),
+        ##  from the same culled particles
+        self.renderBatch(
+            [{'scale_bar':0},
+            {'figure_label':None,
+                'scale_bar':1,
+                'theta':self.theta+90,
+                'aspect_ratio':self.aspect_ratio*0.5}],
+            axs=axs,
+            image_name=image_names)
 
         plt.close(fig)
 
+    def renderBatch(
+        self,
+        setups,
+        axs=None,
+        **kwargs):
+        """ Renders several camera setups of this snapshot. The snapshot is culled once,
+            to the sphere that bounds every setup's frame, and those particles are 
+            staged as float32 arrays that every view then culls, rotates, and projects 
+            from, rather than each view starting from the whole snapshot.
+
+            Input:
+
+                setups -- list of dictionaries of camera (and annotation) parameters, 
+                    any of batch_setup_keys, those left out keep this studio's values
+                axs = None -- axis to render each setup to, None makes a figure for each
+                kwargs -- passed along to render, e.g. image_name
+
+            Output:
+
+                None"""
+
+        setups = [dict(setup) for setup in setups]
+        for setup in setups:
+            unknown_keys = [key for key in setup if key not in batch_setup_keys]
+            if len(unknown_keys):
+                raise ValueError("Setups can only change %s, not %s"%(
+                    batch_setup_keys,unknown_keys))
+
+        if (getattr(self,'chunk_size',None) is not None or 
+            getattr(self,'snapchunks',None) is not None):
+            raise NotImplementedError("Can't share a streamed snapshot between views")
+
+        if axs is None:
+            axs = [None]*len(setups)
+        elif len(axs) != len(setups):
+            raise ValueError("Need an axis for each of the %d setups"%len(setups))
+
+        ## this studio's own parameters, put back at the end
+        own_setup = dict([(key,getattr(self,key)) for key in batch_setup_keys])
+
+        ## sphere that bounds every view's frame, whatever its rotation
+        centers,radii = [],[]
+        for setup in setups:
+            self.setBatchSetup(own_setup,setup)
+            center,radius = self.getFrameBoundingSphere()
+            centers += [center]
+            radii += [radius]
+        centers = np.array(centers)
+        center = 0.5*(np.min(centers,axis=0)+np.max(centers,axis=0))
+        radius = np.max(np.sqrt(np.sum((centers-center)**2,axis=1))+radii)
+
+        if self.snapdict is None:
+            self.openSnapshot(keys_to_extract=self.getSnapshotKeys())
+        snapdict = self.snapdict
+
+        try:
+            self.snapdict = self.stageSnapdict(center,radius)
+            for ax,setup in zip(axs,setups):
+                self.setBatchSetup(own_setup,setup)
+                self.render(ax,**kwargs)
+        finally:
+            self.snapdict = snapdict
+            self.setBatchSetup(own_setup,own_setup)
+
+    def setBatchSetup(self,own_setup,setup):
+        """ Sets the camera (and annotation) parameters in setup, and the rest from
+            own_setup, then recomputes the frame boundaries and setup id."""
+
+        for key in batch_setup_keys:
+            setattr(self,key,setup[key] if key in setup else own_setup[key])
+        self.frame_center = np.array(self.frame_center)
+
+        self.computeFrameBoundaries()
+        if 'this_setup_id' not in setup:
+            self.identifyThisSetup()
+
     def render(
         self,
         ax,
@@ -225,7 +342,15 @@ class Studio(object):
 
         ## project the image using a C routine
         if not this_setup_in_projection_file or self.overwrite:
-            self.projectImage(image_names)
+            with contextlib.ExitStack() as stack:
+                ## only hook the kernels if there's something to report to, so
+                ##  they skip the callbacks (and a hook around render still applies)
+                if self.progress_callback is not None or self.timeout is not None:
+                    stack.enter_context(progress_hook(
+                        self.progress_callback,
+                        self.progress_interval,
+                        self.timeout))
+                self.projectImage(image_names)
 
         ## remap the C output to RGB space
         self.final_image = self.produceImage(image_names)
@@ -289,7 +414,7 @@ class Studio(object):
             ##  and the galaxy won't be rotated or extracted
             snapdict = openSnapshot(
                 self.snapdir,self.snapnum,
-                ptype=0,cosmological=0,
+                ptype=getattr(self,'ptype',0),cosmological=0,
                 keys_to_extract=keys_to_extract)
             if load_stars:
                 star_snapdict = openSnapshot(
@@ -303,7 +428,7 @@ class Studio(object):
         else:
             snapdict = openSnapshot(
                 self.snapdir,self.snapnum,
-                ptype=0,cosmological=1,
+                ptype=getattr(self,'ptype',0),cosmological=1,
                 keys_to_extract=keys_to_extract)
 
             if load_stars:
@@ -335,6 +460,55 @@ class Studio(object):
         if load_stars:
             self.star_snapdict = star_snapdict
 
+    def openSnapshotChunks(
+        self,
+        ptype = 0,
+        keys_to_extract = None,
+        chunk_size = None):
+        """ Lazily reads the snapshot in chunks of (at most) chunk_size particles
+            rather than opening it all at once, see iter_snapshot_chunks. With
+            extract_galaxy, the disk is first oriented on the particles within
+            3*frame_half_width of the halo center (reading their coordinates,
+            masses, and velocities a chunk at a time) and each chunk is then 
+            extracted and rotated, see iter_extracted_chunks."""
+
+        if chunk_size is None:
+            chunk_size = 2**22
+
+        ## converted the same way openSnapshot converts them
+        chunks = iter_snapshot_chunks(
+            self.snapdir,self.snapnum,
+            ptype=ptype,
+            keys_to_extract=keys_to_extract,
+            chunk_size=chunk_size,
+            cosmological=int(bool(self.extract_galaxy)))
+
+        if not self.extract_galaxy:
+            return chunks
+
+        ## orient the disk once per snapshot, it takes a pass through the particles
+        radius = 3*self.frame_half_width
+        orientation_key = (self.snapnum,ptype,radius)
+        if getattr(self,'chunk_orientations',None) is None:
+            self.chunk_orientations = {}
+        if orientation_key not in self.chunk_orientations:
+            scom,rvir,vesc = load_AHF(
+                self.snapdir,self.snapnum,
+                get_snapshot_header(self.snapdir,self.snapnum)['Redshift'],
+                ahf_path=self.ahf_path)
+            vscom,rot_matrix = get_disk_orientation(
+                iter_snapshot_chunks(
+                    self.snapdir,self.snapnum,
+                    ptype=ptype,
+                    keys_to_extract=['Coordinates','Masses','Velocities'],
+                    chunk_size=chunk_size,
+                    cosmological=1),
+                scom,radius)
+            self.chunk_orientations[orientation_key] = (scom,vscom,rot_matrix)
+        scom,vscom,rot_matrix = self.chunk_orientations[orientation_key]
+
+        return iter_extracted_chunks(chunks,scom,vscom,rot_matrix,radius)
+
     def identifyThisSetup(self):
         ## uniquely identify this projection setup
         self.this_setup_id = (
@@ -356,6 +530,9 @@ class Studio(object):
         try:
             with h5py.File(self.projection_file,'r') as handle:
                 for group in handle.keys():
+                    ## produceImage reads the maps of this setup's group
+                    if group != self.this_setup_id:
+                        continue
                     this_group = handle[group]
                     flag = True
                     for key in ['npix_x','frame_half_width','frame_depth',
@@ -382,6 +559,24 @@ class Studio(object):
         except IOError:
             return 0
 
+    @contextlib.contextmanager
+    def projectionFileTransaction(self):
+        """ Holds the projection file open so that every map written within 
+            (by writeImageGrid) goes into it in a single transaction, rather than 
+            reopening the file for each map."""
+
+        ## already inside a transaction
+        if self.projection_handle is not None:
+            yield self.projection_handle
+            return
+
+        with h5py.File(self.projection_file, "a") as h5file:
+            self.projection_handle = h5file
+            try:
+                yield h5file
+            finally:
+                self.projection_handle = None
+
     def writeImageGrid(
         self,
         image,
@@ -392,7 +587,7 @@ class Studio(object):
         ## let the user give it a
         ##	custom name through kwargs later on TODO
 
-        with h5py.File(self.projection_file, "a") as h5file:
+        with self.projectionFileTransaction() as h5file:
             if self.this_setup_id not in list(h5file.keys()):
                 this_group = h5file.create_group(self.this_setup_id)
                 ## save the maps themselves
@@ -470,6 +665,74 @@ class Studio(object):
         self.npix_x   = self.pixels #1200 by default
         self.npix_y   = int(self.pixels*self.aspect_ratio) #1200 by default
 
+    def getFrameBoundingSphere(self):
+        """ Center and radius of the sphere around frame_center that holds the frame
+            (before it's rotated, so whatever the euler angles are)."""
+
+        center = np.array(self.frame_center,dtype=np.float64)
+        radius = np.sqrt(np.sum(np.max(np.abs([
+            np.array([self.Xmin,self.Ymin,self.Zmin])-center,
+            np.array([self.Xmax,self.Ymax,self.Zmax])-center]),axis=0)**2))
+        return center,radius
+
+    def getSnapshotKeys(self):
+        """ keys of the snapshot to open, None opens all of them """
+        return None
+
+    def stageSnapdict(self,center,radius):
+        """ Copies the particles in snapdict within radius of center, with their 
+            floating point arrays cast to float32, to share between the views of
+            a renderBatch."""
+
+        Coordinates = self.snapdict['Coordinates']
+        nparts = Coordinates.shape[0]
+        in_sphere = np.sum((Coordinates-center)**2,axis=1) < radius**2
+
+        staged_snapdict = {}
+        for key,value in self.snapdict.items():
+            ## per-particle arrays, the rest (e.g. BoxSize) is passed along as is
+            if isinstance(value,np.ndarray) and value.ndim and value.shape[0] == nparts:
+                value = value[in_sphere]
+                if value.dtype.kind == 'f':
+                    value = value.astype(np.float32)
+            staged_snapdict[key] = value
+
+        print(np.sum(in_sphere),'of',nparts,'particles staged for the batch')
+        return staged_snapdict
+
+    def getHsmlEngine(self,snapdict,ptype,nthreads=1):
+        """ HsmlEngine over every particle in snapdict (of type ptype), built once 
+            and kept for as long as snapdict is. Its smoothing lengths are cached
+            by ParticleIDs (if snapdict has them) in a per-snapshot file for each
+            ptype next to the projection file, shared by every setup."""
+
+        snapdict_engine = self.hsml_engines.get(ptype)
+        if snapdict_engine is not None and snapdict_engine[0] is snapdict:
+            snapdict_engine[1].nthreads = nthreads
+            return snapdict_engine[1]
+
+        keys = None
+        if 'ParticleIDs' in snapdict:
+            keys = get_particle_keys(
+                snapdict['ParticleIDs'],
+                snapdict['ParticleChildIDsNumber'] 
+                if 'ParticleChildIDsNumber' in snapdict else None)
+
+        if ptype == 0:
+            cache_file = self.hsml_cache_file
+        else:
+            cache_file = os.path.join(
+                self.projection_dir,
+                self.h5prefix+"hsml_cache_ptype%d_%03d.hdf5"%(ptype,self.snapnum))
+
+        engine = HsmlEngine(
+            snapdict['Coordinates'],
+            keys=keys,
+            cache_file=cache_file,
+            nthreads=nthreads)
+        self.hsml_engines[ptype] = (snapdict,engine)
+        return engine
+
     def cullFrameIndices(
         self,
         Coordinates):
@@ -482,29 +745,70 @@ class Studio(object):
 
         return ind_box
 
+    def estimateCost(self):
+        """ Estimates how expensive projecting this frame will be from the smoothing
+            lengths of the particles (of ptype, gas by default) inside it (see 
+            estimate_projection_cost), reading just their coordinates and smoothing
+            lengths a chunk at a time if the snapshot isn't open yet (extracting 
+            the galaxy from each chunk, see openSnapshotChunks). Frames can be sorted by cost['seconds']
+            before they're farmed out to a batch scheduler.
+
+            Output:
+
+                cost -- dictionary with the number of particles, the number of 
+                    kernel pixels, the fraction of sub-pixel particles, and the 
+                    estimated single thread projection time in seconds, and the
+                    number of particles that are read (nparticles_read)"""
+
+        if getattr(self,'snapdict',None) is not None:
+            chunks = [self.snapdict]
+        else:
+            chunks = self.openSnapshotChunks(
+                ptype=getattr(self,'ptype',0),
+                keys_to_extract=['Coordinates','SmoothingLength'],
+                chunk_size=getattr(self,'chunk_size',None))
+
+        hsmls = []
+        nmissing = 0
+        nparticles_read = 0
+        for chunk in chunks:
+            nparticles_read += chunk['Coordinates'].shape[0]
+            ind_box = self.cullFrameIndices(chunk['Coordinates'])
+            if 'SmoothingLength' in chunk:
+                hsmls += [chunk['SmoothingLength'][ind_box]]
+            else:
+                nmissing += np.sum(ind_box)
+
+        if getattr(self,'snapdict',None) is None and self.extract_galaxy:
+            ## openSnapshot reads every particle before it extracts the galaxy
+            nparticles_read = int(get_snapshot_header(
+                self.snapdir,self.snapnum)['NumPart_Total'][getattr(self,'ptype',0)])
+
+        hsml = np.concatenate(hsmls) if len(hsmls) else np.zeros(0)
+        if nmissing:
+            ## no smoothing lengths stored, guess the radius that holds 32 
+            ##  neighbors if the particles were spread evenly through the frame
+            volume = ((self.Xmax-self.Xmin)*(self.Ymax-self.Ymin)*(self.Zmax-self.Zmin))
+            h_guess = (3*32*volume/(4*np.pi*(nmissing+hsml.size)))**(1/3)
+            hsml = np.concatenate([hsml,np.full(nmissing,h_guess)])
+
+        self.cost_estimate = estimate_projection_cost(
+            hsml,
+            self.Xmin,self.Xmax,
+            self.Ymin,self.Ymax,
+            self.npix_x,self.npix_y)
+        self.cost_estimate['nparticles_read'] = nparticles_read
+
+        return self.cost_estimate
+
     def rotateEuler(self,theta,phi,psi,pos):
-        pos-=self.frame_center
         ## if need to rotate at all really -__-
         if theta==0 and phi==0 and psi==0:
             return pos
+        ## rotate about the frame_center, without modifying pos
+        pos = pos - self.frame_center
         # rotate particles by angle derived from frame number
-        pi        = 3.14159265
-        theta_rad = pi*theta/ 1.8e2
-        phi_rad   = pi*phi  / 1.8e2
-        psi_rad   = pi*psi  / 1.8e2
-
-        # construct rotation matrix
-        rot_matrix = np.array([
-            [np.cos(phi_rad)*np.cos(psi_rad), #xx
-                -np.cos(phi_rad)*np.sin(psi_rad), #xy
-                np.sin(phi_rad)], #xz
-            [np.cos(theta_rad)*np.sin(psi_rad) + np.sin(theta_rad)*np.sin(phi_rad)*np.cos(psi_rad),#yx
-                np.cos(theta_rad)*np.cos(psi_rad) - np.sin(theta_rad)*np.sin(phi_rad)*np.sin(psi_rad),#yy
-                -np.sin(theta_rad)*np.cos(phi_rad)],#yz
-            [np.sin(theta_rad)*np.sin(psi_rad) - np.cos(theta_rad)*np.sin(phi_rad)*np.cos(psi_rad),#zx
-                np.sin(theta_rad)*np.cos(psi_rad) - np.cos(theta_rad)*np.sin(phi_rad)*np.sin(psi_rad),#zy
-                np.cos(theta_rad)*np.cos(phi_rad)]#zz
-            ]).astype(np.float32)
+        rot_matrix = get_rotation_matrix(theta,phi,psi)
 
         n_box = pos.shape[0]
 
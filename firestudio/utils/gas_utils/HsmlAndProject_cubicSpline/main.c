@@ -7,9 +7,30 @@
     this routine takes a set of points and does an approximate projection through them, 
         weighting the quantity by the weight. Returns sum(weight) in pixel to OUT0 and 
         sum(weight*quantity) in pixel to OUT1.
+
+    the tile routine accepts several quantities at once (stored one after another, 
+        Nquantities x N_xy), so any number of weighted maps (e.g. second moments, 
+        by passing quantity^2) come out of a single walk over the kernels. 
+        OUT1 then holds Nquantities consecutive Xpixels x Ypixels maps.
       
 */
 
+// bits of the FLAGS argument //
+#define FLAG_SUBPIXEL_CIC 1 // deposit particles smaller than a pixel with cloud-in-cell weights
+#define FLAG_FAST_MATH 2 // evaluate (and scatter) the kernel in loops that vectorize, see below
+
+/* 
+    progress reporting: every PROGRESS_INTERVAL particles the routines call PROGRESS 
+    (if it isn't NULL) with the number of particles done and the total. a nonzero 
+    return cancels the routine, which stops and returns PROGRESS_CANCELLED (its 
+    outputs are then incomplete). nothing is printed.
+*/
+typedef int (*progress_callback)(long ndone, long ntotal);
+#define PROGRESS_CANCELLED -1
+
+/* a routine that can't allocate its work buffers stops and returns OUT_OF_MEMORY */
+#define OUT_OF_MEMORY -2
+
 /* extremely fast approximation function for the exponential, 
     useful here since fractional accuracy errors are smaller than the kernel sources anyways */
 inline double fast_exp(double y) {
@@ -19,149 +40,418 @@ inline double fast_exp(double y) {
     return d;
 }
 
-// changed to better fit python wrapper, not IDL //
-int hsml_project(
+/* 
+    makes sure the stencil buffer can hold at least needed entries, 
+    reallocating it (without preserving contents) if it can't. returns NULL
+    (having freed it) if it can't be reallocated
+*/
+double* grow_stencil(double* STENCIL, long* stencil_size, long needed)
+{
+  if(needed > *stencil_size)
+  {
+    free(STENCIL);
+    *stencil_size = 2*needed;
+    STENCIL = malloc((*stencil_size)*sizeof(double));
+    if(STENCIL == NULL) *stencil_size = 0;
+  }
+  return STENCIL;
+}
+
+/* 
+    the cubic spline kernel at u=r/h (for u<1), evaluated exactly like make_map in 
+    HsmlAndProject.so (findHsmlAndProject) does. its normalization doesn't matter, 
+    each particle's weights are divided by their sum.
+*/
+static inline double cubic_spline_kernel(double u)
+{
+  if(u < 0.5) return 2.546479089470 + 15.278874536822*(u-1)*u*u;
+  return 5.092958178941*(1.0-u)*(1.0-u)*(1.0-u);
+}
+
+/* 
+    FLAG_FAST_MATH: branchless version of cubic_spline_kernel (0 for u>=1), so the loop 
+    over a row of pixels vectorizes. only the rounding (and the order the weights
+    are summed in) differs from the exact path.
+*/
+static inline double cubic_spline_kernel_fast(double u)
+{
+  double v = 1.-u;
+  double wk = (u<0.5) ? (2.546479089470 + 15.278874536822*(u-1.)*u*u) : (5.092958178941*v*v*v);
+  return (u<1.) ? wk : 0.;
+}
+
+/* 
+    lays out a particle's kernel like make_map does: relative to the image's low 
+    corner the particle is at (xr,yr), and its footprint is the (2*NX+1) x (2*NY+1)
+    pixels around the pixel (IC,JC) it's in, whose centers are at (XC+a*dx,YC+b*dy)
+    for a in [-NX,NX] and b in [-NY,NY]. the footprint isn't clipped by the image, 
+    the kernel is normalized over all of it (so the weight that falls off the 
+    image is lost). returns 0 if the kernel can't reach the image.
+*/
+int kernel_footprint(
+    double xr, double yr, double h, // position relative to the image's low corner and kernel radius
+    double dx, double dy, double LengthX, double LengthY, // pixel and image sizes
+    long* IC, long* JC, long* NX, long* NY, double* XC, double* YC) // output footprint
+{
+  if(xr+h < 0 || xr-h > LengthX || yr+h < 0 || yr-h > LengthY) return 0;
+  *NX = (long)(h/dx + 1.0); *NY = (long)(h/dy + 1.0);
+  *IC = (long)floor(xr/dx); *JC = (long)floor(yr/dy);
+  *XC = ((double)(*IC) + 0.5)*dx; *YC = ((double)(*JC) + 0.5)*dy;
+  return 1;
+}
+
+/* 
+    evaluates a particle's kernel on the pixels at offsets [alo,ahi] x [blo,bhi] (inclusive)
+    from the one it's in, see kernel_footprint, in a single walk. stores each pixel's 
+    weight in STENCIL (row-major, 0 outside the kernel) so it can be scattered afterwards
+    without evaluating the kernel a second time. returns the sum of the weights, which
+    over the whole footprint is make_map's normalization, to the last bit.
+*/
+double fill_kernel_stencil(
+    double xr, double yr, // position relative to the image's low corner
+    double h, double h2, // kernel radius and its square
+    double XC, double YC, double dx, double dy, // center of the particle's pixel and pixel size
+    long alo, long ahi, long blo, long bhi, // offsets to evaluate
+    double* STENCIL) // output weights
+{
+  double xx, yy, x2, r2, wk, wt_sum=0.;
+  long a,b,s=0;
+
+  for(a=alo;a<=ahi;a++)
+  {
+   xx = a*dx + XC - xr;
+   x2 = xx*xx;
+   for(b=blo;b<=bhi;b++)
+   {
+     yy = b*dy + YC - yr;
+     r2 = x2 + yy*yy;
+     wk = 0.;
+     if(r2 < h2)
+     {
+      wk = cubic_spline_kernel(sqrt(r2)/h);
+      wt_sum += wk;
+     }
+     STENCIL[s++] = wk;
+   }
+  }
+  return wt_sum;
+}
+
+/* 
+    FLAG_FAST_MATH version of fill_kernel_stencil
+*/
+double fill_kernel_stencil_fast(
+    double xr, double yr, // position relative to the image's low corner
+    double h, // kernel radius
+    double XC, double YC, double dx, double dy, // center of the particle's pixel and pixel size
+    long alo, long ahi, long blo, long bhi, // offsets to evaluate
+    double* restrict STENCIL) // output weights
+{
+  double xx, x2, h_i = 1./h, wt_sum=0.;
+  long a,b,s=0;
+
+  for(a=alo;a<=ahi;a++,s+=bhi-blo+1)
+  {
+   xx = a*dx + XC - xr;
+   x2 = xx*xx;
+   #pragma omp simd reduction(+:wt_sum)
+   for(b=blo;b<=bhi;b++)
+   {
+     double yy = b*dy + YC - yr;
+     double wk = cubic_spline_kernel_fast(sqrt(x2 + yy*yy)*h_i);
+     wt_sum += wk;
+     STENCIL[s+b-blo] = wk;
+   }
+  }
+  return wt_sum;
+}
+
+/* 
+    splits a particle between the (up to) 2 pixel centers bracketing it along one axis, 
+    folding a neighbor that falls off the image back onto the edge pixel so no weight 
+    is lost. returns the number of pixels used.
+*/
+int cic_weights(double i_flt, long npix, long* ii, double* wi)
+{
+  long i0;
+  double f;
+  i_flt -= 0.5; // relative to the pixel centers
+  i0 = (long)floor(i_flt);
+  f = i_flt - i0;
+  if(i0 < 0) {ii[0]=0; wi[0]=1.; return 1;}
+  if(i0 >= npix-1) {ii[0]=npix-1; wi[0]=1.; return 1;}
+  ii[0]=i0; wi[0]=1.-f;
+  ii[1]=i0+1; wi[1]=f;
+  return 2;
+}
+
+/* 
+    projects the particles onto the sub-rectangle [Ilo,Ihi) x [Jlo,Jhi) of the full 
+    Xpixels x Ypixels grid. the deposit is make_map's (findHsmlAndProject's): the same 
+    kernel, smoothing lengths clamped to hmin, footprints and normalization over the 
+    whole (unclipped) footprint, so the maps agree with it to the rounding of the 
+    sums. each particle is normalized over its whole footprint whichever tile it's
+    in, so tiling the image and summing the tiles reproduces the full-image 
+    projection exactly. only pixels inside the tile are written and the output 
+    vectors are NOT zeroed, so disjoint tiles can be filled concurrently.
+
+    the kernel is evaluated once per pixel: the weights are gathered into a stencil 
+    buffer (which also yields the normalization) and then scattered into the tile.
+
+    FLAGS is a combination of:
+      FLAG_SUBPIXEL_CIC: particles smaller than a pixel (which would otherwise be 
+        clamped to hmin) skip the kernel and are split between the 4 nearest pixel 
+        centers with cloud-in-cell weights, conserving their weight exactly.
+      FLAG_FAST_MATH: the kernel is evaluated (and scattered) in loops that vectorize,
+        which only changes the rounding. WT_SUM must have been computed with the 
+        same flag.
+*/
+int hsml_project_tile(
     int N_xy, // number of input particles/positions
-    float* x, float* y, // positions (assumed already sorted in z)
+    float* x, float* y, // positions 
     float* hsml, // smoothing lengths for each
     float* weight, // weight 
-    float* quantity, // quantity
+    int Nquantities, // number of quantities to weight
+    float* quantity, // quantities, Nquantities x N_xy
     float Xmin, float Xmax, float Ymin, float Ymax, // boundaries of output grid
     int Xpixels, int Ypixels, // dimensions of grid
-    float* OUT0, float* OUT1) // output vectors for weightMap and weightWeightedQuantityMap
+    int Ilo, int Ihi, int Jlo, int Jhi, // pixel bounds of this tile
+    double* WT_SUM, // precomputed kernel normalization of each particle, NULL to compute it here
+    float* restrict OUT0, float* restrict OUT1, // output vectors for weightMap and weightWeightedQuantityMaps
+    int FLAGS, // FLAG_SUBPIXEL_CIC | FLAG_FAST_MATH
+    progress_callback PROGRESS, long PROGRESS_INTERVAL) // progress report (or NULL) and how often to call it
 {
-  // print out the input parameters // 
-  printf("N_xy=%d...",N_xy); 
-  printf("Xmin=%f...Xmax=%f...Ymin=%f...Ymax=%f...Xpixels=%d...Ypixels=%d\n",
-    Xmin,Xmax,Ymin,Ymax,Xpixels,Ypixels);
-  printf("quantity=%f...\n",quantity);
-
-  double dx, dy, dx_i, dy_i, dx_n, dy_n, i_x_flt, i_y_flt, d_ij, h, hmin;
-  double h2, x2_n, y2_n, r2_n, h2_i, wk, wt_sum, hkernel_over_hsml_to_use, *Kernel; 
-  double dpi=3.1415926535897932384626433832795;
-  long n,i,j,k,imin,imax,jmin,jmax,N_KERNEL_TABLE;
+  double dx, dy, dx_i, dy_i, LengthX, LengthY, i_x_flt, i_y_flt, xr, yr, XC, YC, h, hmin;
+  double h2, wk, wt_sum; 
+  double *STENCIL=NULL;
+  long n,i,j,k,s,q,a,b,IC,JC,NX,NY,stencil_size=0;
+  long Npixels = ((long)Xpixels)*((long)Ypixels);
+  long atmin,atmax,btmin,btmax,salo,sblo,sny;
+  long ii[2],jj[2]; double wi[2],wj[2]; int ni,nj,ci,cj;
+  int SUBPIXEL_CIC = FLAGS & FLAG_SUBPIXEL_CIC, FAST_MATH = FLAGS & FLAG_FAST_MATH;
+  long next_report = (PROGRESS != NULL && PROGRESS_INTERVAL > 0) ? PROGRESS_INTERVAL : -1;
+  float *out, wq;
   
-  dx = (Xmax - Xmin)/((double)Xpixels);
-  dy = (Ymax - Ymin)/((double)Ypixels);
+  LengthX = Xmax - Xmin; LengthY = Ymax - Ymin;
+  dx = LengthX/((double)Xpixels);
+  dy = LengthY/((double)Ypixels);
   dx_i = 1./dx; dy_i = 1./dy;
-  hmin = 0.5*sqrt(dx*dx+dy*dy); // ensures at least one cell 'sees' the particle // 
-  
-  // pre-define cell positions so we save a step in the loop //
-  double x_i[Xpixels]; for(i=0;i<Xpixels;i++) x_i[i]=Xmin+dx*((double)i+0.5);
-  double y_j[Ypixels]; for(i=0;i<Ypixels;i++) y_j[i]=Ymin+dy*((double)i+0.5);
-  
-  // build a kernel lookup table to save on the calculation below // 
-  hkernel_over_hsml_to_use = 1.0; 
-  //hkernel_over_hsml_to_use = 2.0; 
-  // default = 1 (integrate out to kernel), but low-density regions are represented 
-  //   more accurately if this is larger (~2); code expense increases though!
-  N_KERNEL_TABLE = 1000;
-  Kernel = calloc(N_KERNEL_TABLE+1, sizeof(double)); 
-  dx_n=(hkernel_over_hsml_to_use*hkernel_over_hsml_to_use)/((double)N_KERNEL_TABLE); r2_n=0.;
-  double kernel_spacing_inv = 1./dx_n;
-  for(n=0;n<N_KERNEL_TABLE;n++)
-  {
-   h = sqrt(r2_n); // radius (to save sqrt operation we're interpolating in r^2 //
-   // approximate gaussian for projected, integrate kernel: //
-        //wk = (135./(14.*dpi)) * exp(-(135./14.)*h*h); // quintic spline we're using now   
-        //wk = (135./(14.*dpi)) * exp(-(135./14.)*h*h/(1.+h)); 
-        // this has more extended tails, designed to reduce artifacts in low-density regions
-        //  (where we would really want to use a proper volume-render)
-        // wk = 1.91 * exp(-5.56*h*h); // cubic spline 
-   // cubic spline kernel
-        h2=(1.-h); if(h<=0.5) {wk=(1.-6.*h*h*h2);} else {wk=2.*h2*h2*h2;} wk*=8/dpi; //wk*=40./(7.0*dpi);
-   Kernel[n] = wk;
-   r2_n += dx_n; // radius at this point in the table
-  }
-  Kernel[N_KERNEL_TABLE]=0;
-  
-  // zero out the output vectors before the main sum
-  for(n=0;n<Xpixels*Ypixels;n++)
-  {
-    OUT0[n]=0.0; OUT1[n]=0.0;
-  }
+  hmin = 1.001*(dx < dy ? dx : dy)/2; // ensures at least one cell 'sees' the particle // 
   
   // loop over particles // 
   for(n=0;n<N_xy;n++)
   {
-    i_x_flt = (x[n] - Xmin) * dx_i;
-    i_y_flt = (y[n] - Ymin) * dy_i;
+    // report progress, stopping if asked to //
+    if(n == next_report)
+    {
+      if(PROGRESS(n,N_xy)) {free(STENCIL); return PROGRESS_CANCELLED;}
+      next_report += PROGRESS_INTERVAL;
+    }
+
+    // ABG: particles smaller than a pixel skip the kernel loop entirely //
+    if(SUBPIXEL_CIC && hsml[n] < hmin)
+    {
+      i_x_flt = (x[n] - Xmin) * dx_i;
+      i_y_flt = (y[n] - Ymin) * dy_i;
+      if(i_x_flt < 0 || i_x_flt >= Xpixels || i_y_flt < 0 || i_y_flt >= Ypixels) continue;
+      ni = cic_weights(i_x_flt,Xpixels,ii,wi);
+      nj = cic_weights(i_y_flt,Ypixels,jj,wj);
+      for(ci=0;ci<ni;ci++)
+      {
+        if(ii[ci]<Ilo || ii[ci]>=Ihi) continue;
+        for(cj=0;cj<nj;cj++)
+        {
+          if(jj[cj]<Jlo || jj[cj]>=Jhi) continue;
+          wk = wi[ci]*wj[cj];
+          k = jj[cj] + Ypixels*ii[ci];
+          OUT0[k] += weight[n]*wk;
+          for(q=0;q<Nquantities;q++) OUT1[k+q*Npixels] += weight[n]*wk*quantity[n+q*N_xy];
+        }
+      }
+      continue;
+    }
+
+    xr = x[n] - Xmin; yr = y[n] - Ymin; // (in single precision, like make_map)
     h = hsml[n]; if(h<hmin) h=hmin; // assume 'intrinsic' h is smeared by some fraction of pixel
-    h2=h*h;
-    h2_i = 1./(h*h); // here we need the 'real' h (not the expanded search) // 
-    h *= hkernel_over_hsml_to_use; // make search area larger for kernel //
-    d_ij=h*dx_i; imin=(long)(i_x_flt-d_ij); imax=(long)(i_x_flt+d_ij)+1; if(imin<0) imin=0; if(imax>Xpixels-1) imax=Xpixels-1;
-    d_ij=h*dy_i; jmin=(long)(i_y_flt-d_ij); jmax=(long)(i_y_flt+d_ij)+1; if(jmin<0) jmin=0; if(jmax>Ypixels-1) jmax=Ypixels-1;
+    h2 = h*h;
+    if(!kernel_footprint(xr,yr,h,dx,dy,LengthX,LengthY,&IC,&JC,&NX,&NY,&XC,&YC)) continue;
+
+    // the part of the footprint that falls inside this tile //
+    atmin=-NX; if(atmin<Ilo-IC) atmin=Ilo-IC; atmax=NX; if(atmax>Ihi-1-IC) atmax=Ihi-1-IC;
+    btmin=-NY; if(btmin<Jlo-JC) btmin=Jlo-JC; btmax=NY; if(btmax>Jhi-1-JC) btmax=Jhi-1-JC;
+    if((atmin>atmax) || (btmin>btmax)) continue;
     
-    wt_sum = 0.;
-    // ABG do initial loop to count total weight deposited
-    for(i=imin;i<imax;i++)
+    if(WT_SUM != NULL) 
     {
-     dx_n = x[n]-x_i[i]; 
-     if (fabs(dx_n) < h)
-     {
-     x2_n = dx_n*dx_n;
-     for(j=jmin;j<jmax;j++)
-     {
-       dy_n = y[n]-y_j[j]; 
-       y2_n = dy_n*dy_n;
-       r2_n = x2_n + y2_n; 
-       if (r2_n < h2) 
-       {
-        // use the kernel lookup table compiled above for the weighting //
-        r2_n *= h2_i*kernel_spacing_inv; // ok now have the separation in units of hsml, then kernel_table // 
-        k = (long)r2_n;
-        wk = h2_i * (Kernel[k] + (Kernel[k+1]-Kernel[k])*(r2_n-k)); // ok that's the weighted result
-
-        k = j + Ypixels*i; // j runs 0-Ypixels-1, so this provides the necessary indexing //
-        wt_sum += wk;
-       }
-     }
-     }
+      // only need the weights inside the tile //
+      salo=atmin; sblo=btmin; sny=btmax-btmin+1;
+      STENCIL = grow_stencil(STENCIL,&stencil_size,(atmax-atmin+1)*sny);
+      if(STENCIL == NULL) return OUT_OF_MEMORY;
+      if(FAST_MATH) fill_kernel_stencil_fast(
+        xr,yr,h,XC,YC,dx,dy,
+        atmin,atmax,btmin,btmax,
+        STENCIL);
+      else fill_kernel_stencil(
+        xr,yr,h,h2,XC,YC,dx,dy,
+        atmin,atmax,btmin,btmax,
+        STENCIL);
+      wt_sum = WT_SUM[n];
     }
-    for(i=imin;i<imax;i++)
-        {
-         dx_n = x[n]-x_i[i]; 
-         if (fabs(dx_n) < h)
-         {
-         x2_n = dx_n*dx_n;
-         for(j=jmin;j<jmax;j++)
-         {
-           dy_n = y[n]-y_j[j]; 
-           y2_n = dy_n*dy_n;
-           r2_n = x2_n + y2_n; 
-           if (r2_n < h2) 
-           {
-            // use the kernel lookup table compiled above for the weighting //
-            r2_n *= h2_i*kernel_spacing_inv; // ok now have the separation in units of hsml, then kernel_table // 
-            k = (long)r2_n;
-            wk = h2_i * (Kernel[k] + (Kernel[k+1]-Kernel[k])*(r2_n-k)); // ok that's the weighted result
-
-            // ABG: renormalize by sum of wk
-            wk = wk/wt_sum;
-
-            k = j + Ypixels*i; // j runs 0-Ypixels-1, so this provides the necessary indexing //
-        
-            OUT0[k] += weight[n]*wk;
-            OUT1[k] += weight[n]*wk*quantity[n];
-
-           } // if (r2_n < h2)
-        } // for(j=jmin;j<jmax;j++)
-      } // if (x2_n < h2)
-    } // for(i=imin;i<imax;i++)
-
-    if(!(n%10000))
+    else
     {
-    //printf("%ld..  xy=%g|%g  weight=%g wt(1|2|3)=%g|%g|%g  h=%g  imin/max=%ld|%ld  jmin/max=%ld|%ld  \n",
-        //n,x[n],y[n],Mass[n],quantity[n],wt2[n],wt3[n],h,imin,imax,jmin,jmax); fflush(stdout);
-//    printf("%ld..  xy=%g|%g  weight(1|2|3)=%g|%g|%g  h=%g  imin/max=%ld|%ld  jmin/max=%ld|%ld  wt_sum=%g \n",
-//        n,x[n],y[n],Mass1[n],Mass2[n],Mass3[n],h,imin,imax,jmin,jmax,wt_sum); fflush(stdout);
+      // ABG gather the whole footprint to count total weight deposited
+      salo=-NX; sblo=-NY; sny=2*NY+1;
+      STENCIL = grow_stencil(STENCIL,&stencil_size,(2*NX+1)*sny);
+      if(STENCIL == NULL) return OUT_OF_MEMORY;
+      if(FAST_MATH) wt_sum = fill_kernel_stencil_fast(
+        xr,yr,h,XC,YC,dx,dy,
+        -NX,NX,-NY,NY,
+        STENCIL);
+      else wt_sum = fill_kernel_stencil(
+        xr,yr,h,h2,XC,YC,dx,dy,
+        -NX,NX,-NY,NY,
+        STENCIL);
     }
-    
+    if(wt_sum < 1.0e-10) continue;
+
+    if(FAST_MATH)
+    {
+      // branchless scatter, a whole row of the tile at a time (0 weights add nothing) //
+      wk = weight[n]/wt_sum;
+      for(a=atmin;a<=atmax;a++)
+      {
+        s = (a-salo)*sny - sblo - JC;
+        k = Ypixels*(IC+a);
+        #pragma omp simd
+        for(j=JC+btmin;j<=JC+btmax;j++) OUT0[k+j] += wk*STENCIL[s+j];
+        for(q=0;q<Nquantities;q++)
+        {
+          out = OUT1 + q*Npixels + k;
+          wq = wk*quantity[n+q*N_xy];
+          #pragma omp simd
+          for(j=JC+btmin;j<=JC+btmax;j++) out[j] += wq*STENCIL[s+j];
+        }
+      }
+      continue;
+    }
+
+    // scatter the gathered weights into this tile //
+    for(a=atmin;a<=atmax;a++)
+    {
+      i = IC+a;
+      s = (a-salo)*sny + (btmin-sblo);
+      for(b=btmin;b<=btmax;b++,s++)
+      {
+        if(STENCIL[s] > 0.)
+        {
+          j = JC+b;
+          k = j + Ypixels*i; // j runs 0-Ypixels-1, so this provides the necessary indexing //
+      
+          // ABG: renormalize by sum of wk
+          OUT0[k] += weight[n]*STENCIL[s]/wt_sum;
+          for(q=0;q<Nquantities;q++) OUT1[k+q*Npixels] += weight[n]*quantity[n+q*N_xy]*STENCIL[s]/wt_sum;
+        }
+      } // for(b=btmin;b<=btmax;b++)
+    } // for(a=atmin;a<=atmax;a++)
+
   } // for(n=0;n<N_xy;n++)
   
+  if(PROGRESS != NULL) PROGRESS(N_xy,N_xy);
+  free(STENCIL);
+  return 1;
+} // closes tile routine
+
+/* 
+    computes the sum of each particle's kernel over its whole footprint, the 
+    normalization hsml_project_tile divides by. lets a tiled projection walk 
+    each footprint once for the normalization rather than once per tile.
+*/
+int hsml_project_normalization(
+    int N_xy, // number of input particles/positions
+    float* x, float* y, // positions 
+    float* hsml, // smoothing lengths for each
+    float Xmin, float Xmax, float Ymin, float Ymax, // boundaries of output grid
+    int Xpixels, int Ypixels, // dimensions of grid
+    double* WT_SUM, // output vector of kernel normalizations
+    int FLAGS, // the FLAGS hsml_project_tile will be called with
+    progress_callback PROGRESS, long PROGRESS_INTERVAL) // progress report (or NULL) and how often to call it
+{
+  double dx, dy, LengthX, LengthY, xr, yr, XC, YC, h, hmin, h2; 
+  double *STENCIL=NULL;
+  long n,IC,JC,NX,NY,stencil_size=0;
+  int SUBPIXEL_CIC = FLAGS & FLAG_SUBPIXEL_CIC, FAST_MATH = FLAGS & FLAG_FAST_MATH;
+  long next_report = (PROGRESS != NULL && PROGRESS_INTERVAL > 0) ? PROGRESS_INTERVAL : -1;
   
+  // must match hsml_project_tile exactly //
+  LengthX = Xmax - Xmin; LengthY = Ymax - Ymin;
+  dx = LengthX/((double)Xpixels);
+  dy = LengthY/((double)Ypixels);
+  hmin = 1.001*(dx < dy ? dx : dy)/2;
+
+  for(n=0;n<N_xy;n++)
+  {
+    // report progress, stopping if asked to //
+    if(n == next_report)
+    {
+      if(PROGRESS(n,N_xy)) {free(STENCIL); return PROGRESS_CANCELLED;}
+      next_report += PROGRESS_INTERVAL;
+    }
+
+    WT_SUM[n] = 0.;
+    if(SUBPIXEL_CIC && hsml[n] < hmin) continue; // normalized by construction //
+
+    xr = x[n] - Xmin; yr = y[n] - Ymin;
+    h = hsml[n]; if(h<hmin) h=hmin;
+    h2 = h*h;
+    if(!kernel_footprint(xr,yr,h,dx,dy,LengthX,LengthY,&IC,&JC,&NX,&NY,&XC,&YC)) continue;
+
+    // same walk as hsml_project_tile so the sums agree to the last bit //
+    STENCIL = grow_stencil(STENCIL,&stencil_size,(2*NX+1)*(2*NY+1));
+    if(STENCIL == NULL) return OUT_OF_MEMORY;
+    if(FAST_MATH) WT_SUM[n] = fill_kernel_stencil_fast(
+      xr,yr,h,XC,YC,dx,dy,
+      -NX,NX,-NY,NY,
+      STENCIL);
+    else WT_SUM[n] = fill_kernel_stencil(
+      xr,yr,h,h2,XC,YC,dx,dy,
+      -NX,NX,-NY,NY,
+      STENCIL);
+  } // for(n=0;n<N_xy;n++)
+
+  if(PROGRESS != NULL) PROGRESS(N_xy,N_xy);
+  free(STENCIL);
   return 1;
+} // closes normalization routine
+
+// changed to better fit python wrapper, not IDL //
+int hsml_project(
+    int N_xy, // number of input particles/positions
+    float* x, float* y, // positions (assumed already sorted in z)
+    float* hsml, // smoothing lengths for each
+    float* weight, // weight 
+    float* quantity, // quantity
+    float Xmin, float Xmax, float Ymin, float Ymax, // boundaries of output grid
+    int Xpixels, int Ypixels, // dimensions of grid
+    float* OUT0, float* OUT1) // output vectors for weightMap and weightWeightedQuantityMap
+{
+  long n;
+
+  // zero out the output vectors before the main sum
+  for(n=0;n<Xpixels*Ypixels;n++)
+  {
+    OUT0[n]=0.0; OUT1[n]=0.0;
+  }
+
+  // the whole image is a single tile //
+  return hsml_project_tile(
+    N_xy,x,y,hsml,weight,1,quantity,
+    Xmin,Xmax,Ymin,Ymax,
+    Xpixels,Ypixels,
+    0,Xpixels,0,Ypixels,
+    NULL,
+    OUT0,OUT1,
+    0,
+    NULL,0);
 } // closes main program 
 
 
@@ -0,0 +1,763 @@
+import os
+import time
+import functools
+import warnings
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+
+from firestudio.utils import kernel_bindings
+
+def fcor(x):
+    return np.array(x,dtype='f',ndmin=1)
+
+def find_hsml_and_project(
+    BoxSize,
+    Xmin,Xmax,
+    Ymin,Ymax,
+    Zmin,Zmax,
+    npix_x,npix_y,
+    pos,hsml,mass,quantity,
+    desngb=32,
+    Hmax=None,
+    out=None):
+    """ Calls the (neighbor-finding) findHsmlAndProject routine in HsmlAndProject.so.
+        Any zero-filled hsml array is filled in place with the smoothing lengths
+        computed by the routine's internal neighbor tree. Returns the total mass map
+        and the mass weighted quantity map, filling the pair of (npix_x,npix_y) 
+        float32 arrays in out if they are passed."""
+
+    if Hmax is None:
+        Hmax = 0.5*(Xmax-Xmin)
+
+    return kernel_bindings.find_hsml_and_project(
+        pos,hsml,mass,quantity, ## position, smoothing length, mass, and "quantity" of particles
+        Xmin,Xmax, ## xmin/xmax
+        Ymin,Ymax, ## ymin/ymax
+        Zmin,Zmax, ## zmin/zmax
+        npix_x,npix_y, ## npixels
+        desngb, ## neighbor depth
+        Hmax,BoxSize, ## maximum smoothing length and size of box
+        out=out) ## output cell-mass and cell-mass-weighted-quantity
+
+def find_hsml(
+    BoxSize,
+    Xmin,Xmax,
+    Ymin,Ymax,
+    Zmin,Zmax,
+    pos,
+    desngb=32,
+    Hmax=None):
+    """ Computes the smoothing lengths findHsmlAndProject would compute for
+        these particles by projecting them onto a single pixel."""
+
+    hsml = np.zeros(pos.shape[0],dtype=np.float32)
+    dummy = np.zeros(pos.shape[0],dtype=np.float32)
+    find_hsml_and_project(
+        BoxSize,
+        Xmin,Xmax,
+        Ymin,Ymax,
+        Zmin,Zmax,
+        1,1,
+        pos,hsml,dummy,dummy,
+        desngb=desngb,
+        Hmax=Hmax if Hmax is not None else 0.5*(Xmax-Xmin))
+    return hsml
+
+def get_quantity_map_shape(quantity,npix_x,npix_y,single_quantity):
+    """ shape of the weighted quantity map(s) for the (Nquantities,N) quantity """
+    if single_quantity:
+        return (npix_x,npix_y)
+    return (quantity.shape[0],npix_x,npix_y)
+
+def get_tile_edges(npix,ntiles):
+    """ splits npix pixels into ntiles (nearly) equal, contiguous pieces """
+    ntiles = max(1,min(npix,ntiles))
+    return np.linspace(0,npix,ntiles+1).astype(int)
+
+def get_hmin(dx,dy):
+    """ smallest smoothing length hsml_project (like findHsmlAndProject) deposits
+        with, so that at least one pixel center 'sees' each particle """
+    return 1.001*min(dx,dy)/2
+
+def get_pixel_footprints(
+    x,y,hsml,
+    Xmin,Xmax,
+    Ymin,Ymax,
+    npix_x,npix_y):
+    """ Returns the (conservative) range of pixel indices each particle's kernel
+        can touch, mirroring the footprints laid out in hsml_project. Padded by a 
+        pixel on each side so single vs. double precision rounding can't drop a particle."""
+
+    dx = (Xmax-Xmin)/npix_x
+    dy = (Ymax-Ymin)/npix_y
+    hmin = get_hmin(dx,dy)
+
+    h = np.maximum(hsml,hmin)
+    i_x = np.floor((x-Xmin)/dx)
+    i_y = np.floor((y-Ymin)/dy)
+
+    imin = i_x-np.trunc(h/dx+1)-1
+    imax = i_x+np.trunc(h/dx+1)+2
+    jmin = i_y-np.trunc(h/dy+1)-1
+    jmax = i_y+np.trunc(h/dy+1)+2
+
+    return imin,imax,jmin,jmax
+
+def hsml_project_tiled(
+    x,y,hsml,
+    weight,quantity,
+    Xmin,Xmax,
+    Ymin,Ymax,
+    npix_x,npix_y,
+    nthreads=1,
+    ntiles=None,
+    hybrid=False,
+    fast_math=False,
+    out=None,
+    accumulate=False):
+    """ Thread-parallel version of hsml_project. Splits the image into tiles,
+        hands each tile the (order-preserved) subset of particles whose kernel
+        overlaps it, and projects the tiles concurrently. Each particle's kernel
+        normalization is computed once over its full footprint (in parallel
+        chunks of particles) and shared by every tile it touches, so the output
+        is bitwise identical to the serial (nthreads=1) projection. The deposit
+        is findHsmlAndProject's (the same kernel, minimum smoothing length, and 
+        normalization, so the weight of kernels that reach past the image's 
+        edges is lost), its maps agree with find_hsml_and_project's for the 
+        same smoothing lengths to the rounding of the sums. That routine also 
+        limits the smoothing lengths to its Hmax and drops the particles 
+        outside Zmin-Zmax, which it's up to the caller to do here.
+
+        Input:
+
+            x,y -- projected positions of the particles
+            hsml -- smoothing lengths of the particles
+            weight -- weight of the particles (e.g. mass)
+            quantity -- quantity to weight, or an (Nquantities,N) array of 
+                quantities that are all weighted in the same walk over the kernels
+            Xmin,Xmax,Ymin,Ymax -- boundaries of the image
+            npix_x,npix_y -- shape of the image
+            nthreads = 1 -- number of threads to project tiles with
+            ntiles = None -- number of tiles in each direction, defaults
+                to ~2 tiles per thread in each direction
+            hybrid = False -- deposit particles smaller than a pixel (which would 
+                be clamped to hmin anyway) with cloud-in-cell weights on the 4 
+                nearest pixels, and only send resolved particles through the 
+                kernel loop. conserves the weight of every particle on the image.
+            fast_math = False -- evaluate and scatter the kernel in loops that
+                vectorize, which only changes the rounding of the maps, see 
+                kernel_bindings.FAST_MATH_TOLERANCE
+            out = None -- float32 arrays of the output shapes to fill in place
+            accumulate = False -- add to the maps in out rather than zeroing them,
+                e.g. to project a snapshot in chunks
+
+        Output:
+
+            weightMap -- sum(weight) in each pixel
+            weightedQuantityMap -- sum(weight*quantity) in each pixel, 
+                (Nquantities,npix_x,npix_y) if multiple quantities were passed"""
+
+    ## cast to single precision for the c-routine
+    x,y,hsml = fcor(x),fcor(y),fcor(hsml)
+    weight = fcor(weight)
+    Xmin,Xmax,Ymin,Ymax = float(Xmin),float(Xmax),float(Ymin),float(Ymax)
+
+    ## stack the quantities as Nquantities x N
+    single_quantity = np.ndim(quantity) <= 1
+    quantity = np.array(quantity,dtype='f',ndmin=2,order='C')
+    nquantities = quantity.shape[0]
+
+    ## output arrays, tiles fill disjoint pieces of them
+    weightMap,weightedQuantityMap = kernel_bindings.get_output_buffers(
+        out,[(npix_x,npix_y),get_quantity_map_shape(quantity,npix_x,npix_y,single_quantity)],
+        zero=not accumulate)
+    weightedQuantityMaps = weightedQuantityMap.reshape(nquantities,npix_x,npix_y)
+
+    if ntiles is None:
+        ntiles = 1 if nthreads <= 1 else int(np.ceil(np.sqrt(4*nthreads)))
+
+    iedges = get_tile_edges(npix_x,ntiles)
+    jedges = get_tile_edges(npix_y,ntiles)
+
+    imin,imax,jmin,jmax = get_pixel_footprints(
+        x,y,hsml,
+        Xmin,Xmax,Ymin,Ymax,
+        npix_x,npix_y)
+
+    ## compute each particle's kernel normalization once, in parallel
+    ##  chunks of particles, rather than once per tile it touches
+    wt_sums = np.zeros(x.size,dtype=np.float64)
+    def normalize_chunk(chunk):
+        lo,hi = chunk
+        kernel_bindings.hsml_project_normalization(
+            x[lo:hi],y[lo:hi], ## x-y positions
+            hsml[lo:hi], ## smoothing lengths
+            Xmin,Xmax, ## x limits of the full image
+            Ymin,Ymax, ## y limits of the full image
+            npix_x,npix_y, ## shape of the full image
+            subpixel_cic=hybrid, ## sub-pixel particles don't need a normalization
+            fast_math=fast_math, ## must match the projection
+            out=wt_sums[lo:hi])
+
+    def project_tile(tile):
+        ilo,ihi,jlo,jhi = tile
+
+        ## np.flatnonzero is sorted, so particle order is preserved in each tile
+        indices = np.flatnonzero(
+            (imin < ihi) & (imax > ilo) &
+            (jmin < jhi) & (jmax > jlo))
+
+        if indices.size == 0:
+            return 0
+
+        ## gather this tile's particles
+        if indices.size == x.size:
+            tx,ty,th,tw,tq,tn = x,y,hsml,weight,quantity,wt_sums
+        else:
+            tx,ty,th = x[indices],y[indices],hsml[indices]
+            tw,tn = weight[indices],wt_sums[indices]
+            ## fancy indexing along the second axis can hand back a fortran-ordered array
+            tq = np.ascontiguousarray(quantity[:,indices])
+
+        ## ctypes releases the GIL for the duration of the call
+        kernel_bindings.hsml_project_tile(
+            tx,ty, ## x-y positions
+            th, ## smoothing lengths
+            tw, ## weights
+            tq, ## quantities
+            Xmin,Xmax, ## x limits of the full image
+            Ymin,Ymax, ## y limits of the full image
+            npix_x,npix_y, ## shape of the full image
+            ilo,ihi, ## x pixel range of this tile
+            jlo,jhi, ## y pixel range of this tile
+            tn, ## kernel normalizations
+            subpixel_cic=hybrid, ## cloud-in-cell deposit sub-pixel particles
+            fast_math=fast_math, ## vectorized kernel evaluation
+            out=(weightMap,weightedQuantityMaps),
+            accumulate=True)
+
+        return indices.size
+
+    tiles = [
+        (iedges[ii],iedges[ii+1],jedges[jj],jedges[jj+1])
+        for ii in range(iedges.size-1)
+        for jj in range(jedges.size-1)]
+
+    chunk_edges = get_tile_edges(x.size,nthreads)
+    chunks = list(zip(chunk_edges[:-1],chunk_edges[1:]))
+
+    if nthreads <= 1:
+        for chunk in chunks:
+            normalize_chunk(chunk)
+        for tile in tiles:
+            project_tile(tile)
+    else:
+        with ThreadPoolExecutor(max_workers=nthreads) as executor:
+            list(executor.map(normalize_chunk,chunks))
+            list(executor.map(project_tile,tiles))
+
+    return weightMap,weightedQuantityMap
+
+def get_mip_levels(
+    hsml,
+    Xmin,Xmax,
+    Ymin,Ymax,
+    npix_x,npix_y,
+    mip_tolerance):
+    """ Returns the level of the image pyramid each particle should be deposited on:
+        the coarsest level (pixels 2^level times larger) on which the particle's 
+        smoothing length still spans at least mip_tolerance pixels."""
+
+    dx = np.sqrt((Xmax-Xmin)/npix_x*(Ymax-Ymin)/npix_y)
+    ## coarsest level that still has more than a single pixel
+    max_level = max(0,int(np.floor(np.log2(max(npix_x,npix_y))))-1)
+
+    with np.errstate(divide='ignore'):
+        levels = np.floor(np.log2(hsml/(dx*mip_tolerance)))
+    return np.clip(levels,0,max_level).astype(int)
+
+def upsample_mip_level(coarse,factor,npix_x,npix_y):
+    """ Upsamples a (...,nx,ny) map of coarse pixels factor times larger than the 
+        final pixels, whose first coarse pixel lies one coarse pixel outside the image.
+        Each coarse pixel is spread evenly over the fine pixels it covers and then 
+        smoothed by a (symmetric, normalized) box of width factor along each axis, 
+        which amounts to a linear interpolation between the coarse pixels. The 
+        padding holds the weight of the kernels just past the image's edges, which
+        the smoothing carries partly onto the image as it carries the edge pixels
+        partly off of it."""
+
+    fine = np.repeat(np.repeat(coarse,factor,axis=-2),factor,axis=-1)/factor**2
+    fine = fine.astype(np.float64)
+
+    half = factor//2
+    for axis in (-2,-1):
+        ## box of factor+1 pixels whose end pixels count half, as the average of 
+        ##  (centered) boxes of factor+1 and factor-1 pixels, from cumulative sums
+        fine = np.moveaxis(fine,axis,-1)
+        cumulative = np.zeros(fine.shape[:-1]+(fine.shape[-1]+1,))
+        np.cumsum(fine,axis=-1,out=cumulative[...,1:])
+        npix = fine.shape[-1]
+        center = np.arange(npix)
+        def box(width):
+            lo = np.clip(center-width,0,npix)
+            hi = np.clip(center+width+1,0,npix)
+            return cumulative[...,hi]-cumulative[...,lo]
+        fine = 0.5*(box(half)+box(half-1))/factor
+        fine = np.moveaxis(fine,-1,axis)
+
+    ## drop the padding
+    return fine[...,factor:factor+npix_x,factor:factor+npix_y].astype(np.float32)
+
+def hsml_project_pyramid(
+    x,y,hsml,
+    weight,quantity,
+    Xmin,Xmax,
+    Ymin,Ymax,
+    npix_x,npix_y,
+    mip_tolerance=8,
+    nthreads=1,
+    ntiles=None,
+    hybrid=False,
+    fast_math=False,
+    out=None,
+    accumulate=False):
+    """ Multi-resolution version of hsml_project_tiled. Particles whose kernel would
+        cover many pixels are deposited onto a coarser level of an image pyramid 
+        (pixels 2^level times larger), and each level is linearly upsampled 
+        (conserving its total weight) and summed into the full resolution image. 
+        A particle is deposited on the coarsest level on which its smoothing length 
+        still spans at least mip_tolerance pixels, so the cost of each particle is
+        capped at ~(4*mip_tolerance)^2 pixels. The error comes from interpolating
+        the coarse levels, and shrinks as mip_tolerance grows. Like hsml_project,
+        the weight of kernels that reach past the image's edges is lost.
+
+        Input:
+
+            x,y -- projected positions of the particles
+            hsml -- smoothing lengths of the particles
+            weight -- weight of the particles (e.g. mass)
+            quantity -- quantity to weight, or an (Nquantities,N) array of quantities
+            Xmin,Xmax,Ymin,Ymax -- boundaries of the image
+            npix_x,npix_y -- shape of the image
+            mip_tolerance = 8 -- minimum number of pixels a particle's smoothing 
+                length must span on the level it is deposited on
+            nthreads = 1 -- number of threads to project tiles with
+            ntiles = None -- number of tiles in each direction
+            hybrid = False -- cloud-in-cell deposit sub-pixel particles 
+            fast_math = False -- evaluate the kernel in vectorized loops
+            out = None -- float32 arrays of the output shapes to fill in place
+            accumulate = False -- add to the maps in out rather than zeroing them,
+                e.g. to project a snapshot in chunks
+
+        Output:
+
+            weightMap -- sum(weight) in each pixel
+            weightedQuantityMap -- sum(weight*quantity) in each pixel, 
+                (Nquantities,npix_x,npix_y) if multiple quantities were passed"""
+
+    x,y,hsml = fcor(x),fcor(y),fcor(hsml)
+    weight = fcor(weight)
+    single_quantity = np.ndim(quantity) <= 1
+    quantity = np.array(quantity,dtype='f',ndmin=2,order='C')
+
+    dx = (Xmax-Xmin)/npix_x
+    dy = (Ymax-Ymin)/npix_y
+
+    levels = get_mip_levels(
+        hsml,
+        Xmin,Xmax,
+        Ymin,Ymax,
+        npix_x,npix_y,
+        mip_tolerance)
+
+    weightMap,weightedQuantityMap = kernel_bindings.get_output_buffers(
+        out,[(npix_x,npix_y),get_quantity_map_shape(quantity,npix_x,npix_y,single_quantity)],
+        zero=not accumulate)
+    weightedQuantityMaps = weightedQuantityMap.reshape(quantity.shape[0],npix_x,npix_y)
+
+    for level in np.unique(levels):
+        indices = np.flatnonzero(levels == level)
+        factor = 2**level
+
+        if level == 0:
+            ## full resolution, nothing to resample
+            levelWeightMap,levelWeightedQuantityMap = hsml_project_tiled(
+                x[indices],y[indices],hsml[indices],
+                weight[indices],
+                np.ascontiguousarray(quantity[:,indices]),
+                Xmin,Xmax,
+                Ymin,Ymax,
+                npix_x,npix_y,
+                nthreads=nthreads,
+                ntiles=ntiles,
+                hybrid=hybrid,
+                fast_math=fast_math)
+
+            weightMap += levelWeightMap
+            weightedQuantityMaps += levelWeightedQuantityMap
+        else:
+            ## cover the image with whole coarse pixels, plus one to spare 
+            ##  on each side for the upsampling
+            nx = int(np.ceil(npix_x/factor))+2
+            ny = int(np.ceil(npix_y/factor))+2
+            levelWeightMap,levelWeightedQuantityMap = hsml_project_tiled(
+                x[indices],y[indices],hsml[indices],
+                weight[indices],
+                np.ascontiguousarray(quantity[:,indices]),
+                Xmin-factor*dx,Xmin+(nx-1)*factor*dx,
+                Ymin-factor*dy,Ymin+(ny-1)*factor*dy,
+                nx,ny,
+                nthreads=nthreads,
+                ntiles=ntiles,
+                fast_math=fast_math)
+
+            weightMap += upsample_mip_level(
+                levelWeightMap,factor,npix_x,npix_y)
+            weightedQuantityMaps += upsample_mip_level(
+                levelWeightedQuantityMap,factor,npix_x,npix_y)
+
+    return weightMap,weightedQuantityMap
+
+@functools.lru_cache(maxsize=None)
+def get_kernel_z_cdf(ntable=2001):
+    """ Tabulates the fraction of a 3D cubic spline kernel's weight that lies
+        below height z (relative to the particle, in units of the kernel radius,
+        on a grid from -1 to 1), i.e. the integral of the kernel over x and y."""
+
+    ## the kernel integrated over a plane at height u, 2pi int_u^1 w(q) q dq
+    q = np.linspace(0,1,4*ntable)
+    w = np.where(q <= 0.5,1-6*q**2+6*q**3,2*(1-q)**3)
+    integrand = w*q
+    outer = np.concatenate([[0],np.cumsum(0.5*(integrand[1:]+integrand[:-1])*np.diff(q))])
+    planes = outer[-1]-outer
+
+    ## cumulative distribution in |u|, then mirrored to -1 < u < 1
+    cdf = np.concatenate([[0],np.cumsum(0.5*(planes[1:]+planes[:-1])*np.diff(q))])
+    cdf = 0.5*cdf/cdf[-1]
+    u = np.linspace(-1,1,ntable)
+    return u,0.5+np.sign(u)*np.interp(np.abs(u),q,cdf)
+
+def get_slab_fractions(z,hsml,slab_edges):
+    """ Returns the (nslab,N) fraction of each particle's (kernel smoothed) weight 
+        that lies between each pair of consecutive slab_edges in z."""
+
+    u,cdf = get_kernel_z_cdf()
+    z = np.asarray(z,dtype=np.float64)
+    hsml = np.asarray(hsml,dtype=np.float64)
+
+    ## fraction of the kernel below each edge
+    below = np.array([
+        np.interp((edge-z)/hsml,u,cdf,left=0,right=1) 
+        for edge in slab_edges])
+
+    return np.diff(below,axis=0).astype(np.float32)
+
+def hsml_project_slabs(
+    x,y,z,hsml,
+    weight,quantity,
+    Xmin,Xmax,
+    Ymin,Ymax,
+    npix_x,npix_y,
+    slab_edges,
+    nthreads=1,
+    ntiles=None,
+    hybrid=False,
+    fast_math=False,
+    mip_tolerance=None,
+    histogram=False):
+    """ Projects the particles into a stack of slabs in z in a single walk over 
+        their kernels. Each particle's weight is split between the slabs its 
+        kernel overlaps (by integrating the 3D kernel over each slab), and those
+        fractions ride along as extra quantities of hsml_project_tiled (or 
+        hsml_project_pyramid, with mip_tolerance). With histogram each particle
+        is binned, whole, into the pixel and the slab that contain it.
+
+        Input:
+
+            x,y,z -- positions of the particles
+            hsml -- smoothing lengths of the particles
+            weight -- weight of the particles (e.g. mass)
+            quantity -- quantity to weight, or an (Nquantities,N) array of quantities
+            Xmin,Xmax,Ymin,Ymax -- boundaries of the image
+            npix_x,npix_y -- shape of the image
+            slab_edges -- nslab+1 increasing z boundaries of the slabs
+            nthreads = 1 -- number of threads to project tiles with
+            ntiles = None -- number of tiles in each direction
+            hybrid = False -- cloud-in-cell deposit sub-pixel particles 
+            fast_math = False -- evaluate the kernel in vectorized loops
+            mip_tolerance = None -- deposit large particles on coarser levels of
+                an image pyramid, see hsml_project_pyramid
+            histogram = False -- ignore the smoothing lengths (which can be None),
+                see histogram_project
+
+        Output:
+
+            slabWeightMaps -- (nslab,npix_x,npix_y) sum(weight) in each slab
+            slabWeightedQuantityMaps -- (nslab,npix_x,npix_y) sum(weight*quantity) 
+                in each slab, (Nquantities,nslab,npix_x,npix_y) if multiple 
+                quantities were passed"""
+
+    single_quantity = np.ndim(quantity) <= 1
+    quantity = np.array(quantity,dtype='f',ndmin=2,order='C')
+    nquantities = quantity.shape[0]
+
+    if histogram:
+        ## all of each particle's weight goes into the slab its center is in
+        slab_edges = np.asarray(slab_edges,dtype=np.float64)
+        slab_index = np.searchsorted(slab_edges,z,side='right')-1
+        in_slab = (slab_index >= 0) & (slab_index < slab_edges.size-1)
+        fractions = np.zeros((slab_edges.size-1,np.size(z)),dtype=np.float32)
+        fractions[slab_index[in_slab],np.flatnonzero(in_slab)] = 1
+    else:
+        fractions = get_slab_fractions(z,hsml,slab_edges)
+    nslab = fractions.shape[0]
+
+    ## only particles that overlap a slab
+    in_slabs = np.any(fractions > 0,axis=0)
+    fractions = fractions[:,in_slabs]
+
+    ## rows of fractions (for the weight in each slab), then fractions times 
+    ##  each quantity, so that every map comes out of the same walk
+    slab_quantity = np.concatenate([fractions]+[
+        fractions*quantity[qq,in_slabs] for qq in range(nquantities)])
+
+    if histogram:
+        weightMap,weightedQuantityMaps = histogram_project(
+            fcor(x)[in_slabs],fcor(y)[in_slabs],
+            fcor(weight)[in_slabs],
+            slab_quantity,
+            Xmin,Xmax,
+            Ymin,Ymax,
+            npix_x,npix_y)
+    elif mip_tolerance is None:
+        weightMap,weightedQuantityMaps = hsml_project_tiled(
+            fcor(x)[in_slabs],fcor(y)[in_slabs],fcor(hsml)[in_slabs],
+            fcor(weight)[in_slabs],
+            slab_quantity,
+            Xmin,Xmax,
+            Ymin,Ymax,
+            npix_x,npix_y,
+            nthreads=nthreads,
+            ntiles=ntiles,
+            hybrid=hybrid,
+            fast_math=fast_math)
+    else:
+        weightMap,weightedQuantityMaps = hsml_project_pyramid(
+            fcor(x)[in_slabs],fcor(y)[in_slabs],fcor(hsml)[in_slabs],
+            fcor(weight)[in_slabs],
+            slab_quantity,
+            Xmin,Xmax,
+            Ymin,Ymax,
+            npix_x,npix_y,
+            mip_tolerance=mip_tolerance,
+            nthreads=nthreads,
+            ntiles=ntiles,
+            hybrid=hybrid,
+            fast_math=fast_math)
+
+    slabWeightMaps = weightedQuantityMaps[:nslab]
+    slabWeightedQuantityMaps = weightedQuantityMaps[nslab:].reshape(
+        nquantities,nslab,npix_x,npix_y)
+
+    if single_quantity:
+        slabWeightedQuantityMaps = slabWeightedQuantityMaps[0]
+
+    return slabWeightMaps,slabWeightedQuantityMaps
+
+def histogram_project(
+    x,y,
+    weight,quantity,
+    Xmin,Xmax,
+    Ymin,Ymax,
+    npix_x,npix_y,
+    out=None,
+    accumulate=False):
+    """ Quick-look projection that ignores the smoothing lengths and bins each 
+        particle into the single pixel that contains it (particles outside the 
+        image are dropped). Takes the same quantities and returns the same maps
+        as hsml_project_tiled, in a small fraction of the time."""
+
+    x,y = fcor(x),fcor(y)
+    weight = fcor(weight)
+    single_quantity = np.ndim(quantity) <= 1
+    quantity = np.array(quantity,dtype='f',ndmin=2,order='C')
+    nquantities = quantity.shape[0]
+
+    weightMap,weightedQuantityMap = kernel_bindings.get_output_buffers(
+        out,[(npix_x,npix_y),get_quantity_map_shape(quantity,npix_x,npix_y,single_quantity)],
+        zero=not accumulate)
+    weightedQuantityMaps = weightedQuantityMap.reshape(nquantities,npix_x,npix_y)
+
+    ## flat index of the pixel each particle falls in
+    ii = np.floor((x-Xmin)/(Xmax-Xmin)*npix_x).astype(int)
+    jj = np.floor((y-Ymin)/(Ymax-Ymin)*npix_y).astype(int)
+    in_image = (ii >= 0) & (ii < npix_x) & (jj >= 0) & (jj < npix_y)
+    pixels = ii[in_image]*npix_y + jj[in_image]
+    weight = weight[in_image]
+
+    weightMap += np.bincount(
+        pixels,weights=weight,minlength=npix_x*npix_y).reshape(npix_x,npix_y)
+    for qq in range(nquantities):
+        weightedQuantityMaps[qq] += np.bincount(
+            pixels,weights=weight*quantity[qq,in_image],
+            minlength=npix_x*npix_y).reshape(npix_x,npix_y)
+
+    return weightMap,weightedQuantityMap
+
+## throughput of the kernel loop (pixels in the kernels' bounding boxes per second)
+##  and the overhead of each particle, for a single thread of hsml_project_tile.
+##  these are machine specific (measured on a single core of a ~3 GHz x86 node),
+##  set them yourself or measure them on this machine with calibrate_projection_cost
+KERNEL_PIXELS_PER_SECOND = 1.5e8
+SECONDS_PER_PARTICLE = 2e-7
+
+def calibrate_projection_cost(npix=256,nparticles=100000):
+    """ Times hsml_project_tiled on this machine, once with sub-pixel particles 
+        (mostly per particle overhead) and once with large ones (mostly kernel 
+        pixels), and sets KERNEL_PIXELS_PER_SECOND and SECONDS_PER_PARTICLE
+        (which estimate_projection_cost uses) from them.
+
+        Input:
+
+            npix = 256 -- size of the test images
+            nparticles = 100000 -- number of sub-pixel particles to time, 1% as 
+                many large ones are timed
+
+        Output:
+
+            kernel_pixels_per_second,seconds_per_particle -- the new values"""
+
+    global KERNEL_PIXELS_PER_SECOND,SECONDS_PER_PARTICLE
+
+    rng = np.random.default_rng(0)
+    dx = 2./npix
+    rows = []
+    times = []
+    for this_nparticles,hsml in [(nparticles,0.1*dx),(nparticles//100,8*dx)]:
+        x,y = rng.uniform(-1,1,(2,this_nparticles))
+        hsml = np.full(this_nparticles,hsml)
+        ones = np.ones(this_nparticles)
+
+        ## the first call pays for loading the library and building its tables
+        hsml_project_tiled(x[:10],y[:10],hsml[:10],ones[:10],ones[:10],-1,1,-1,1,npix,npix)
+        init = time.time()
+        hsml_project_tiled(x,y,hsml,ones,ones,-1,1,-1,1,npix,npix)
+        times += [time.time()-init]
+
+        cost = estimate_projection_cost(hsml,-1,1,-1,1,npix,npix)
+        rows += [[cost['kernel_pixels'],this_nparticles]]
+
+    ## seconds = kernel_pixels/KERNEL_PIXELS_PER_SECOND + nparticles*SECONDS_PER_PARTICLE
+    inverse_throughput,seconds_per_particle = np.linalg.solve(rows,times)
+    KERNEL_PIXELS_PER_SECOND = 1./max(inverse_throughput,1e-12)
+    SECONDS_PER_PARTICLE = max(seconds_per_particle,0.)
+
+    return KERNEL_PIXELS_PER_SECOND,SECONDS_PER_PARTICLE
+
+def estimate_projection_cost(
+    hsml,
+    Xmin,Xmax,
+    Ymin,Ymax,
+    npix_x,npix_y):
+    """ Estimates the cost of projecting particles with smoothing lengths hsml
+        onto the image, which is dominated by the number of pixels in their 
+        kernels' footprints, sum((2*NX+1)*(2*NY+1)) with NX = int(h/dx+1) and h
+        clamped to the smallest smoothing length hsml_project uses (get_hmin).
+
+        Input:
+
+            hsml -- smoothing lengths of the particles in (or near) the frame
+            Xmin,Xmax,Ymin,Ymax -- boundaries of the image
+            npix_x,npix_y -- shape of the image
+
+        Output:
+
+            cost -- dictionary with the number of particles, the number of kernel 
+                pixels, the fraction of sub-pixel particles, and the estimated 
+                single thread projection time in seconds"""
+
+    dx = (Xmax-Xmin)/npix_x
+    dy = (Ymax-Ymin)/npix_y
+    hmin = get_hmin(dx,dy)
+
+    hsml = np.asarray(hsml,dtype=np.float64)
+    nparticles = hsml.size
+    h = np.maximum(hsml,hmin)
+    kernel_pixels = float(np.sum(
+        (2*np.floor(h/dx+1)+1)*(2*np.floor(h/dy+1)+1)))
+
+    return {
+        'nparticles':nparticles,
+        'kernel_pixels':kernel_pixels,
+        'subpixel_fraction':float(np.mean(hsml < hmin)) if nparticles else 0.,
+        'seconds':kernel_pixels/KERNEL_PIXELS_PER_SECOND + nparticles*SECONDS_PER_PARTICLE}
+
+def plan_projection(
+    cost,
+    nthreads=None,
+    max_seconds=None,
+    max_particles=None,
+    allow_histogram=False):
+    """ Picks how to project a frame from its estimate_projection_cost.
+
+        Input:
+
+            cost -- dictionary returned by estimate_projection_cost
+            nthreads = None -- most threads to use, None uses every cpu
+            max_seconds = None -- time budget, frames that won't fit it (even
+                with every thread) are warned about
+            max_particles = None -- most particles to read into memory at once, 
+                snapshots with more (cost['nparticles_read'], if it's there) 
+                are streamed in chunks of this many particles
+            allow_histogram = False -- fall back to the quick histogram for frames
+                that won't fit max_seconds, which changes the image
+
+        Output:
+
+            plan -- dictionary with the backend ('serial', 'tiled', 'hybrid', or 
+                'histogram'), nthreads, chunk_size (None to load everything), 
+                and the estimated wall clock time in seconds"""
+
+    if nthreads is None:
+        nthreads = os.cpu_count() or 1
+
+    seconds = cost['seconds']
+    if seconds < 1 or nthreads <= 1:
+        ## not worth spinning up threads
+        nthreads = 1
+    else:
+        seconds /= nthreads
+
+    over_budget = max_seconds is not None and seconds > max_seconds
+    if over_budget and allow_histogram:
+        warnings.warn(
+            "Projection would take ~%.1f s > max_seconds=%.1f s,"%(seconds,max_seconds)+
+            " falling back to the histogram, which ignores the smoothing lengths")
+        backend = 'histogram'
+        nthreads = 1
+        seconds = cost['nparticles']*SECONDS_PER_PARTICLE
+    elif cost['subpixel_fraction'] > 0.5:
+        ## mostly unresolved particles, bin them rather than loop over kernels
+        backend = 'hybrid'
+    elif nthreads > 1:
+        backend = 'tiled'
+    else:
+        backend = 'serial'
+
+    if over_budget and not allow_histogram:
+        warnings.warn(
+            "Projection will take ~%.1f s > max_seconds=%.1f s,"%(seconds,max_seconds)+
+            " pass allow_histogram=True to fall back to the quick histogram")
+
+    ## bound the particles that are read, not just those in the frame
+    chunk_size = None
+    nparticles_read = cost.get('nparticles_read',cost['nparticles'])
+    if max_particles is not None and nparticles_read > max_particles:
+        chunk_size = int(max_particles)
+
+    return {
+        'backend':backend,
+        'nthreads':nthreads,
+        'chunk_size':chunk_size,
+        'seconds':seconds}
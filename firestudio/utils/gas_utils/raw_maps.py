@@ -0,0 +1,139 @@
+""" Composing the raw (additive) maps the gas projections store: the total mass
+    and total mass*quantity in each pixel. Unlike the (log) column density and
+    mass weighted quantity maps made from them, these add linearly, so maps of
+    neighboring slabs, of different particle types, or of neighboring image
+    tiles can be combined without projecting the particles again.
+
+    Raw maps are passed around as (totalMassMap,weightedQuantityMap) pairs, where
+    weightedQuantityMap is (Nmaps,...) with the same trailing shape as totalMassMap."""
+
+import numpy as np
+
+def add_raw_maps(*raw_maps):
+    """ Sums raw maps of the same frame, e.g. of neighboring slabs or of
+        different particle types.
+
+        Input:
+
+            raw_maps -- (totalMassMap,weightedQuantityMap) pairs, all the same shapes
+
+        Output:
+
+            totalMassMap -- summed total mass map
+            weightedQuantityMap -- summed total mass*quantity maps"""
+
+    if not len(raw_maps):
+        raise ValueError("Need at least one pair of raw maps to add")
+
+    totalMassMap = np.array(raw_maps[0][0],dtype=np.float32)
+    weightedQuantityMap = np.array(raw_maps[0][1],dtype=np.float32)
+
+    for this_totalMassMap,this_weightedQuantityMap in raw_maps[1:]:
+        if (np.shape(this_totalMassMap) != totalMassMap.shape or
+            np.shape(this_weightedQuantityMap) != weightedQuantityMap.shape):
+            raise ValueError("Raw maps of shapes %s,%s can't be added to %s,%s"%(
+                np.shape(this_totalMassMap),np.shape(this_weightedQuantityMap),
+                totalMassMap.shape,weightedQuantityMap.shape))
+        totalMassMap += this_totalMassMap
+        weightedQuantityMap += this_weightedQuantityMap
+
+    return totalMassMap,weightedQuantityMap
+
+def collapse_slabs(totalMassSlabsMap,weightedQuantitySlabsMap,first=0,last=None):
+    """ Sums the raw maps of slabs first to last (exclusive) of a slab stack into
+        the raw maps of a single, thicker, slab.
+
+        Input:
+
+            totalMassSlabsMap -- (nslab,npix_x,npix_y) total mass maps
+            weightedQuantitySlabsMap -- (Nmaps,nslab,npix_x,npix_y) total mass*quantity maps
+            first = 0 -- first slab to include
+            last = None -- slab to stop before, None includes the rest of the stack
+
+        Output:
+
+            totalMassMap -- (npix_x,npix_y) total mass map
+            weightedQuantityMap -- (Nmaps,npix_x,npix_y) total mass*quantity maps"""
+
+    return (
+        np.sum(totalMassSlabsMap[first:last],axis=0,dtype=np.float32),
+        np.sum(weightedQuantitySlabsMap[...,first:last,:,:],axis=-3,dtype=np.float32))
+
+def stitch_raw_maps(
+    raw_maps,
+    tile_limits,
+    Xmin,Xmax,
+    Ymin,Ymax,
+    npix_x,npix_y,
+    crop=0):
+    """ Places raw maps of image tiles into the raw maps of a larger frame. The
+        tiles must share the frame's pixel size and be aligned with its pixels,
+        pixels covered by more than one tile are summed (so the cropped tiles should 
+        partition the frame) and parts of tiles outside the frame are dropped.
+
+        The neighbor search only sees the particles in a tile, and the hybrid 
+        cloud-in-cell deposit folds sub-pixel particles that straddle its edge back
+        onto it, so pixels within a kernel's reach of a tile's edge aren't additive.
+        Project each tile padded by crop pixels on every side, with crop at least
+        the largest kernel (in pixels), and those pixels are dropped here.
+
+        Input:
+
+            raw_maps -- (totalMassMap,weightedQuantityMap) pairs, one per tile
+            tile_limits -- (Xmin,Xmax,Ymin,Ymax) of each tile
+            Xmin,Xmax,Ymin,Ymax -- limits of the frame
+            npix_x,npix_y -- number of pixels of the frame
+            crop = 0 -- number of pixels to drop from each edge of every tile, 
+                tile_limits include them
+
+        Output:
+
+            totalMassMap -- (npix_x,npix_y) total mass map
+            weightedQuantityMap -- (Nmaps,npix_x,npix_y) total mass*quantity maps"""
+
+    if len(raw_maps) != len(tile_limits):
+        raise ValueError("Need the limits of each of the %d tiles"%len(raw_maps))
+
+    dx = (Xmax-Xmin)/npix_x
+    dy = (Ymax-Ymin)/npix_y
+
+    totalMassMap = weightedQuantityMap = None
+    for (tile_totalMassMap,tile_weightedQuantityMap),(tXmin,tXmax,tYmin,tYmax) in zip(
+        raw_maps,tile_limits):
+        tile_npix_x,tile_npix_y = np.shape(tile_totalMassMap)
+        tile_weightedQuantityMap = np.reshape(
+            tile_weightedQuantityMap,(-1,tile_npix_x,tile_npix_y))
+        if 2*crop >= min(tile_npix_x,tile_npix_y):
+            raise ValueError("Can't crop %d pixels from a %dx%d tile"%(
+                crop,tile_npix_x,tile_npix_y))
+
+        if weightedQuantityMap is None:
+            totalMassMap = np.zeros((npix_x,npix_y),dtype=np.float32)
+            weightedQuantityMap = np.zeros(
+                (tile_weightedQuantityMap.shape[0],npix_x,npix_y),dtype=np.float32)
+
+        ## pixel offsets of the tile in the frame
+        offsets = []
+        for tile_min,tile_max,tile_npix,frame_min,delta in [
+            (tXmin,tXmax,tile_npix_x,Xmin,dx),
+            (tYmin,tYmax,tile_npix_y,Ymin,dy)]:
+            if not np.isclose((tile_max-tile_min)/tile_npix,delta,rtol=1e-4):
+                raise ValueError("Tile pixels are %.4g across, not %.4g"%(
+                    (tile_max-tile_min)/tile_npix,delta))
+            offset = (tile_min-frame_min)/delta
+            if not np.isclose(offset,np.round(offset),atol=1e-3):
+                raise ValueError("Tile starting at %.4g isn't aligned with the frame's pixels"%tile_min)
+            offsets += [int(np.round(offset))]
+        i0,j0 = offsets
+
+        ## overlap of the (cropped) tile and the frame
+        fi0,fi1 = max(i0+crop,0),min(i0+tile_npix_x-crop,npix_x)
+        fj0,fj1 = max(j0+crop,0),min(j0+tile_npix_y-crop,npix_y)
+        if fi0 >= fi1 or fj0 >= fj1:
+            continue
+
+        totalMassMap[fi0:fi1,fj0:fj1] += tile_totalMassMap[fi0-i0:fi1-i0,fj0-j0:fj1-j0]
+        weightedQuantityMap[:,fi0:fi1,fj0:fj1] += tile_weightedQuantityMap[
+            :,fi0-i0:fi1-i0,fj0-j0:fj1-j0]
+
+    return totalMassMap,weightedQuantityMap
@@ -0,0 +1,205 @@
+""" Deposit-once 3D grid of the gas, for re-projecting the same snapshot under
+    many camera angles. The SPH particles are deposited onto a cube of cells
+    around the frame center once, after which each frame only rotates the
+    (occupied) cells and projects them, at a cost set by the size of the grid
+    rather than by the number of particles."""
+
+import numpy as np
+
+from firestudio.utils.gas_utils import projection
+
+def get_rotation_matrix(theta,phi,psi):
+    """ Euler rotation matrix for angles (in degrees), as used by Studio.rotateEuler """
+
+    pi        = 3.14159265
+    theta_rad = pi*theta/ 1.8e2
+    phi_rad   = pi*phi  / 1.8e2
+    psi_rad   = pi*psi  / 1.8e2
+
+    return np.array([
+        [np.cos(phi_rad)*np.cos(psi_rad), #xx
+            -np.cos(phi_rad)*np.sin(psi_rad), #xy
+            np.sin(phi_rad)], #xz
+        [np.cos(theta_rad)*np.sin(psi_rad) + np.sin(theta_rad)*np.sin(phi_rad)*np.cos(psi_rad),#yx
+            np.cos(theta_rad)*np.cos(psi_rad) - np.sin(theta_rad)*np.sin(phi_rad)*np.sin(psi_rad),#yy
+            -np.sin(theta_rad)*np.cos(phi_rad)],#yz
+        [np.sin(theta_rad)*np.sin(psi_rad) - np.cos(theta_rad)*np.sin(phi_rad)*np.cos(psi_rad),#zx
+            np.sin(theta_rad)*np.cos(psi_rad) - np.cos(theta_rad)*np.sin(phi_rad)*np.sin(psi_rad),#zy
+            np.cos(theta_rad)*np.cos(phi_rad)]#zz
+        ]).astype(np.float32)
+
+class VolumeGrid(object):
+    """
+    Input:
+        pos - (N,3) positions of the particles
+        hsml - smoothing lengths of the particles
+        mass - masses of the particles
+        quantity - quantity to mass weight, or an (Nquantities,N) array of quantities
+        center - center of the grid
+        half_width - half-width of the (cubic) grid
+
+    Optional:
+        ngrid=128 - number of cells along each side of the grid
+        zblock=8 - number of z layers deposited together, particles are only
+            walked over for the blocks of layers their kernel overlaps
+        nthreads=1 - number of threads to deposit (and project) with
+        second_moments=False - deposit quantity^2 too, so that project also
+            returns the sum(mass*quantity^2) maps
+    """
+
+    def __init__(
+        self,
+        pos,hsml,mass,quantity,
+        center,
+        half_width,
+        ngrid=128,
+        zblock=8,
+        nthreads=1,
+        second_moments=False):
+
+        self.center = np.array(center,dtype=np.float64)
+        self.half_width = half_width
+        self.ngrid = ngrid
+        self.cell_size = 2.*half_width/ngrid
+        self.nthreads = nthreads
+
+        self.second_moments = second_moments
+        self.single_quantity = np.ndim(quantity) <= 1 and not second_moments
+        quantity = np.array(quantity,dtype=np.float32,ndmin=2)
+        self.nquantities = quantity.shape[0]
+        if second_moments:
+            ## deposit sum(mass*quantity^2) alongside sum(mass*quantity)
+            quantity = np.concatenate([quantity,quantity**2])
+        ## number of sum(mass*quantity) (then sum(mass*quantity^2)) grids
+        self.nmaps = quantity.shape[0]
+
+        pos = np.asarray(pos,dtype=np.float32)
+        hsml = np.asarray(hsml,dtype=np.float32)
+        mass = np.asarray(mass,dtype=np.float32)
+
+        ## cell edges
+        xmin,ymin,zmin = self.center-half_width
+        xmax,ymax,zmax = self.center+half_width
+        zedges = np.linspace(zmin,zmax,ngrid+1)
+
+        massGrid = np.zeros((ngrid,ngrid,ngrid),dtype=np.float32)
+        weightedQuantityGrid = np.zeros((self.nmaps,ngrid,ngrid,ngrid),dtype=np.float32)
+
+        ## deposit blocks of z layers at a time as slabs of a single projection,
+        ##  each particle's mass is split between the layers its kernel overlaps
+        for k0 in range(0,ngrid,zblock):
+            k1 = min(k0+zblock,ngrid)
+            in_block = ((pos[:,2]+hsml > zedges[k0]) & (pos[:,2]-hsml < zedges[k1]))
+            if not np.any(in_block):
+                continue
+
+            slabMassMaps,slabWeightedQuantityMaps = projection.hsml_project_slabs(
+                pos[in_block,0],pos[in_block,1],pos[in_block,2],
+                hsml[in_block],
+                mass[in_block],
+                quantity[:,in_block],
+                xmin,xmax,
+                ymin,ymax,
+                ngrid,ngrid,
+                zedges[k0:k1+1],
+                nthreads=nthreads)
+
+            ## slab maps are (z,x,y), the grid is (x,y,z)
+            massGrid[:,:,k0:k1] = np.moveaxis(slabMassMaps,0,-1)
+            weightedQuantityGrid[:,:,:,k0:k1] = np.moveaxis(slabWeightedQuantityMaps,1,-1)
+
+        ## keep only the occupied cells, at their centers
+        occupied = np.nonzero(massGrid > 0)
+        centers = (np.arange(ngrid)+0.5)*self.cell_size
+        self.cell_pos = np.array([
+            xmin+centers[occupied[0]],
+            ymin+centers[occupied[1]],
+            zmin+centers[occupied[2]]],dtype=np.float32).T.copy()
+        self.cell_mass = massGrid[occupied]
+        ## mass weighted quantity of each cell
+        self.cell_quantity = np.array([
+            weightedQuantityGrid[qq][occupied]/self.cell_mass
+            for qq in range(self.nmaps)],dtype=np.float32)
+
+    def containsFrame(
+        self,
+        frame_center,
+        theta,phi,psi,
+        Xmin,Xmax,
+        Ymin,Ymax,
+        Zmin,Zmax):
+        """ Whether every corner of the rotated frame is inside the grid, i.e.
+            whether project can see all the gas the particles would have shown."""
+
+        frame_center = np.array(frame_center,dtype=np.float64)
+        corners = np.array([
+            [x,y,z] for x in (Xmin,Xmax) for y in (Ymin,Ymax) for z in (Zmin,Zmax)])
+
+        ## project rotates the cells into the frame, rotate the frame back instead
+        corners = np.matmul(
+            corners-frame_center,
+            get_rotation_matrix(theta,phi,psi).astype(np.float64))+frame_center
+
+        ## allow for the float32 rotation matrix
+        tolerance = 1e-5*self.half_width
+        return np.all(np.abs(corners-self.center) <= self.half_width+tolerance)
+
+    def project(
+        self,
+        frame_center,
+        theta,phi,psi,
+        Xmin,Xmax,
+        Ymin,Ymax,
+        Zmin,Zmax,
+        npix_x,npix_y,
+        out=None,
+        **kwargs):
+        """ Rotates the occupied cells about frame_center (like Studio.rotateEuler),
+            keeps those inside the frame, and projects them as particles the size of
+            a cell with hsml_project_tiled. Extra kwargs (hybrid, fast_math, ...)
+            are passed along to it.
+
+            Output:
+
+                totalMassMap -- sum(mass) in each pixel
+                weightedQuantityMap -- sum(mass*quantity) in each pixel,
+                    (Nmaps,npix_x,npix_y) if multiple quantities (or second 
+                    moments, the sum(mass*quantity^2) maps follow) were deposited"""
+
+        if not self.containsFrame(
+            frame_center,
+            theta,phi,psi,
+            Xmin,Xmax,
+            Ymin,Ymax,
+            Zmin,Zmax):
+            raise ValueError(
+                "The rotated frame reaches outside the volume_grid"+
+                " (half-width %.3g around %s), deposit a larger one"%(
+                self.half_width,self.center))
+
+        frame_center = np.array(frame_center,dtype=np.float32)
+        pos = np.matmul(
+            self.cell_pos-frame_center,
+            get_rotation_matrix(theta,phi,psi).T)+frame_center
+
+        ## a cell's kernel reaches to the centers of its neighbors, so
+        ##  neighboring cells blend smoothly into one another
+        hsml = np.sqrt(3)*self.cell_size
+        ind_box = ((pos[:,0] > Xmin-hsml) & (pos[:,0] < Xmax+hsml) &
+                   (pos[:,1] > Ymin-hsml) & (pos[:,1] < Ymax+hsml) &
+                   (pos[:,2] > Zmin) & (pos[:,2] < Zmax))
+
+        quantity = self.cell_quantity[:,ind_box]
+        if self.single_quantity:
+            quantity = quantity[0]
+
+        kwargs.setdefault('nthreads',self.nthreads)
+        return projection.hsml_project_tiled(
+            pos[ind_box,0],pos[ind_box,1],
+            np.full(np.sum(ind_box),hsml,dtype=np.float32),
+            self.cell_mass[ind_box],quantity,
+            Xmin,Xmax,
+            Ymin,Ymax,
+            npix_x,npix_y,
+            out=out,
+            **kwargs)
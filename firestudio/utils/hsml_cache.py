@@ -0,0 +1,100 @@
+""" Per-snapshot cache of the smoothing lengths the projection routines compute
+    with their neighbor search, keyed by particle ID, so that later frames
+    (angles, zooms, ...) of the same snapshot can skip the search entirely. Only 
+    smoothing lengths that don't depend on the frame they were searched in should
+    be cached, see GasStudio.findFrameHsml."""
+
+import os
+import numpy as np
+import h5py
+
+def get_particle_keys(ParticleIDs,ParticleChildIDsNumber=None):
+    """ Unique integer key of each particle, combining the particle ID with
+        its child ID (for particles that were split) if there is one."""
+
+    keys = np.asarray(ParticleIDs).astype(np.uint64)
+    if ParticleChildIDsNumber is not None:
+        keys = (keys << np.uint64(32)) + np.asarray(ParticleChildIDsNumber).astype(np.uint64)
+    return keys
+
+def load_cached_hsml(fname,keys):
+    """ Looks up the cached smoothing length of each particle key.
+
+        Input:
+
+            fname -- path to the cache file
+            keys -- particle keys, see get_particle_keys
+
+        Output:
+
+            hsml -- float32 smoothing lengths, 0 for particles that aren't cached"""
+
+    hsml = np.zeros(np.size(keys),dtype=np.float32)
+    if not os.path.isfile(fname):
+        return hsml
+
+    with h5py.File(fname,'r') as handle:
+        cached_keys = handle['keys'][()]
+        cached_hsml = handle['SmoothingLength'][()]
+
+    ## cached keys are stored sorted
+    return match_hsml(keys,cached_keys,cached_hsml,out=hsml)
+
+def match_hsml(keys,sorted_keys,sorted_hsml,out=None):
+    """ Looks up the smoothing length of each particle key in a table of them
+        sorted by key (e.g. the cache's, or those of the previous snapshot).
+
+        Input:
+
+            keys -- particle keys, see get_particle_keys
+            sorted_keys -- sorted particle keys of the table
+            sorted_hsml -- smoothing lengths of the table
+            out = None -- float32 array to fill
+
+        Output:
+
+            hsml -- float32 smoothing lengths, 0 for particles that aren't in the table"""
+
+    keys = np.asarray(keys).astype(np.uint64)
+    if out is None:
+        out = np.zeros(keys.size,dtype=np.float32)
+
+    if np.size(sorted_keys):
+        index = np.clip(np.searchsorted(sorted_keys,keys),0,np.size(sorted_keys)-1)
+        found = sorted_keys[index] == keys
+        out[found] = sorted_hsml[index[found]]
+
+    return out
+
+def save_cached_hsml(fname,keys,hsml):
+    """ Adds the (nonzero) smoothing lengths of these particles to the cache file,
+        replacing any values already cached for them. Keys that appear more than
+        once are ambiguous and are left out. The new file is written next to the
+        old one and swapped in, so readers never see a partially written file
+        (concurrent writers can drop each other's new values, which are then 
+        just searched for again)."""
+
+    keys = np.asarray(keys).astype(np.uint64)
+    hsml = np.asarray(hsml,dtype=np.float32)
+
+    ## drop uncomputed and duplicated particles
+    unique_keys,index,counts = np.unique(keys,return_index=True,return_counts=True)
+    index = index[counts == 1]
+    index = index[hsml[index] > 0]
+    keys,hsml = keys[index],hsml[index]
+
+    if os.path.isfile(fname):
+        with h5py.File(fname,'r') as handle:
+            cached_keys = handle['keys'][()]
+            cached_hsml = handle['SmoothingLength'][()]
+        ## new values take precedence
+        keep = ~np.isin(cached_keys,keys)
+        keys = np.concatenate([cached_keys[keep],keys])
+        hsml = np.concatenate([cached_hsml[keep],hsml])
+
+    order = np.argsort(keys)
+    tmp_fname = fname[:-len('.hdf5')]+'.tmp%d.hdf5'%os.getpid()
+    with h5py.File(tmp_fname,'w') as handle:
+        handle['keys'] = keys[order]
+        handle['SmoothingLength'] = hsml[order]
+    os.replace(tmp_fname,fname)
@@ -0,0 +1,114 @@
+""" Smoothing lengths of particles that don't have them (stars, dark matter, ...),
+    the distance to each particle's desngb-th nearest neighbor like the
+    starhsml.so neighbor search. The neighbor tree is built once over every
+    particle of the type and only the particles of each frame are queried (in
+    parallel), their neighbors outside the frame included. Results are kept,
+    and cached by particle ID, so later frames of the snapshot only compute
+    the particles they haven't seen."""
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from firestudio.utils.hsml_cache import load_cached_hsml,save_cached_hsml
+
+class HsmlEngine(object):
+    """
+    Input:
+        pos - (N,3) positions of every particle of the type
+
+    Optional:
+        keys=None - particle keys (see hsml_cache.get_particle_keys) to cache the
+            smoothing lengths under in cache_file
+        cache_file=None - hsml cache file (see hsml_cache) to read smoothing lengths
+            from and save the ones computed to
+        desngb=32 - number of neighbors, counting the particle itself
+        Hmax=None - largest smoothing length, None doesn't limit them (starhsml.so
+            only limits particles with fewer than desngb neighbors in a cube of 
+            its Hmax, others can grow past it)
+        nthreads=1 - number of threads to query the tree with
+        leafsize=16 - number of particles in a leaf of the tree
+    """
+
+    def __init__(
+        self,
+        pos,
+        keys=None,
+        cache_file=None,
+        desngb=32,
+        Hmax=None,
+        nthreads=1,
+        leafsize=16):
+
+        self.pos = np.asarray(pos,dtype=np.float32)
+        self.keys = keys
+        self.cache_file = cache_file if keys is not None else None
+        self.desngb = min(desngb,self.pos.shape[0])
+        self.Hmax = Hmax
+        self.nthreads = nthreads
+        self.leafsize = leafsize
+
+        ## built the first time a particle isn't cached
+        self.tree = None
+
+        ## 0 for particles that haven't been computed yet
+        if self.cache_file is not None:
+            self.hsml = load_cached_hsml(self.cache_file,self.keys)
+        else:
+            self.hsml = np.zeros(self.pos.shape[0],dtype=np.float32)
+
+    def buildTree(self):
+        if self.tree is None:
+            ## unbalanced trees build much faster and query about as fast
+            self.tree = cKDTree(
+                self.pos,
+                leafsize=self.leafsize,
+                balanced_tree=False,
+                compact_nodes=False)
+            ## where each particle is in the order of the tree's leaves
+            self.leaf_rank = np.empty(self.pos.shape[0],dtype=np.intp)
+            self.leaf_rank[self.tree.indices] = np.arange(self.pos.shape[0])
+        return self.tree
+
+    def query(self,indices=None):
+        """ Smoothing lengths of the particles in indices (a boolean mask or
+            indices, None for all of them), computing those that aren't known yet.
+
+            Input:
+
+                indices = None -- particles to return the smoothing lengths of
+
+            Output:
+
+                hsml -- float32 smoothing lengths of the particles"""
+
+        if indices is None:
+            indices = slice(None)
+
+        hsml = np.array(self.hsml[indices])
+        missing = hsml <= 0
+        if np.any(missing):
+            missing_indices = np.arange(self.hsml.size)[indices][missing]
+            tree = self.buildTree()
+
+            ## query them in the order of the tree's leaves, so consecutive queries
+            ##  walk the same nodes (about 30% faster than in the snapshot's order)
+            leaf_order = np.argsort(self.leaf_rank[missing_indices])
+            missing = np.flatnonzero(missing)[leaf_order]
+            missing_indices = missing_indices[leaf_order]
+
+            ## distance to the desngb-th nearest neighbor, the particle is its own first
+            distances,neighbors = tree.query(
+                self.pos[missing_indices],
+                k=[self.desngb],
+                workers=self.nthreads)
+            computed = distances[:,0].astype(np.float32)
+            if self.Hmax is not None:
+                computed = np.minimum(computed,self.Hmax)
+
+            self.hsml[missing_indices] = computed
+            hsml[missing] = computed
+
+            if self.cache_file is not None:
+                save_cached_hsml(self.cache_file,self.keys[missing_indices],computed)
+
+        return hsml
@@ -0,0 +1,812 @@
+""" Typed ctypes bindings for the C kernels FIRE_studio ships.
+
+    Each shared library is loaded once (per process) and each entry point has
+    its argtypes/restype declared, so numpy arrays are passed zero-copy and
+    mismatched dtypes/layouts raise a ctypes.ArgumentError instead of being
+    silently reinterpreted by the C code.
+
+    Every wrapper takes an out= argument: a (tuple of) float32 array(s) of the
+    output shape that is zeroed and filled in place rather than allocating new
+    maps, so a movie loop can reuse the same buffers for every frame.
+
+    The projection kernels take a FLAGS bitmask (see get_kernel_flags):
+    subpixel_cic deposits particles smaller than a pixel with cloud-in-cell
+    weights, and fast_math evaluates the kernel (analytically rather than from
+    the ray-tracer's lookup table, and its attenuation with a polynomial exp) 
+    in loops the compiler vectorizes, at the cost of differences up to 
+    FAST_MATH_TOLERANCE. The 
+    ray-tracer also takes front_to_back, which composites the nearest particles
+    first and stops at pixels that have become opaque (see MIN_TRANSMITTANCE).
+
+    The kernels print nothing. Instead they report their progress through a
+    callback every so many particles, and stop when it asks them to, see
+    progress_hook (findHsmlAndProject, which only ships compiled, can't be
+    stopped while it runs, it only reports once it's done)."""
+
+import os
+import time
+import ctypes
+import threading
+import functools
+import contextlib
+import numpy as np
+
+## paths of the shared libraries, relative to firestudio/utils
+LIBRARY_PATHS = {
+    'HsmlAndProject':('gas_utils','HsmlAndProject_cubicSpline','HsmlAndProject.so'),
+    'hsml_project':('gas_utils','HsmlAndProject_cubicSpline','hsml_project.so'),
+    'raytrace_rgb':('stellar_utils','c_libraries','RayTrace_RGB','raytrace_rgb.so'),
+    'starhsml':('stellar_utils','c_libraries','StellarHsml','starhsml.so')}
+
+## numpy buffer types, inputs need only be contiguous, outputs also writeable
+c_int = ctypes.c_int
+c_long = ctypes.c_long
+c_float = ctypes.c_float
+c_double = ctypes.c_double
+float_array = np.ctypeslib.ndpointer(dtype=np.float32,flags='C_CONTIGUOUS')
+float_buffer = np.ctypeslib.ndpointer(dtype=np.float32,flags=('C_CONTIGUOUS','WRITEABLE'))
+double_buffer = np.ctypeslib.ndpointer(dtype=np.float64,flags=('C_CONTIGUOUS','WRITEABLE'))
+int_array = np.ctypeslib.ndpointer(dtype=np.int32,flags='C_CONTIGUOUS')
+
+def optional(pointer_type):
+    """ a version of the numpy buffer type pointer_type that also takes None (NULL) """
+    class OptionalPointer(pointer_type):
+        @classmethod
+        def from_param(cls,obj):
+            if obj is None:
+                return None
+            return pointer_type.from_param(obj)
+    return OptionalPointer
+
+## int (*progress_callback)(long ndone, long ntotal), a nonzero return cancels the kernel
+##  which then returns PROGRESS_CANCELLED, as #defined in their main.c
+PROGRESS_CALLBACK = ctypes.CFUNCTYPE(c_int,c_long,c_long)
+PROGRESS_CANCELLED = -1
+## returned by the projection kernels that couldn't allocate their work buffers
+OUT_OF_MEMORY = -2
+
+## bits of the FLAGS argument of the projection kernels, as #defined in their main.c
+FLAG_SUBPIXEL_CIC = 1
+FLAG_FAST_MATH = 2
+FLAG_FRONT_TO_BACK = 4 ## ray-tracer only
+
+## default transmittance below which the front_to_back ray-trace treats a pixel
+##  as opaque and stops depositing into it, the light that's dropped is less 
+##  than this times the light behind that point
+MIN_TRANSMITTANCE = 1e-4
+
+## largest difference between the fast_math and exact maps, relative to the
+##  peak of the map. the projection evaluates the same kernel on both paths, 
+##  so only the rounding changes. in the ray-tracer the analytic kernel differs
+##  from the exact path's lookup table by < 3e-5 of its peak (the polynomial 
+##  exp by < 1e-8). that holds for kernels inside the image that cover a pixel
+##  or more (sub-pixel particles deposited with subpixel_cic are the same on 
+##  both paths). particles smaller than a pixel without subpixel_cic, and 
+##  kernels clipped by the edge of the image, are renormalized onto the table's
+##  coarse tail and can differ by ~1e-4 or more, check them with 
+##  get_fast_math_error.
+FAST_MATH_TOLERANCE = 3e-5
+
+## (library, function) -> argtypes, every entry point returns an int
+SIGNATURES = {
+    ('HsmlAndProject','findHsmlAndProject'):[
+        c_int, ## number of particles
+        float_array,float_buffer, ## positions, smoothing lengths (filled in if 0)
+        float_array,float_array, ## masses, quantity
+        c_float,c_float, ## xmin/xmax
+        c_float,c_float, ## ymin/ymax
+        c_float,c_float, ## zmin/zmax
+        c_int,c_int, ## npixels
+        c_int, ## neighbor depth
+        c_int,c_int,c_int, ## axes
+        c_float,c_double, ## maximum smoothing length and size of box
+        float_buffer,float_buffer], ## mass map, mass weighted quantity map
+    ('hsml_project','hsml_project'):[
+        c_int, ## number of particles
+        float_array,float_array, ## x-y positions
+        float_array, ## smoothing lengths
+        float_array,float_array, ## weights, quantity
+        c_float,c_float,c_float,c_float, ## image limits
+        c_int,c_int, ## image shape
+        float_buffer,float_buffer], ## weight map, weighted quantity map
+    ('hsml_project','hsml_project_tile'):[
+        c_int, ## number of particles
+        float_array,float_array, ## x-y positions
+        float_array, ## smoothing lengths
+        float_array, ## weights
+        c_int,float_array, ## number of quantities, Nquantities x N quantities
+        c_float,c_float,c_float,c_float, ## limits of the full image
+        c_int,c_int, ## shape of the full image
+        c_int,c_int,c_int,c_int, ## pixel bounds of the tile
+        double_buffer, ## kernel normalizations
+        float_buffer,float_buffer, ## weight map, weighted quantity maps
+        c_int, ## FLAGS
+        PROGRESS_CALLBACK,c_long], ## progress callback and interval
+    ('hsml_project','hsml_project_normalization'):[
+        c_int, ## number of particles
+        float_array,float_array, ## x-y positions
+        float_array, ## smoothing lengths
+        c_float,c_float,c_float,c_float, ## image limits
+        c_int,c_int, ## image shape
+        double_buffer, ## kernel normalizations
+        c_int, ## FLAGS (as passed to hsml_project_tile)
+        PROGRESS_CALLBACK,c_long], ## progress callback and interval
+    ('raytrace_rgb','raytrace_rgb'):[
+        c_int, ## number of particles
+        float_array,float_array, ## x-y positions (sorted in z)
+        float_array, ## smoothing lengths
+        float_array, ## attenuating masses
+        float_array,float_array,float_array, ## luminosities in each band
+        c_float,c_float,c_float, ## opacities in each band
+        c_float,c_float,c_float,c_float, ## image limits
+        c_int,c_int, ## image shape
+        float_buffer, ## mass map
+        float_buffer,float_buffer,float_buffer, ## band maps
+        c_int, ## FLAGS
+        c_float, ## transmittance of an opaque pixel, with FLAG_FRONT_TO_BACK
+        PROGRESS_CALLBACK,c_long], ## progress callback and interval
+    ('raytrace_rgb','raytrace_rgb_tile'):[
+        c_int, ## number of particles
+        float_array,float_array, ## x-y positions (sorted in z)
+        float_array, ## smoothing lengths
+        float_array, ## attenuating masses
+        float_array,float_array,float_array, ## luminosities in each band
+        c_float,c_float,c_float, ## opacities in each band
+        c_float,c_float,c_float,c_float, ## limits of the full image
+        c_int,c_int, ## shape of the full image
+        c_int,c_int,c_int,c_int, ## pixel bounds of the tile
+        double_buffer, ## kernel normalizations
+        float_buffer, ## mass map
+        float_buffer,float_buffer,float_buffer, ## band maps
+        c_int, ## FLAGS
+        c_float, ## transmittance of an opaque pixel, with FLAG_FRONT_TO_BACK
+        PROGRESS_CALLBACK,c_long], ## progress callback and interval
+    ('raytrace_rgb','raytrace_rgb_normalization'):[
+        c_int, ## number of particles to normalize
+        optional(int_array), ## their indices, or NULL for the first ones
+        float_array,float_array, ## x-y positions
+        float_array, ## smoothing lengths
+        c_float,c_float,c_float,c_float, ## image limits
+        c_int,c_int, ## image shape
+        double_buffer, ## kernel normalizations
+        c_int, ## FLAGS (as passed to raytrace_rgb_tile)
+        PROGRESS_CALLBACK,c_long], ## progress callback and interval
+    ('raytrace_rgb','raytrace_nband'):[
+        c_int, ## number of particles to trace
+        optional(int_array), ## their indices in z order, or NULL if already sorted
+        c_int, ## number of particles in the arrays
+        float_array,float_array, ## x-y positions
+        float_array, ## smoothing lengths
+        float_array, ## attenuating masses
+        c_int,float_array, ## number of bands, Nbands x N luminosities
+        float_array, ## opacities in each band
+        c_float,c_float,c_float,c_float, ## image limits
+        c_int,c_int, ## image shape
+        float_buffer,float_buffer, ## mass map, band maps
+        c_int, ## FLAGS
+        c_float, ## transmittance of an opaque pixel, with FLAG_FRONT_TO_BACK
+        PROGRESS_CALLBACK,c_long], ## progress callback and interval
+    ('raytrace_rgb','raytrace_nband_tile'):[
+        c_int, ## number of particles to trace
+        optional(int_array), ## their indices in z order, or NULL if already sorted
+        c_int, ## number of particles in the arrays
+        float_array,float_array, ## x-y positions
+        float_array, ## smoothing lengths
+        float_array, ## attenuating masses
+        c_int,float_array, ## number of bands, Nbands x N luminosities
+        float_array, ## opacities in each band
+        c_float,c_float,c_float,c_float, ## limits of the full image
+        c_int,c_int, ## shape of the full image
+        c_int,c_int,c_int,c_int, ## pixel bounds of the tile
+        optional(double_buffer), ## kernel normalizations, or NULL to compute them
+        float_buffer,float_buffer, ## mass map, band maps
+        c_int, ## FLAGS
+        c_float, ## transmittance of an opaque pixel, with FLAG_FRONT_TO_BACK
+        PROGRESS_CALLBACK,c_long], ## progress callback and interval
+    ('starhsml','stellarhsml'):[
+        c_int, ## number of particles
+        float_array,float_array,float_array, ## positions
+        c_int, ## neighbor depth
+        c_float, ## maximum smoothing length
+        optional(float_array), ## guesses to start each search from, or NULL
+        float_buffer, ## smoothing lengths
+        PROGRESS_CALLBACK,c_long]} ## progress callback and interval
+
+@functools.lru_cache(maxsize=None)
+def load_library(name):
+    """ Loads (once) the shared library called name and declares the
+        argtypes/restype of each of its entry points."""
+
+    curpath = os.path.split(os.path.realpath(__file__))[0]
+    library = ctypes.CDLL(os.path.join(curpath,*LIBRARY_PATHS[name]))
+
+    for (library_name,function_name),argtypes in SIGNATURES.items():
+        if library_name != name:
+            continue
+        function = getattr(library,function_name)
+        function.argtypes = argtypes
+        function.restype = c_int
+
+    return library
+
+def get_function(library_name,function_name):
+    return getattr(load_library(library_name),function_name)
+
+class KernelCancelled(RuntimeError):
+    """ Raised when a progress callback cancels a kernel """
+    pass
+
+class ProgressHook(object):
+    """
+    Input:
+        callback=None - called as callback(kernel_name,ndone,ntotal) from within the 
+            kernels, a truthy return cancels them (raising KernelCancelled). Called
+            with the GIL held, from every thread a threaded projection runs on
+        interval=10000 - number of particles each kernel walks between calls
+        timeout=None - seconds after which the kernels are cancelled (raising 
+            TimeoutError). Checked at the same interval
+    """
+
+    def __init__(self,callback=None,interval=10000,timeout=None):
+        self.callback = callback
+        self.interval = interval
+        self.timeout = timeout
+        self.deadline = None if timeout is None else time.time()+timeout
+        ## the reason the kernels were stopped, once they are
+        self.error = None
+        self.lock = threading.Lock()
+
+    def report(self,kernel_name,ndone,ntotal):
+        """ Passes a kernel's progress to the callback, returns whether it should stop """
+
+        with self.lock:
+            ## once one kernel is stopped the rest are too
+            if self.error is not None:
+                return True
+
+            if self.deadline is not None and time.time() > self.deadline:
+                self.error = TimeoutError("%s ran past the %g s timeout"%(kernel_name,self.timeout))
+            elif self.callback is not None:
+                ## an exception can't propagate through the C code, so hold on to it
+                try:
+                    if self.callback(kernel_name,ndone,ntotal):
+                        self.error = KernelCancelled(
+                            "%s was cancelled by the progress callback"%kernel_name)
+                except Exception as error:
+                    self.error = error
+
+            return self.error is not None
+
+    def check(self):
+        """ raises the reason the kernels were stopped, if they were """
+        if self.error is not None:
+            raise self.error
+
+## the hook kernels called in this process report to, see progress_hook
+_progress_hook = None
+
+@contextlib.contextmanager
+def progress_hook(callback=None,interval=10000,timeout=None):
+    """ Has every kernel called within the context report its progress to callback
+        (see ProgressHook), and be cancelled by it or after timeout seconds. The 
+        hook is process-wide, so it also covers the threads of a tiled projection.
+        
+        Input:
+
+            callback = None -- callback(kernel_name,ndone,ntotal), e.g. print_progress,
+                a truthy return cancels the kernels
+            interval = 10000 -- number of particles between reports
+            timeout = None -- seconds after which to cancel the kernels
+
+        Output:
+
+            hook -- the ProgressHook"""
+
+    global _progress_hook
+    previous_hook = _progress_hook
+    _progress_hook = ProgressHook(callback,interval,timeout)
+    try:
+        yield _progress_hook
+    finally:
+        _progress_hook = previous_hook
+
+def print_progress(kernel_name,ndone,ntotal):
+    """ progress callback that prints (like the kernels used to) """
+    print("%s: %d/%d.."%(kernel_name,ndone,ntotal),flush=True)
+
+def call_kernel(library_name,function_name,*args):
+    """ Calls a kernel that reports its progress, with the active progress_hook's 
+        callback (or none), and raises the reason it was stopped if it was 
+        (MemoryError if it couldn't allocate its work buffers)."""
+
+    function = get_function(library_name,function_name)
+    hook = _progress_hook
+    if hook is None:
+        status = function(*args,PROGRESS_CALLBACK(),0) ## NULL callback
+    else:
+        hook.check()
+        ## keep a reference to the C callback until the kernel returns
+        callback = PROGRESS_CALLBACK(
+            lambda ndone,ntotal: hook.report(function_name,ndone,ntotal))
+        status = function(*args,callback,hook.interval)
+
+    if status == OUT_OF_MEMORY:
+        raise MemoryError("%s couldn't allocate its work buffers"%function_name)
+    if status == PROGRESS_CANCELLED and hook is not None:
+        hook.check()
+        raise KernelCancelled("%s was cancelled"%function_name)
+    return status
+
+def farray(x):
+    """ contiguous single precision view (or copy, if it has to be) of x """
+    return np.ascontiguousarray(x,dtype=np.float32)
+
+def get_output_buffers(out,shapes,dtype=np.float32,zero=True):
+    """ Allocates zeroed output arrays of the given shapes, or checks and zeroes
+        the caller supplied ones in out so they can be filled in place. With 
+        zero=False the arrays in out are left as they are, to be added to."""
+
+    if out is None:
+        return tuple(np.zeros(shape,dtype=dtype) for shape in shapes)
+
+    if isinstance(out,np.ndarray):
+        out = (out,)
+
+    if len(out) != len(shapes):
+        raise ValueError("Expected %d output arrays, got %d"%(len(shapes),len(out)))
+
+    for buffer,shape in zip(out,shapes):
+        if (buffer.dtype != dtype or
+            buffer.shape != tuple(shape) or
+            not buffer.flags['C_CONTIGUOUS']):
+            raise ValueError(
+                "Output arrays must be C-contiguous %s arrays of shape %s, got %s %s"%(
+                np.dtype(dtype).name,tuple(shape),buffer.dtype,buffer.shape))
+        if zero:
+            buffer.fill(0)
+
+    return tuple(out)
+
+def get_kernel_flags(subpixel_cic=False,fast_math=False,front_to_back=False):
+    """ combines the options into the FLAGS bitmask the projection kernels take """
+    return (FLAG_SUBPIXEL_CIC*bool(subpixel_cic) | 
+        FLAG_FAST_MATH*bool(fast_math) | 
+        FLAG_FRONT_TO_BACK*bool(front_to_back))
+
+def find_hsml_and_project(
+    pos,hsml,mass,quantity,
+    Xmin,Xmax,
+    Ymin,Ymax,
+    Zmin,Zmax,
+    npix_x,npix_y,
+    desngb,
+    Hmax,
+    BoxSize,
+    Axis1=0,Axis2=1,Axis3=2,
+    out=None):
+    """ findHsmlAndProject in HsmlAndProject.so. A zero-filled (float32) hsml array
+        is filled in place with the smoothing lengths the routine computes, in the
+        same order as pos (the routine itself sorts copies of the particles).
+        Returns (and fills out with) the total mass map and the mass weighted
+        quantity map. It can't be stopped while it runs, the active progress_hook 
+        is only checked (and reported to) before and after."""
+
+    totalMassMap,massWeightedQuantityMap = get_output_buffers(
+        out,[(npix_x,npix_y)]*2)
+
+    ## the routine reorders the particles in place as it builds its tree, 
+    ##  so hand it copies and put the smoothing lengths back in our order
+    pos = farray(pos)
+    sorted_pos,sorted_hsml = pos.copy(),hsml.copy()
+
+    hook = _progress_hook
+    if hook is not None:
+        hook.check()
+
+    get_function('HsmlAndProject','findHsmlAndProject')(
+        pos.shape[0],
+        sorted_pos,sorted_hsml,np.array(mass,dtype=np.float32),np.array(quantity,dtype=np.float32),
+        Xmin,Xmax,
+        Ymin,Ymax,
+        Zmin,Zmax,
+        npix_x,npix_y,
+        desngb,
+        Axis1,Axis2,Axis3,
+        Hmax,BoxSize,
+        totalMassMap,massWeightedQuantityMap)
+
+    ## particles at the same position end up with the same smoothing length,
+    ##  so it doesn't matter which of them is matched to which
+    hsml[np.lexsort(pos.T)] = sorted_hsml[np.lexsort(sorted_pos.T)]
+
+    ## the routine can't report its progress (or be stopped) while it runs, so
+    ##  report once it's done and a timeout or cancel takes effect right after
+    if hook is not None and hook.report('findHsmlAndProject',pos.shape[0],pos.shape[0]):
+        hook.check()
+
+    return totalMassMap,massWeightedQuantityMap
+
+def hsml_project_normalization(
+    x,y,hsml,
+    Xmin,Xmax,
+    Ymin,Ymax,
+    npix_x,npix_y,
+    subpixel_cic=False,
+    fast_math=False,
+    out=None):
+    """ hsml_project_normalization in hsml_project.so, returns (and fills out with)
+        the sum of each particle's kernel over its image-clipped footprint."""
+
+    x = farray(x)
+    wt_sums, = get_output_buffers(out,[(x.size,)],dtype=np.float64)
+
+    call_kernel('hsml_project','hsml_project_normalization',
+        x.size,
+        x,farray(y),
+        farray(hsml),
+        Xmin,Xmax,
+        Ymin,Ymax,
+        npix_x,npix_y,
+        wt_sums,
+        get_kernel_flags(subpixel_cic,fast_math))
+
+    return wt_sums
+
+def hsml_project_tile(
+    x,y,hsml,
+    weight,quantity,
+    Xmin,Xmax,
+    Ymin,Ymax,
+    npix_x,npix_y,
+    ilo,ihi,jlo,jhi,
+    wt_sums,
+    subpixel_cic=False,
+    fast_math=False,
+    out=None,
+    accumulate=False):
+    """ hsml_project_tile in hsml_project.so, projects the particles onto the pixels
+        [ilo,ihi) x [jlo,jhi) of the image. quantity is an (Nquantities,N) array.
+        Returns (and fills out with) the weight map and the (Nquantities,npix_x,npix_y)
+        weighted quantity maps. With accumulate=True the maps in out are added to
+        rather than zeroed, so that disjoint tiles can fill the same maps. 
+        wt_sums must come from hsml_project_normalization with the same flags."""
+
+    x = farray(x)
+    quantity = np.ascontiguousarray(quantity,dtype=np.float32).reshape(-1,x.size)
+    nquantities = quantity.shape[0]
+    shapes = [(npix_x,npix_y),(nquantities,npix_x,npix_y)]
+
+    weightMap,weightedQuantityMap = get_output_buffers(out,shapes,zero=not accumulate)
+
+    call_kernel('hsml_project','hsml_project_tile',
+        x.size,
+        x,farray(y),
+        farray(hsml),
+        farray(weight),
+        nquantities,quantity,
+        Xmin,Xmax,
+        Ymin,Ymax,
+        npix_x,npix_y,
+        ilo,ihi,jlo,jhi,
+        np.ascontiguousarray(wt_sums,dtype=np.float64),
+        weightMap,weightedQuantityMap,
+        get_kernel_flags(subpixel_cic,fast_math))
+
+    return weightMap,weightedQuantityMap
+
+def raytrace_rgb(
+    x,y,hsml,
+    mass,
+    wt1,wt2,wt3,
+    kappa_1,kappa_2,kappa_3,
+    Xmin,Xmax,
+    Ymin,Ymax,
+    Xpixels,Ypixels,
+    subpixel_cic=False,
+    fast_math=False,
+    front_to_back=False,
+    min_transmittance=MIN_TRANSMITTANCE,
+    out=None):
+    """ raytrace_rgb in raytrace_rgb.so, the particles must already be sorted in z.
+        Returns (and fills out with) the mass map and the three band maps. With
+        front_to_back=True pixels stop once their transmittance (in every band)
+        falls below min_transmittance, and the mass map only counts the mass
+        in front of that point."""
+
+    x = farray(x)
+    outs = get_output_buffers(out,[(Xpixels,Ypixels)]*4)
+
+    call_kernel('raytrace_rgb','raytrace_rgb',
+        x.size,
+        x,farray(y),
+        farray(hsml),
+        farray(mass),
+        farray(wt1),farray(wt2),farray(wt3),
+        kappa_1,kappa_2,kappa_3,
+        Xmin,Xmax,
+        Ymin,Ymax,
+        Xpixels,Ypixels,
+        *outs,
+        get_kernel_flags(subpixel_cic,fast_math,front_to_back),
+        min_transmittance)
+
+    return outs
+
+def raytrace_rgb_normalization(
+    x,y,hsml,
+    Xmin,Xmax,
+    Ymin,Ymax,
+    Xpixels,Ypixels,
+    subpixel_cic=False,
+    fast_math=False,
+    order=None,
+    out=None):
+    """ raytrace_rgb_normalization in raytrace_rgb.so, returns (and fills out with)
+        the sum of each particle's kernel over its image-clipped footprint. With
+        order (int32 indices) only those particles are normalized, and the rest 
+        of out is left as it is."""
+
+    x = farray(x)
+    wt_sums, = get_output_buffers(out,[(x.size,)],dtype=np.float64,zero=order is None)
+    order = get_order(order,x.size)
+
+    call_kernel('raytrace_rgb','raytrace_rgb_normalization',
+        x.size if order is None else order.size,
+        order,
+        x,farray(y),
+        farray(hsml),
+        Xmin,Xmax,
+        Ymin,Ymax,
+        Xpixels,Ypixels,
+        wt_sums,
+        get_kernel_flags(subpixel_cic,fast_math))
+
+    return wt_sums
+
+def raytrace_rgb_tile(
+    x,y,hsml,
+    mass,
+    wt1,wt2,wt3,
+    kappa_1,kappa_2,kappa_3,
+    Xmin,Xmax,
+    Ymin,Ymax,
+    Xpixels,Ypixels,
+    ilo,ihi,jlo,jhi,
+    wt_sums,
+    subpixel_cic=False,
+    fast_math=False,
+    front_to_back=False,
+    min_transmittance=MIN_TRANSMITTANCE,
+    out=None):
+    """ raytrace_rgb_tile in raytrace_rgb.so, raytraces the particles (sorted in z)
+        through the pixels [ilo,ihi) x [jlo,jhi) of the image. Returns (and fills
+        out with) the mass map and the three band maps, which are NOT zeroed so that
+        disjoint tiles can fill the same maps. wt_sums must come from 
+        raytrace_rgb_normalization with the same flags."""
+
+    x = farray(x)
+    outs = get_output_buffers(out,[(Xpixels,Ypixels)]*4,zero=False)
+
+    call_kernel('raytrace_rgb','raytrace_rgb_tile',
+        x.size,
+        x,farray(y),
+        farray(hsml),
+        farray(mass),
+        farray(wt1),farray(wt2),farray(wt3),
+        kappa_1,kappa_2,kappa_3,
+        Xmin,Xmax,
+        Ymin,Ymax,
+        Xpixels,Ypixels,
+        ilo,ihi,jlo,jhi,
+        np.ascontiguousarray(wt_sums,dtype=np.float64),
+        *outs,
+        get_kernel_flags(subpixel_cic,fast_math,front_to_back),
+        min_transmittance)
+
+    return outs
+
+def get_order(order,N):
+    """ checks that order is None or int32 indices of N particles """
+
+    if order is None:
+        return None
+    order = np.ascontiguousarray(order,dtype=np.int32)
+    if order.size and (order.min() < 0 or order.max() >= N):
+        raise ValueError("order indexes particles outside the %d passed"%N)
+    return order
+
+def get_band_arrays(lums,kappas,N):
+    """ contiguous single precision (Nbands,N) luminosities and (Nbands,) opacities """
+
+    lums = np.ascontiguousarray(lums,dtype=np.float32)
+    if lums.ndim == 1:
+        lums = lums.reshape(1,-1)
+    if lums.ndim != 2 or lums.shape[1] != N:
+        raise ValueError("lums must be (Nbands,%d), not %s"%(N,lums.shape))
+    kappas = np.ascontiguousarray(kappas,dtype=np.float32).reshape(-1)
+    if kappas.size != lums.shape[0]:
+        raise ValueError("Got %d opacities for %d bands"%(kappas.size,lums.shape[0]))
+    return lums,kappas
+
+def raytrace_nband(
+    x,y,hsml,
+    mass,
+    lums,kappas,
+    Xmin,Xmax,
+    Ymin,Ymax,
+    Xpixels,Ypixels,
+    subpixel_cic=False,
+    fast_math=False,
+    front_to_back=False,
+    min_transmittance=MIN_TRANSMITTANCE,
+    order=None,
+    out=None):
+    """ raytrace_nband in raytrace_rgb.so, raytrace_rgb for any number of bands:
+        lums is an (Nbands,N) array of luminosities and kappas the Nbands opacities.
+        Returns (and fills out with) the mass map and the (Nbands,Xpixels,Ypixels)
+        band maps, each band is the same as raytrace_rgb would make it. The 
+        particles must be sorted in z, or order must be the (int32) indices of 
+        the particles to trace in z order, so they needn't be copied to mask 
+        and sort them."""
+
+    x = farray(x)
+    lums,kappas = get_band_arrays(lums,kappas,x.size)
+    outs = get_output_buffers(out,[(Xpixels,Ypixels),(lums.shape[0],Xpixels,Ypixels)])
+    order = get_order(order,x.size)
+
+    call_kernel('raytrace_rgb','raytrace_nband',
+        x.size if order is None else order.size,
+        order,
+        x.size,
+        x,farray(y),
+        farray(hsml),
+        farray(mass),
+        lums.shape[0],lums,
+        kappas,
+        Xmin,Xmax,
+        Ymin,Ymax,
+        Xpixels,Ypixels,
+        *outs,
+        get_kernel_flags(subpixel_cic,fast_math,front_to_back),
+        min_transmittance)
+
+    return outs
+
+def raytrace_nband_tile(
+    x,y,hsml,
+    mass,
+    lums,kappas,
+    Xmin,Xmax,
+    Ymin,Ymax,
+    Xpixels,Ypixels,
+    ilo,ihi,jlo,jhi,
+    wt_sums,
+    subpixel_cic=False,
+    fast_math=False,
+    front_to_back=False,
+    min_transmittance=MIN_TRANSMITTANCE,
+    order=None,
+    out=None):
+    """ raytrace_nband_tile in raytrace_rgb.so, raytrace_rgb_tile for any number of 
+        bands (see raytrace_nband, also for order). Returns (and fills out with) the
+        mass map and the (Nbands,Xpixels,Ypixels) band maps, which are NOT zeroed 
+        so that disjoint tiles can fill the same maps. wt_sums (one per particle)
+        must come from raytrace_rgb_normalization with the same flags, or be None
+        to normalize each particle (over the full image) as it's traced."""
+
+    x = farray(x)
+    lums,kappas = get_band_arrays(lums,kappas,x.size)
+    outs = get_output_buffers(
+        out,[(Xpixels,Ypixels),(lums.shape[0],Xpixels,Ypixels)],zero=False)
+    order = get_order(order,x.size)
+
+    call_kernel('raytrace_rgb','raytrace_nband_tile',
+        x.size if order is None else order.size,
+        order,
+        x.size,
+        x,farray(y),
+        farray(hsml),
+        farray(mass),
+        lums.shape[0],lums,
+        kappas,
+        Xmin,Xmax,
+        Ymin,Ymax,
+        Xpixels,Ypixels,
+        ilo,ihi,jlo,jhi,
+        None if wt_sums is None else np.ascontiguousarray(wt_sums,dtype=np.float64),
+        *outs,
+        get_kernel_flags(subpixel_cic,fast_math,front_to_back),
+        min_transmittance)
+
+    return outs
+
+def stellarhsml(
+    x,y,z,
+    desngb,
+    Hmax,
+    h_guess=None,
+    out=None):
+    """ stellarhsml in starhsml.so, returns (and fills out with) the distance
+        to each particle's desngb-th nearest neighbor. Each particle's search
+        starts from its h_guess (if > 0), e.g. its smoothing length in the 
+        previous snapshot, which doesn't change the result but converges faster."""
+
+    x = farray(x)
+    hsml, = get_output_buffers(out,[(x.size,)])
+
+    if h_guess is not None:
+        h_guess = farray(h_guess)
+        if h_guess.size != x.size:
+            raise ValueError("Got %d guesses for %d particles"%(h_guess.size,x.size))
+
+    call_kernel('starhsml','stellarhsml',
+        x.size,
+        x,farray(y),farray(z),
+        desngb,
+        Hmax,
+        h_guess,
+        hsml)
+
+    return hsml
+
+def get_fast_math_error(
+    x,y,hsml,
+    weight,
+    Xmin,Xmax,
+    Ymin,Ymax,
+    npix_x,npix_y,
+    subpixel_cic=False,
+    lums=None,kappas=None,
+    order=None,
+    front_to_back=False):
+    """ Projects the particles with and without fast_math and returns the largest
+        difference between the two weight maps, relative to the peak of the map, 
+        to be compared against FAST_MATH_TOLERANCE (e.g. on a subsample of a 
+        snapshot before rendering it with fast_math). With lums and kappas the
+        particles are raytraced instead (weight is their attenuating mass and 
+        order their z order, see raytrace_nband), which also covers the polynomial
+        exp, and the largest difference of the mass map and each band map 
+        (relative to its own peak) is returned."""
+
+    maps = []
+    for fast_math in [False,True]:
+        if lums is not None:
+            massMap,bandMaps = raytrace_nband(
+                x,y,hsml,
+                weight,
+                lums,kappas,
+                Xmin,Xmax,
+                Ymin,Ymax,
+                npix_x,npix_y,
+                subpixel_cic=subpixel_cic,
+                fast_math=fast_math,
+                front_to_back=front_to_back,
+                order=order)
+            maps += [[massMap]+list(bandMaps)]
+            continue
+
+        wt_sums = hsml_project_normalization(
+            x,y,hsml,
+            Xmin,Xmax,
+            Ymin,Ymax,
+            npix_x,npix_y,
+            subpixel_cic=subpixel_cic,
+            fast_math=fast_math)
+        weightMap,weightedQuantityMap = hsml_project_tile(
+            x,y,hsml,
+            weight,weight,
+            Xmin,Xmax,
+            Ymin,Ymax,
+            npix_x,npix_y,
+            0,npix_x,0,npix_y,
+            wt_sums,
+            subpixel_cic=subpixel_cic,
+            fast_math=fast_math)
+        maps += [[weightMap]]
+
+    error = 0.
+    for exact_map,fast_map in zip(*maps):
+        peak = np.max(np.abs(exact_map))
+        if peak > 0:
+            error = max(error,float(np.max(np.abs(fast_map-exact_map))/peak))
+    return error
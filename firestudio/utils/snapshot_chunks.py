@@ -0,0 +1,195 @@
+""" Lazy, chunked reading of particle data from (possibly multi-file) HDF5 snapshots,
+    so that projections can stream through a snapshot without holding it in memory."""
+
+import os
+import glob
+import numpy as np
+import h5py
+
+from abg_python.snapshot_utils import get_unit_conversion
+from abg_python.physics_utils import getTemperature
+
+def get_snapshot_files(snapdir,snapnum):
+    """ Returns the list of HDF5 files that make up snapshot snapnum in snapdir,
+        either a single snapshot_NNN.hdf5 file or the (sorted) pieces of a
+        snapdir_NNN/snapshot_NNN.M.hdf5 multi-file snapshot."""
+
+    single_file = os.path.join(snapdir,'snapshot_%03d.hdf5'%snapnum)
+    if os.path.isfile(single_file):
+        return [single_file]
+
+    fnames = []
+    for subdir in [os.path.join(snapdir,'snapdir_%03d'%snapnum),snapdir]:
+        fnames = glob.glob(os.path.join(subdir,'snapshot_%03d.*.hdf5'%snapnum))
+        if len(fnames):
+            break
+
+    if not len(fnames):
+        raise IOError("Can't find snapshot %d in %s"%(snapnum,snapdir))
+
+    ## sort by the file index, not lexically
+    return sorted(fnames,key=lambda fname: int(fname.split('.')[-2]))
+
+def get_snapshot_header(snapdir,snapnum):
+    """ Header attributes of the (first file of the) snapshot """
+
+    with h5py.File(get_snapshot_files(snapdir,snapnum)[0],'r') as handle:
+        return dict(handle['Header'].attrs)
+
+def read_chunk(part_group,key,lo,hi,header,cosmological):
+    """ reads particles [lo,hi) of key from the particle group and converts its 
+        units, with the same helpers openSnapshot uses """
+
+    if key == 'Temperature' and 'Temperature' not in part_group:
+        ## compute the temperature from the internal energy, like openSnapshot
+        InternalEnergy = part_group['InternalEnergy'][lo:hi]
+        if 'ChimesMu' in part_group:
+            return getTemperature(InternalEnergy,mu=part_group['ChimesMu'][lo:hi])
+
+        metallicity = part_group['Metallicity'][lo:hi] if 'Metallicity' in part_group else None
+        if metallicity is not None and metallicity.ndim > 1:
+            helium_mass_fraction = metallicity[:,1]
+        else:
+            helium_mass_fraction = 0.25
+        return getTemperature(
+            InternalEnergy,
+            helium_mass_fraction,
+            part_group['ElectronAbundance'][lo:hi])
+
+    values = part_group[key][lo:hi]
+    unit_fact = get_unit_conversion(header,key,cosmological)
+    if unit_fact != 1:
+        values = values*unit_fact
+    return values
+
+def iter_snapshot_chunks(
+    snapdir,snapnum,
+    ptype=0,
+    keys_to_extract=None,
+    chunk_size=2**22,
+    cosmological=0):
+    """ Lazily reads the particles of type ptype from a snapshot in chunks of
+        (at most) chunk_size particles, so peak memory is set by chunk_size
+        rather than by the size of the snapshot.
+
+        Input:
+
+            snapdir,snapnum -- location and number of the snapshot
+            ptype = 0 -- particle type to read
+            keys_to_extract = None -- which arrays to read, None reads Coordinates,
+                Masses, and SmoothingLength. Temperature is computed from
+                InternalEnergy (etc.) if it isn't stored in the snapshot.
+            chunk_size = 2**22 -- maximum number of particles in a chunk
+            cosmological = 0 -- flag to convert from comoving units, the flag 
+                the Studio opens the snapshot with. like openSnapshot, snapshots
+                with HubbleParam != 1 are converted either way, so both read
+                the same units
+
+        Output:
+
+            generator of dictionaries holding each chunk's arrays"""
+
+    if keys_to_extract is None:
+        keys_to_extract = ['Coordinates','Masses','SmoothingLength']
+
+    part_name = 'PartType%d'%ptype
+    for fname in get_snapshot_files(snapdir,snapnum):
+        with h5py.File(fname,'r') as handle:
+            if part_name not in handle:
+                continue
+
+            header = dict(handle['Header'].attrs)
+            if header['HubbleParam'] != 1:
+                cosmological = 1
+            part_group = handle[part_name]
+            npart = part_group['Coordinates'].shape[0]
+
+            for lo in range(0,npart,chunk_size):
+                hi = min(lo+chunk_size,npart)
+                yield dict(
+                    (key,read_chunk(part_group,key,lo,hi,header,cosmological))
+                    for key in keys_to_extract
+                    if key in part_group or key == 'Temperature')
+
+def get_disk_orientation(chunks,scom,radius):
+    """ Orients the disk on the angular momentum of the particles within radius of 
+        the halo center, like abg_python.cosmoExtractor but accumulated a chunk at
+        a time.
+
+        Input:
+
+            chunks -- iterable of chunks with Coordinates, Masses, and Velocities
+            scom -- halo center
+            radius -- radius of the particles to orient on
+
+        Output:
+
+            vscom -- center of mass velocity of the particles within radius
+            rot_matrix -- (Tait-Bryan, xyz) rotation matrix that takes their
+                angular momentum to the z axis"""
+
+    scom = np.asarray(scom,dtype=np.float64)
+    total_mass = 0
+    total_momentum = np.zeros(3)
+    total_moment = np.zeros(3) ## sum(m*r)
+    total_angMom = np.zeros(3) ## sum(r x m*v)
+    for chunk in chunks:
+        rs = chunk['Coordinates']-scom
+        mask = np.sum(rs**2,axis=1) <= radius**2
+        rs = rs[mask]
+        mvs = chunk['Masses'][mask,None]*chunk['Velocities'][mask]
+
+        total_mass += np.sum(chunk['Masses'][mask])
+        total_momentum += np.sum(mvs,axis=0)
+        total_moment += np.sum(chunk['Masses'][mask,None]*rs,axis=0)
+        total_angMom += np.sum(np.cross(rs,mvs),axis=0)
+
+    if not total_mass:
+        raise ValueError("No particles to orient the disk on within %.2f of %s"%(radius,scom))
+
+    ## angular momentum in the frame of the center of mass velocity,
+    ##  sum(r x m*(v-vscom)) = sum(r x m*v) - sum(m*r) x vscom
+    vscom = total_momentum/total_mass
+    angMom = total_angMom - np.cross(total_moment,vscom)
+
+    ## Tait-Bryan angles of the angular momentum, rotated about x then y
+    theta = np.arctan2(angMom[1],np.sqrt(angMom[0]**2+angMom[2]**2))
+    phi = np.arctan2(-angMom[0],angMom[2])
+    c1,s1 = np.cos(theta),np.sin(theta)
+    c2,s2 = np.cos(phi),np.sin(phi)
+    rot_matrix = np.array([
+        [c2   , 0 , s2    ],
+        [s1*s2, c1, -s1*c2],
+        [-c1*s2, s1, c1*c2]])
+
+    return vscom,rot_matrix
+
+def iter_extracted_chunks(chunks,scom,vscom,rot_matrix,radius):
+    """ Keeps the particles of each chunk within radius of the halo center, and
+        offsets and rotates their coordinates (and velocities) into the frame of
+        the disk, see get_disk_orientation.
+
+        Input:
+
+            chunks -- iterable of chunks, see iter_snapshot_chunks
+            scom,vscom -- halo center and center of mass velocity
+            rot_matrix -- rotation matrix of the disk
+            radius -- radius of the particles to keep
+
+        Output:
+
+            generator of dictionaries holding each chunk's extracted arrays"""
+
+    for chunk in chunks:
+        rs = chunk['Coordinates']-scom
+        mask = np.sum(rs**2,axis=1) <= radius**2
+        if not np.any(mask):
+            continue
+
+        extracted = dict((key,value[mask]) for key,value in chunk.items())
+        extracted['Coordinates'] = np.matmul(rot_matrix,rs[mask].T).T.astype(
+            chunk['Coordinates'].dtype)
+        if 'Velocities' in extracted:
+            extracted['Velocities'] = np.matmul(rot_matrix,(extracted['Velocities']-vscom).T).T.astype(
+                chunk['Velocities'].dtype)
+        yield extracted
@@ -13,10 +13,31 @@
 
     along with the basic information for the image grid (dimensions and size), 
     you send in the particle positions (in x,y), smoothing lengths (hsml), 
-      and 'weights' (mass, and 'luminosity' in each of three 'bands')
+      and 'weights' (mass, and 'luminosity' in each of three 'bands', or of
+      Nbands bands for raytrace_nband)
       
 */
 
+// bits of the FLAGS argument //
+#define FLAG_SUBPIXEL_CIC 1 // deposit particles smaller than a pixel with cloud-in-cell weights
+#define FLAG_FAST_MATH 2 // evaluate the kernel and attenuation in loops that vectorize, see below
+#define FLAG_FRONT_TO_BACK 4 // composite nearest particle first, stopping at opaque pixels, see below
+
+// side of the square blocks of pixels FLAG_FRONT_TO_BACK tracks opacity in //
+#define OPAQUE_BLOCK 8
+
+/* 
+    progress reporting: every PROGRESS_INTERVAL particles the routine calls PROGRESS 
+    (if it isn't NULL) with the number of particles done and the total. a nonzero 
+    return cancels the routine, which stops and returns PROGRESS_CANCELLED (its 
+    outputs are then incomplete). nothing is printed.
+*/
+typedef int (*progress_callback)(long ndone, long ntotal);
+#define PROGRESS_CANCELLED -1
+
+/* a routine that can't allocate its work buffers stops and returns OUT_OF_MEMORY */
+#define OUT_OF_MEMORY -2
+
 /* extremely fast approximation function for the exponential, 
     useful here since fractional accuracy errors are smaller than the kernel sources anyways */
 inline double fast_exp(double y) {
@@ -26,29 +47,328 @@ inline double fast_exp(double y) {
     return d;
 }
 
-// changed to better fit python wrapper, not IDL //
-int raytrace_rgb(
-    int N_xy, // number of input particles/positions
-    float* x, float* y, // positions (assumed already sorted in z)
+/* 
+    makes sure the stencil buffer can hold at least needed entries, 
+    reallocating it (without preserving contents) if it can't. returns NULL
+    (having freed it) if it can't be reallocated
+*/
+double* grow_stencil(double* STENCIL, long* stencil_size, long needed)
+{
+  if(needed > *stencil_size)
+  {
+    free(STENCIL);
+    *stencil_size = 2*needed;
+    STENCIL = malloc((*stencil_size)*sizeof(double));
+    if(STENCIL == NULL) *stencil_size = 0;
+  }
+  return STENCIL;
+}
+
+/* 
+    evaluates a particle's kernel on the pixels [imin,imax) x [jmin,jmax) in a single walk, 
+    storing each pixel's weight in STENCIL (row-major, 0 outside the kernel) so it 
+    can be scattered afterwards without evaluating the kernel a second time. 
+    returns the sum of the weights.
+*/
+double fill_kernel_stencil(
+    double x_n, double y_n, // position of the particle
+    double h, double h2, double h2_i, // search radius, kernel radius^2 and its inverse
+    double* x_i, double* y_j, // pixel centers
+    long imin, long imax, long jmin, long jmax, // pixel range to evaluate
+    double* Kernel, double kernel_spacing_inv, // kernel lookup table
+    double* STENCIL) // output weights
+{
+  double dx_n, dy_n, x2_n, y2_n, r2_n, wk, wt_sum=0.;
+  long i,j,k,s=0;
+
+  for(i=imin;i<imax;i++)
+  {
+   dx_n = x_n-x_i[i]; 
+   if (fabs(dx_n) < h)
+   {
+   x2_n = dx_n*dx_n;
+   for(j=jmin;j<jmax;j++)
+   {
+     dy_n = y_n-y_j[j]; 
+     y2_n = dy_n*dy_n;
+     r2_n = x2_n + y2_n; 
+     wk = 0.;
+     if (r2_n < h2) 
+     {
+      // use the kernel lookup table compiled above for the weighting //
+      r2_n *= h2_i*kernel_spacing_inv; // ok now have the separation in units of hsml, then kernel_table // 
+      k = (long)r2_n;
+      // ABG: used to be h2_i * below here
+      wk = (Kernel[k] + (Kernel[k+1]-Kernel[k])*(r2_n-k)); // ok that's the weighted result
+      wt_sum += wk;
+     }
+     STENCIL[s++] = wk;
+   }
+   }
+   else
+   {
+    for(j=jmin;j<jmax;j++) STENCIL[s++] = 0.;
+   }
+  }
+  return wt_sum;
+}
+
+/* 
+    FLAG_FAST_MATH: evaluates the cubic spline kernel (normalized like the lookup table) 
+    at u=r/h directly instead of interpolating the table in r^2. branchless (0 for u>=1) 
+    so the loop over a row of pixels vectorizes. differs from the table by its 
+    interpolation error: < 3e-5 relative to the peak of the kernel (more, relative to 
+    the kernel itself, in its far tail, where the table is coarsest).
+*/
+static inline double cubic_spline_kernel(double u)
+{
+  double v = 1.-u;
+  double wk = (u<=0.5) ? (1.-6.*u*u*v) : (2.*v*v*v);
+  return (u<1.) ? wk*(8./3.1415926535897932384626433832795) : 0.;
+}
+
+/* 
+    FLAG_FAST_MATH version of fill_kernel_stencil
+*/
+double fill_kernel_stencil_fast(
+    double x_n, double y_n, // position of the particle
+    double h, double h2_i, // search radius and inverse kernel radius^2
+    double* x_i, double* y_j, // pixel centers
+    long imin, long imax, long jmin, long jmax, // pixel range to evaluate
+    double* restrict STENCIL) // output weights
+{
+  double dx_n, x2_n, wt_sum=0.;
+  long i,j,s=0;
+
+  for(i=imin;i<imax;i++,s+=jmax-jmin)
+  {
+   dx_n = x_n-x_i[i]; 
+   if (fabs(dx_n) < h)
+   {
+   x2_n = dx_n*dx_n*h2_i;
+   #pragma omp simd reduction(+:wt_sum)
+   for(j=jmin;j<jmax;j++)
+   {
+     double dy_n = y_n-y_j[j]; 
+     double wk = cubic_spline_kernel(sqrt(x2_n + dy_n*dy_n*h2_i));
+     wt_sum += wk;
+     STENCIL[s+j-jmin] = wk;
+   }
+   }
+   else
+   {
+    for(j=jmin;j<jmax;j++) STENCIL[s+j-jmin] = 0.;
+   }
+  }
+  return wt_sum;
+}
+
+/* 
+    FLAG_FAST_MATH: exp(y) for y<=0 from 2^(y/ln2) = 2^n * 2^r, with n the nearest 
+    integer (built directly in the exponent bits) and 2^r (|r|<=1/2) a degree 7 
+    Taylor polynomial. relative error < 1e-8, unlike fast_exp above it is accurate 
+    enough for optically thick pixels, and it vectorizes. underflows to 0 for y<-700.
+*/
+static inline double exp_poly(double y)
+{
+  double t, r, p, e;
+  int n; long bits;
+  y = (y < -700.) ? -700. : y;
+  t = y*1.4426950408889634; // y/ln2
+  n = (int)(t - 0.5); // round to nearest (t<=0)
+  r = (t - (double)n)*0.6931471805599453; // 2^(t-n) = exp(r), |r|<=ln2/2
+  p = 1.+r*(1.+r*(1./2.+r*(1./6.+r*(1./24.+r*(1./120.+r*(1./720.+r*(1./5040.)))))));
+  bits = ((long)(n+1023)) << 52; memcpy(&e,&bits,sizeof(double)); // e = 2^n
+  return (y <= -700.) ? 0. : p*e;
+}
+
+/* 
+    extincts the light already in pixel k by the fraction wk of particle n's mass, 
+    then adds the same fraction of its own luminosity, in each of the Nbands bands
+*/
+void raytrace_pixel(
+    long k, double wk, // pixel index and fraction of the particle deposited there
+    long n, float Mass, // the particle's index and mass
+    int Nbands, float** LUM, float* KAPPA, // luminosities (LUM[b][n]) and opacities in each band
+    double dx_dy_i, // inverse pixel area
+    float* OUT0, float** OUTS)
+{
+  double d_ij;
+  int b;
+  // first 'extinct' the background
+  if(Mass>0.)
+  {
+      d_ij = Mass*wk; // actual mass deposited into the cell
+      OUT0[k] += d_ij;
+      d_ij *= dx_dy_i; // surface density, m/(L_xcell*L_ycell)
+      for(b=0;b<Nbands;b++) OUTS[b][k] *= exp(-KAPPA[b] * d_ij);
+      // here the surface density extinct the background sources, 
+      //   with effective 'opacities' KAPPA[b] in each band
+  }
+  // now 'contribute' the particles own luminosity
+  for(b=0;b<Nbands;b++)
+    if(LUM[b][n] != 0.) OUTS[b][k] += LUM[b][n]*wk; // adds 'surface brightness' of LUM[b][n] to total in band b
+}
+
+/* 
+    FLAG_FRONT_TO_BACK version of raytrace_pixel, for particles passed nearest first:
+    adds the fraction wk of the particle's luminosity, dimmed by the transmittance T 
+    (one per band) of everything in front of it, then dims T by the fraction wk 
+    of its mass. returns 1 if that made the pixel opaque, i.e. every band's 
+    transmittance fell below MIN_TRANSMITTANCE.
+*/
+int raytrace_pixel_front_to_back(
+    long k, double wk, // pixel index and fraction of the particle deposited there
+    long n, float Mass, // the particle's index and mass
+    int Nbands, float** LUM, float* KAPPA, // luminosities (LUM[b][n]) and opacities in each band
+    double dx_dy_i, // inverse pixel area
+    int FAST_MATH, double MIN_TRANSMITTANCE, 
+    double* T, // transmittance of the pixel in each band
+    float* OUT0, float** OUTS)
+{
+  double d_ij;
+  int b, opaque;
+  // first 'contribute' the particle's own luminosity, through what's in front of it
+  for(b=0;b<Nbands;b++)
+    if(LUM[b][n] != 0.) OUTS[b][k] += T[b]*LUM[b][n]*wk;
+  // then 'extinct' everything behind it
+  if(Mass>0.)
+  {
+      d_ij = Mass*wk; // actual mass deposited into the cell
+      OUT0[k] += d_ij;
+      d_ij *= dx_dy_i; // surface density, m/(L_xcell*L_ycell)
+      opaque = 1;
+      for(b=0;b<Nbands;b++)
+      {
+        if(FAST_MATH) T[b] *= exp_poly(-KAPPA[b] * d_ij);
+        else T[b] *= exp(-KAPPA[b] * d_ij);
+        opaque = opaque && (T[b] < MIN_TRANSMITTANCE);
+      }
+      return opaque;
+  }
+  return 0;
+}
+
+/* whether every band of a pixel's transmittance T is below MIN_TRANSMITTANCE */
+static inline int is_opaque(double* T, int Nbands, double MIN_TRANSMITTANCE)
+{
+  int b;
+  for(b=0;b<Nbands;b++) if(!(T[b] < MIN_TRANSMITTANCE)) return 0;
+  return 1;
+}
+
+/* 
+    splits a particle between the (up to) 2 pixel centers bracketing it along one axis, 
+    folding a neighbor that falls off the image back onto the edge pixel. 
+    returns the number of pixels used.
+*/
+int cic_weights(double i_flt, long npix, long* ii, double* wi)
+{
+  long i0;
+  double f;
+  i_flt -= 0.5; // relative to the pixel centers
+  i0 = (long)floor(i_flt);
+  f = i_flt - i0;
+  if(i0 < 0) {ii[0]=0; wi[0]=1.; return 1;}
+  if(i0 >= npix-1) {ii[0]=npix-1; wi[0]=1.; return 1;}
+  ii[0]=i0; wi[0]=1.-f;
+  ii[1]=i0+1; wi[1]=f;
+  return 2;
+}
+
+/* 
+    builds the (projected) cubic spline kernel lookup table, in r^2 out to 
+    hkernel_over_hsml_to_use, used by fill_kernel_stencil 
+*/
+double* build_kernel_table(long N_KERNEL_TABLE, double hkernel_over_hsml_to_use, double* kernel_spacing_inv)
+{
+  double h, h2, wk, dx_n, r2_n=0., *Kernel;
+  double dpi=3.1415926535897932384626433832795;
+  long n;
+
+  Kernel = calloc(N_KERNEL_TABLE+1, sizeof(double)); 
+  if(Kernel == NULL) return NULL;
+  dx_n=(hkernel_over_hsml_to_use*hkernel_over_hsml_to_use)/((double)N_KERNEL_TABLE);
+  *kernel_spacing_inv = 1./dx_n;
+  for(n=0;n<N_KERNEL_TABLE;n++)
+  {
+   h = sqrt(r2_n); // radius (to save sqrt operation we're interpolating in r^2 //
+   // approximate gaussian for projected, integrate kernel: //
+        //wk = (135./(14.*dpi)) * exp(-(135./14.)*h*h); // quintic spline we're using now   
+        //wk = (135./(14.*dpi)) * exp(-(135./14.)*h*h/(1.+h)); 
+        // this has more extended tails, designed to reduce artifacts in low-density regions
+        //  (where we would really want to use a proper volume-render)
+        // wk = 1.91 * exp(-5.56*h*h); // cubic spline 
+   // cubic spline kernel
+        h2=(1.-h); if(h<=0.5) {wk=(1.-6.*h*h*h2);} else {wk=2.*h2*h2*h2;} wk*=8/dpi; //wk*=40./(7.0*dpi);
+   Kernel[n] = wk;
+   r2_n += dx_n; // radius at this point in the table
+  }
+  Kernel[N_KERNEL_TABLE]=0;
+  return Kernel;
+}
+
+/* 
+    raytraces the particles through the sub-rectangle [Ilo,Ihi) x [Jlo,Jhi) of the full 
+    Xpixels x Ypixels grid. each particle is still renormalized by the sum of its kernel 
+    over its whole (image-clipped) footprint, and every pixel sees the particles in the
+    order they're passed (which must be z order), so raytracing disjoint tiles, each
+    with the (order-preserved) particles that overlap it, reproduces the full-image 
+    raytrace exactly. only pixels inside the tile are written and the output vectors 
+    are NOT zeroed (they must start at 0), so disjoint tiles can be filled concurrently.
+
+    FLAGS is a combination of:
+      FLAG_SUBPIXEL_CIC: particles smaller than a pixel skip the kernel and are split 
+        between the 4 nearest pixel centers with cloud-in-cell weights.
+      FLAG_FAST_MATH: the kernel and attenuation are evaluated in loops that vectorize,
+        see cubic_spline_kernel and exp_poly. WT_SUM must have been computed with 
+        the same flag.
+      FLAG_FRONT_TO_BACK: the particles are composited nearest (last) first, tracking
+        the transmittance of each pixel in each band. once every band of a pixel
+        is below MIN_TRANSMITTANCE the pixel is opaque and nothing more is deposited 
+        into it (so OUT0 only counts the mass in front of that point), and particles 
+        whose footprint only covers blocks of opaque pixels are skipped without 
+        evaluating their kernel. the light that's dropped is less than 
+        MIN_TRANSMITTANCE times what's behind the opaque pixel, with 
+        MIN_TRANSMITTANCE = 0 the result is the same as compositing back to front
+        (up to rounding). pixels only depend on the particles that overlap them, so 
+        tiles still reproduce the full-image result exactly.
+
+    the light is traced in Nbands bands at once, each with its own luminosities 
+    LUM[b] and opacity KAPPA[b] and written to OUTS[b], the bands don't interact 
+    so each comes out exactly as it would traced on its own.
+*/
+static int raytrace_bands_tile(
+    int N_xy, // number of particles to trace
+    int* ORDER, // indices of the N_xy particles in z order, NULL if they're already sorted
+    float* x, float* y, // positions (sorted in z, or ordered by ORDER)
     float* hsml, // smoothing lengths for each
     float* Mass, // total weight for 'extinction' part of calculation
-    float* wt1, float* wt2, float* wt3, // weights for 'luminosities'
-    float KAPPA1, float KAPPA2, float KAPPA3, // opacities for each channel
+    int Nbands, // number of bands
+    float** LUM, // weights for 'luminosities' in each band
+    float* KAPPA, // opacities for each band
     float Xmin, float Xmax, float Ymin, float Ymax, // boundaries of output grid
     int Xpixels, int Ypixels, // dimensions of grid
-    float* OUT0, float* OUT1, float* OUT2, float* OUT3 ) // output vectors with final weights
+    int Ilo, int Ihi, int Jlo, int Jhi, // pixel bounds of this tile
+    double* WT_SUM, // precomputed kernel normalization of each particle, NULL to compute it here
+    float* restrict OUT0, float** OUTS, // output vectors with final weights, mass and each band
+    int FLAGS, // FLAG_SUBPIXEL_CIC | FLAG_FAST_MATH | FLAG_FRONT_TO_BACK
+    float MIN_TRANSMITTANCE, // transmittance below which FLAG_FRONT_TO_BACK stops at a pixel
+    progress_callback PROGRESS, long PROGRESS_INTERVAL) // progress report (or NULL) and how often to call it
 {
-  // print out the input parameters // 
-  printf("N_xy=%d...",N_xy); 
-  printf("Xmin=%f...Xmax=%f...Ymin=%f...Ymax=%f...Xpixels=%d...Ypixels=%d\n",
-    Xmin,Xmax,Ymin,Ymax,Xpixels,Ypixels);
-  printf("Kappa_1=%f...Kappa_2=%f...Kappa_3=%f...\n",KAPPA1,KAPPA2,KAPPA3);
-  printf("wt_1=%f...wt_2=%f...wt_3=%f...\n",wt1,wt2,wt3);
-
-  double dx, dy, dx_i, dy_i, dx_dy_i, dx_n, dy_n, i_x_flt, i_y_flt, d_ij, h, hmin;
-  double h2, x2_n, y2_n, r2_n, h2_i, wk, wt_sum, hkernel_over_hsml_to_use, *Kernel; 
-  double dpi=3.1415926535897932384626433832795;
-  long n,i,j,k,imin,imax,jmin,jmax,N_KERNEL_TABLE;
+  double dx, dy, dx_i, dy_i, dx_dy_i, i_x_flt, i_y_flt, d_ij, h, hmin;
+  double h2, h2_i, wk, wt_sum, hkernel_over_hsml_to_use, kernel_spacing_inv, *Kernel; 
+  double *STENCIL=NULL, *TRANS=NULL;
+  long n,nn,p,i,j,k,s,imin,imax,jmin,jmax,N_KERNEL_TABLE,stencil_size=0;
+  long itmin,itmax,jtmin,jtmax,simin,sjmin,sny;
+  long ii[2],jj[2]; double wi[2],wj[2]; int ni,nj,b;
+  double m, l, a;
+  float* restrict OUTB;
+  int SUBPIXEL_CIC = FLAGS & FLAG_SUBPIXEL_CIC, FAST_MATH = FLAGS & FLAG_FAST_MATH;
+  int FRONT_TO_BACK = FLAGS & FLAG_FRONT_TO_BACK;
+  long tnx = Ihi-Ilo, tny = Jhi-Jlo, nbx = 0, nby = 0, bi, bj, t;
+  int *OPEN=NULL, any_open;
+  long next_report = (PROGRESS != NULL && PROGRESS_INTERVAL > 0) ? PROGRESS_INTERVAL : -1;
   
   dx = (Xmax - Xmin)/((double)Xpixels);
   dy = (Ymax - Ymin)/((double)Ypixels);
@@ -66,131 +386,449 @@ int raytrace_rgb(
   // default = 1 (integrate out to kernel), but low-density regions are represented 
   //   more accurately if this is larger (~2); code expense increases though!
   N_KERNEL_TABLE = 1000;
-  Kernel = calloc(N_KERNEL_TABLE+1, sizeof(double)); 
-  dx_n=(hkernel_over_hsml_to_use*hkernel_over_hsml_to_use)/((double)N_KERNEL_TABLE); r2_n=0.;
-  double kernel_spacing_inv = 1./dx_n;
-  for(n=0;n<N_KERNEL_TABLE;n++)
-  {
-   h = sqrt(r2_n); // radius (to save sqrt operation we're interpolating in r^2 //
-   // approximate gaussian for projected, integrate kernel: //
-        //wk = (135./(14.*dpi)) * exp(-(135./14.)*h*h); // quintic spline we're using now   
-        //wk = (135./(14.*dpi)) * exp(-(135./14.)*h*h/(1.+h)); 
-        // this has more extended tails, designed to reduce artifacts in low-density regions
-        //  (where we would really want to use a proper volume-render)
-        // wk = 1.91 * exp(-5.56*h*h); // cubic spline 
-   // cubic spline kernel
-        h2=(1.-h); if(h<=0.5) {wk=(1.-6.*h*h*h2);} else {wk=2.*h2*h2*h2;} wk*=8/dpi; //wk*=40./(7.0*dpi);
-   Kernel[n] = wk;
-   r2_n += dx_n; // radius at this point in the table
-  }
-  Kernel[N_KERNEL_TABLE]=0;
-  
-  // zero out the output vectors before the main sum
-  for(n=0;n<Xpixels*Ypixels;n++)
+  Kernel = build_kernel_table(N_KERNEL_TABLE, hkernel_over_hsml_to_use, &kernel_spacing_inv);
+  if(Kernel == NULL) return OUT_OF_MEMORY;
+
+  if(FRONT_TO_BACK && tnx > 0 && tny > 0)
   {
-    OUT0[n]=0.0; OUT1[n]=0.0; OUT2[n]=0.0; OUT3[n]=0.0;
+    // transmittance of each pixel of the tile in each band, starting transparent //
+    TRANS = malloc(Nbands*tnx*tny*sizeof(double));
+    if(TRANS == NULL) {free(Kernel); return OUT_OF_MEMORY;}
+    for(t=0;t<Nbands*tnx*tny;t++) TRANS[t]=1.;
+    // number of pixels in each block of the tile that aren't opaque yet //
+    nbx = (tnx+OPAQUE_BLOCK-1)/OPAQUE_BLOCK; nby = (tny+OPAQUE_BLOCK-1)/OPAQUE_BLOCK;
+    OPEN = malloc(nbx*nby*sizeof(int));
+    if(OPEN == NULL) {free(Kernel); free(TRANS); return OUT_OF_MEMORY;}
+    for(bi=0;bi<nbx;bi++)
+      for(bj=0;bj<nby;bj++)
+        OPEN[bj+nby*bi] = 
+          ((bi+1)*OPAQUE_BLOCK > tnx ? tnx-bi*OPAQUE_BLOCK : OPAQUE_BLOCK)*
+          ((bj+1)*OPAQUE_BLOCK > tny ? tny-bj*OPAQUE_BLOCK : OPAQUE_BLOCK);
   }
   
-  // loop over particles // 
-  for(n=0;n<N_xy;n++)
+  // loop over particles, nearest (last) first for FLAG_FRONT_TO_BACK // 
+  for(nn=0;nn<N_xy;nn++)
   {
-    i_x_flt = (x[n] - Xmin) * dx_i;
-    i_y_flt = (y[n] - Ymin) * dy_i;
-    h = hsml[n]; if(h<hmin) h=hmin; // assume 'intrinsic' h is smeared by some fraction of pixel
+    // report progress, stopping if asked to //
+    if(nn == next_report)
+    {
+      if(PROGRESS(nn,N_xy)) {free(STENCIL); free(Kernel); free(TRANS); free(OPEN); return PROGRESS_CANCELLED;}
+      next_report += PROGRESS_INTERVAL;
+    }
+    n = FRONT_TO_BACK ? N_xy-1-nn : nn;
+    p = (ORDER != NULL) ? ORDER[n] : n; // the particle //
+
+    i_x_flt = (x[p] - Xmin) * dx_i;
+    i_y_flt = (y[p] - Ymin) * dy_i;
+
+    // ABG: particles smaller than a pixel skip the kernel loop, 
+    //  their mass/light is split between the 4 nearest pixel centers (in z order)
+    if(SUBPIXEL_CIC && hsml[p] < hmin)
+    {
+      if(i_x_flt < 0 || i_x_flt >= Xpixels || i_y_flt < 0 || i_y_flt >= Ypixels) continue;
+      ni = cic_weights(i_x_flt,Xpixels,ii,wi);
+      nj = cic_weights(i_y_flt,Ypixels,jj,wj);
+      for(i=0;i<ni;i++)
+      {
+        if(ii[i]<Ilo || ii[i]>=Ihi) continue;
+        for(j=0;j<nj;j++)
+        {
+          if(jj[j]<Jlo || jj[j]>=Jhi) continue;
+          if(FRONT_TO_BACK)
+          {
+            t = Nbands*((jj[j]-Jlo) + tny*(ii[i]-Ilo));
+            if(is_opaque(TRANS+t,Nbands,MIN_TRANSMITTANCE)) continue; // already opaque //
+            if(raytrace_pixel_front_to_back(
+              jj[j] + Ypixels*ii[i], wi[i]*wj[j],
+              p,Mass[p],Nbands,LUM,KAPPA,dx_dy_i,
+              FAST_MATH,MIN_TRANSMITTANCE,TRANS+t,
+              OUT0,OUTS))
+              OPEN[(jj[j]-Jlo)/OPAQUE_BLOCK + nby*((ii[i]-Ilo)/OPAQUE_BLOCK)]--;
+            continue;
+          }
+          raytrace_pixel(
+            jj[j] + Ypixels*ii[i], wi[i]*wj[j],
+            p,Mass[p],Nbands,LUM,KAPPA,dx_dy_i,
+            OUT0,OUTS);
+        }
+      }
+      continue;
+    }
+
+    h = hsml[p]; if(h<hmin) h=hmin; // assume 'intrinsic' h is smeared by some fraction of pixel
     h2 = h*h;
     h2_i = 1./(h*h); // here we need the 'real' h (not the expanded search) // 
 
     h *= hkernel_over_hsml_to_use; // make search area larger for kernel //
     d_ij=h*dx_i; imin=(long)(i_x_flt-d_ij); imax=(long)(i_x_flt+d_ij)+1; if(imin<0) imin=0; if(imax>Xpixels-1) imax=Xpixels-1;
     d_ij=h*dy_i; jmin=(long)(i_y_flt-d_ij); jmax=(long)(i_y_flt+d_ij)+1; if(jmin<0) jmin=0; if(jmax>Ypixels-1) jmax=Ypixels-1;
+
+    // the part of the footprint that falls inside this tile //
+    itmin=imin; if(itmin<Ilo) itmin=Ilo; itmax=imax; if(itmax>Ihi) itmax=Ihi;
+    jtmin=jmin; if(jtmin<Jlo) jtmin=Jlo; jtmax=jmax; if(jtmax>Jhi) jtmax=Jhi;
+    if((itmin>=itmax) || (jtmin>=jtmax)) continue;
+
+    // skip particles that only cover opaque blocks, before evaluating their kernel //
+    if(FRONT_TO_BACK)
+    {
+      any_open = 0;
+      for(bi=(itmin-Ilo)/OPAQUE_BLOCK;bi<=(itmax-1-Ilo)/OPAQUE_BLOCK && !any_open;bi++)
+        for(bj=(jtmin-Jlo)/OPAQUE_BLOCK;bj<=(jtmax-1-Jlo)/OPAQUE_BLOCK;bj++)
+          if(OPEN[bj+nby*bi] > 0) {any_open = 1; break;}
+      if(!any_open) continue;
+    }
     
-    wt_sum = 0.;
-    // ABG do initial loop to count total weight deposited
-    for(i=imin;i<imax;i++)
+    if(WT_SUM != NULL)
     {
-     dx_n = x[n]-x_i[i]; 
-     if (fabs(dx_n) < h)
-     {
-     x2_n = dx_n*dx_n;
-     for(j=jmin;j<jmax;j++)
-     {
-       dy_n = y[n]-y_j[j]; 
-       y2_n = dy_n*dy_n;
-       r2_n = x2_n + y2_n; 
-       if (r2_n < h2) 
-       {
-        // use the kernel lookup table compiled above for the weighting //
-        r2_n *= h2_i*kernel_spacing_inv; // ok now have the separation in units of hsml, then kernel_table // 
-        k = (long)r2_n;
-        // ABG: used to be h2_i * below here
-        wk = (
-            Kernel[k] + 
-            (Kernel[k+1]-Kernel[k])*(r2_n-k)
-            ); // ok that's the weighted result
-
-        k = j + Ypixels*i; // j runs 0-Ypixels-1, so this provides the necessary indexing //
-        wt_sum += wk;
-       }
-     }
-     }
+      // only need the weights inside the tile //
+      simin=itmin; sjmin=jtmin; sny=jtmax-jtmin;
+      STENCIL = grow_stencil(STENCIL,&stencil_size,(itmax-itmin)*sny);
+      if(STENCIL == NULL) {free(Kernel); free(TRANS); free(OPEN); return OUT_OF_MEMORY;}
+      if(FAST_MATH) fill_kernel_stencil_fast(
+        x[p],y[p],h,h2_i,x_i,y_j,
+        itmin,itmax,jtmin,jtmax,
+        STENCIL);
+      else fill_kernel_stencil(
+        x[p],y[p],h,h2,h2_i,x_i,y_j,
+        itmin,itmax,jtmin,jtmax,
+        Kernel,kernel_spacing_inv,STENCIL);
+      wt_sum = WT_SUM[p];
     }
-    for(i=imin;i<imax;i++)
-        {
-         dx_n = x[n]-x_i[i]; 
-         if (fabs(dx_n) < h)
-         {
-         x2_n = dx_n*dx_n;
-         for(j=jmin;j<jmax;j++)
-         {
-           dy_n = y[n]-y_j[j]; 
-           y2_n = dy_n*dy_n;
-           r2_n = x2_n + y2_n; 
-           if (r2_n < h2) 
-           {
-            // use the kernel lookup table compiled above for the weighting //
-            r2_n *= h2_i*kernel_spacing_inv; // ok now have the separation in units of hsml, then kernel_table // 
-            k = (long)r2_n;
-            // ABG: used to be h2_i * below here
-            wk = (Kernel[k] + (Kernel[k+1]-Kernel[k])*(r2_n-k)); // ok that's the weighted result
-
-            // ABG: renormalize by sum of wk
-            wk = wk/wt_sum;
-
-            k = j + Ypixels*i; // j runs 0-Ypixels-1, so this provides the necessary indexing //
-        
-        // first 'extinct' the background
-        if(Mass[n]>0.)
+    else
+    {
+      // ABG gather the kernel weights (and their total) in a single walk //
+      simin=imin; sjmin=jmin; sny=jmax-jmin;
+      STENCIL = grow_stencil(STENCIL,&stencil_size,(imax-imin)*sny);
+    if(STENCIL == NULL) {free(Kernel); return OUT_OF_MEMORY;}
+      if(STENCIL == NULL) {free(Kernel); free(TRANS); free(OPEN); return OUT_OF_MEMORY;}
+      if(FAST_MATH) wt_sum = fill_kernel_stencil_fast(
+        x[p],y[p],h,h2_i,x_i,y_j,
+        imin,imax,jmin,jmax,
+        STENCIL);
+      else wt_sum = fill_kernel_stencil(
+        x[p],y[p],h,h2,h2_i,x_i,y_j,
+        imin,imax,jmin,jmax,
+        Kernel,kernel_spacing_inv,STENCIL);
+    }
+
+    if(FRONT_TO_BACK)
+    {
+      // scatter into the pixels that aren't opaque yet //
+      for(i=itmin;i<itmax;i++)
+      {
+        s = (i-simin)*sny + (jtmin-sjmin);
+        for(j=jtmin;j<jtmax;j++,s++)
         {
-            d_ij = Mass[n]*wk; // actual mass deposited into the cell
-            OUT0[k] += d_ij;
-            d_ij *= dx_dy_i; // surface density, m/(L_xcell*L_ycell)
-            OUT1[k] *= exp(-KAPPA1 * d_ij);
-            OUT2[k] *= exp(-KAPPA2 * d_ij);
-            OUT3[k] *= exp(-KAPPA3 * d_ij);
-            // here the surface density extinct the background sources, 
-            //   with effective 'opacities' KAPPA1/2/3 in each channel
+          if(!(STENCIL[s] > 0.)) continue;
+          t = Nbands*((j-Jlo) + tny*(i-Ilo));
+          if(is_opaque(TRANS+t,Nbands,MIN_TRANSMITTANCE)) continue; // already opaque //
+          if(raytrace_pixel_front_to_back(
+            j + Ypixels*i, STENCIL[s]/wt_sum,
+            p,Mass[p],Nbands,LUM,KAPPA,dx_dy_i,
+            FAST_MATH,MIN_TRANSMITTANCE,TRANS+t,
+            OUT0,OUTS))
+            OPEN[(j-Jlo)/OPAQUE_BLOCK + nby*((i-Ilo)/OPAQUE_BLOCK)]--;
         }
-        // now 'contribute' the particles own luminosity
-        if(wt1[n] != 0.) OUT1[k] += wt1[n]*wk; // adds 'surface brightness' of wt1 to total in channel1
-        if(wt2[n] != 0.) OUT2[k] += wt2[n]*wk;
-        if(wt3[n] != 0.) OUT3[k] += wt3[n]*wk;
-       } // if (r2_n < h2)
-      } // for(j=jmin;j<jmax;j++)
-      } // if (x2_n < h2)
-    } // for(i=imin;i<imax;i++)
-
-    if(!(n%10000))
+      }
+      continue;
+    }
+
+    if(FAST_MATH)
     {
-    //printf("%ld..  xy=%g|%g  mass=%g wt(1|2|3)=%g|%g|%g  h=%g  imin/max=%ld|%ld  jmin/max=%ld|%ld  \n",
-     //   n,x[n],y[n],Mass[n],wt1[n],wt2[n],wt3[n],h,imin,imax,jmin,jmax); fflush(stdout);
-//    printf("%ld..  xy=%g|%g  mass(1|2|3)=%g|%g|%g  h=%g  imin/max=%ld|%ld  jmin/max=%ld|%ld  wt_sum=%g \n",
-//        n,x[n],y[n],Mass1[n],Mass2[n],Mass3[n],h,imin,imax,jmin,jmax,wt_sum); fflush(stdout);
+      // branchless scatter, a whole row of the tile at a time (0 weights leave a pixel unchanged) //
+      if(wt_sum <= 0.) continue;
+      m = Mass[p]/wt_sum;
+      for(i=itmin;i<itmax;i++)
+      {
+        s = (i-simin)*sny + (jtmin-sjmin) - jtmin;
+        k = Ypixels*i;
+        #pragma omp simd
+        for(j=jtmin;j<jtmax;j++) OUT0[k+j] += m*STENCIL[s+j];
+        // one band at a time, each is independent of the others //
+        for(b=0;b<Nbands;b++)
+        {
+          l = LUM[b][p]/wt_sum; a = -KAPPA[b]*m*dx_dy_i; OUTB = OUTS[b];
+          #pragma omp simd
+          for(j=jtmin;j<jtmax;j++)
+          {
+            double w = STENCIL[s+j];
+            OUTB[k+j] = OUTB[k+j]*exp_poly(a*w) + l*w;
+          }
+        }
+      }
+      continue;
     }
-    
-  } // for(n=0;n<N_xy;n++)
+
+    // then scatter them into this tile without re-evaluating the kernel //
+    for(i=itmin;i<itmax;i++)
+    {
+      s = (i-simin)*sny + (jtmin-sjmin);
+      for(j=jtmin;j<jtmax;j++,s++)
+      {
+        if(STENCIL[s] > 0.)
+        {
+        // ABG: renormalize by sum of wk
+        wk = STENCIL[s]/wt_sum;
+
+        k = j + Ypixels*i; // j runs 0-Ypixels-1, so this provides the necessary indexing //
+        raytrace_pixel(
+          k,wk,
+          p,Mass[p],Nbands,LUM,KAPPA,dx_dy_i,
+          OUT0,OUTS);
+        } // if(STENCIL[s] > 0.)
+      } // for(j=jtmin;j<jtmax;j++)
+    } // for(i=itmin;i<itmax;i++)
+
+  } // for(nn=0;nn<N_xy;nn++)
   
+  if(PROGRESS != NULL) PROGRESS(N_xy,N_xy);
+  free(STENCIL);
+  free(Kernel);
+  free(TRANS);
+  free(OPEN);
+  return 1;
+} // closes tile routine
+
+/* 
+    raytrace_bands_tile for the three bands (wt1,wt2,wt3) of the RGB images, 
+    see there for the tiling and FLAGS.
+*/
+int raytrace_rgb_tile(
+    int N_xy, // number of input particles/positions
+    float* x, float* y, // positions (assumed already sorted in z)
+    float* hsml, // smoothing lengths for each
+    float* Mass, // total weight for 'extinction' part of calculation
+    float* wt1, float* wt2, float* wt3, // weights for 'luminosities'
+    float KAPPA1, float KAPPA2, float KAPPA3, // opacities for each channel
+    float Xmin, float Xmax, float Ymin, float Ymax, // boundaries of output grid
+    int Xpixels, int Ypixels, // dimensions of grid
+    int Ilo, int Ihi, int Jlo, int Jhi, // pixel bounds of this tile
+    double* WT_SUM, // precomputed kernel normalization of each particle, NULL to compute it here
+    float* restrict OUT0, float* restrict OUT1, float* restrict OUT2, float* restrict OUT3, // output vectors with final weights
+    int FLAGS, // FLAG_SUBPIXEL_CIC | FLAG_FAST_MATH | FLAG_FRONT_TO_BACK
+    float MIN_TRANSMITTANCE, // transmittance below which FLAG_FRONT_TO_BACK stops at a pixel
+    progress_callback PROGRESS, long PROGRESS_INTERVAL) // progress report (or NULL) and how often to call it
+{
+  float* LUM[3] = {wt1,wt2,wt3};
+  float KAPPA[3] = {KAPPA1,KAPPA2,KAPPA3};
+  float* OUTS[3] = {OUT1,OUT2,OUT3};
+
+  return raytrace_bands_tile(
+    N_xy,NULL,x,y,hsml,Mass,
+    3,LUM,KAPPA,
+    Xmin,Xmax,Ymin,Ymax,
+    Xpixels,Ypixels,
+    Ilo,Ihi,Jlo,Jhi,
+    WT_SUM,
+    OUT0,OUTS,
+    FLAGS,MIN_TRANSMITTANCE,
+    PROGRESS,PROGRESS_INTERVAL);
+}
+
+/* 
+    raytrace_bands_tile for any number of bands: LUM holds the Nbands luminosities 
+    of each particle band by band (Nbands x N) and OUT the Nbands images 
+    (Nbands x Xpixels x Ypixels), see there for the tiling and FLAGS. the 
+    particles are traced in the order of ORDER, N_xy indices into the N particle
+    arrays, so they can be masked and sorted without copying them (or, with 
+    ORDER = NULL, N = N_xy particles are traced as they're stored).
+*/
+int raytrace_nband_tile(
+    int N_xy, // number of particles to trace
+    int* ORDER, // indices of the N_xy particles in z order, NULL if they're already sorted
+    int N, // number of particles in the arrays
+    float* x, float* y, // positions (sorted in z, or ordered by ORDER)
+    float* hsml, // smoothing lengths for each
+    float* Mass, // total weight for 'extinction' part of calculation
+    int Nbands, // number of bands
+    float* LUM, // weights for 'luminosities', Nbands x N
+    float* KAPPA, // opacities for each band
+    float Xmin, float Xmax, float Ymin, float Ymax, // boundaries of output grid
+    int Xpixels, int Ypixels, // dimensions of grid
+    int Ilo, int Ihi, int Jlo, int Jhi, // pixel bounds of this tile
+    double* WT_SUM, // precomputed kernel normalization of each particle, NULL to compute it here
+    float* restrict OUT0, float* restrict OUT, // output vectors with final weights, mass and Nbands x Xpixels x Ypixels
+    int FLAGS, // FLAG_SUBPIXEL_CIC | FLAG_FAST_MATH | FLAG_FRONT_TO_BACK
+    float MIN_TRANSMITTANCE, // transmittance below which FLAG_FRONT_TO_BACK stops at a pixel
+    progress_callback PROGRESS, long PROGRESS_INTERVAL) // progress report (or NULL) and how often to call it
+{
+  int b, status;
+  float** LUMS = malloc(Nbands*sizeof(float*));
+  float** OUTS = malloc(Nbands*sizeof(float*));
+  if(LUMS == NULL || OUTS == NULL) {free(LUMS); free(OUTS); return OUT_OF_MEMORY;}
+  for(b=0;b<Nbands;b++)
+  {
+    LUMS[b] = LUM + (long)b*N;
+    OUTS[b] = OUT + (long)b*Xpixels*Ypixels;
+  }
+
+  status = raytrace_bands_tile(
+    N_xy,ORDER,x,y,hsml,Mass,
+    Nbands,LUMS,KAPPA,
+    Xmin,Xmax,Ymin,Ymax,
+    Xpixels,Ypixels,
+    Ilo,Ihi,Jlo,Jhi,
+    WT_SUM,
+    OUT0,OUTS,
+    FLAGS,MIN_TRANSMITTANCE,
+    PROGRESS,PROGRESS_INTERVAL);
+
+  free(LUMS);
+  free(OUTS);
+  return status;
+}
+
+/* 
+    computes the sum of each particle's kernel over its (image-clipped) footprint, 
+    the normalization raytrace_rgb_tile (and raytrace_nband_tile) divides by. lets a tiled raytrace walk 
+    each footprint once for the normalization rather than once per tile. with 
+    ORDER only the particles it indexes are normalized (the rest of WT_SUM is 
+    left as it is).
+*/
+int raytrace_rgb_normalization(
+    int N_xy, // number of particles to normalize
+    int* ORDER, // indices of the N_xy particles, NULL for the first N_xy
+    float* x, float* y, // positions 
+    float* hsml, // smoothing lengths for each
+    float Xmin, float Xmax, float Ymin, float Ymax, // boundaries of output grid
+    int Xpixels, int Ypixels, // dimensions of grid
+    double* WT_SUM, // output vector of kernel normalizations, by particle index
+    int FLAGS, // the FLAGS raytrace_rgb_tile will be called with
+    progress_callback PROGRESS, long PROGRESS_INTERVAL) // progress report (or NULL) and how often to call it
+{
+  double dx, dy, dx_i, dy_i, i_x_flt, i_y_flt, d_ij, h, hmin;
+  double h2, h2_i, hkernel_over_hsml_to_use, kernel_spacing_inv, *Kernel; 
+  double *STENCIL=NULL;
+  long n,p,i,imin,imax,jmin,jmax,N_KERNEL_TABLE,stencil_size=0;
+  int SUBPIXEL_CIC = FLAGS & FLAG_SUBPIXEL_CIC, FAST_MATH = FLAGS & FLAG_FAST_MATH;
+  long next_report = (PROGRESS != NULL && PROGRESS_INTERVAL > 0) ? PROGRESS_INTERVAL : -1;
+  
+  dx = (Xmax - Xmin)/((double)Xpixels);
+  dy = (Ymax - Ymin)/((double)Ypixels);
+  dx_i = 1./dx; dy_i = 1./dy;
+  hmin = 0.5*sqrt(dx*dx+dy*dy); // ensures at least one cell 'sees' the particle // 
   
+  // pre-define cell positions so we save a step in the loop //
+  double x_i[Xpixels]; for(i=0;i<Xpixels;i++) x_i[i]=Xmin+dx*((double)i+0.5);
+  double y_j[Ypixels]; for(i=0;i<Ypixels;i++) y_j[i]=Ymin+dy*((double)i+0.5);
+
+  // must match the table in raytrace_rgb_tile exactly //
+  hkernel_over_hsml_to_use = 1.0; 
+  N_KERNEL_TABLE = 1000;
+  Kernel = build_kernel_table(N_KERNEL_TABLE, hkernel_over_hsml_to_use, &kernel_spacing_inv);
+  if(Kernel == NULL) return OUT_OF_MEMORY;
+
+  for(n=0;n<N_xy;n++)
+  {
+    // report progress, stopping if asked to //
+    if(n == next_report)
+    {
+      if(PROGRESS(n,N_xy)) {free(STENCIL); free(Kernel); return PROGRESS_CANCELLED;}
+      next_report += PROGRESS_INTERVAL;
+    }
+    p = (ORDER != NULL) ? ORDER[n] : n; // the particle //
+
+    i_x_flt = (x[p] - Xmin) * dx_i;
+    i_y_flt = (y[p] - Ymin) * dy_i;
+    WT_SUM[p] = 0.;
+    if(SUBPIXEL_CIC && hsml[p] < hmin) continue; // normalized by construction //
+
+    h = hsml[p]; if(h<hmin) h=hmin; // assume 'intrinsic' h is smeared by some fraction of pixel
+    h2 = h*h;
+    h2_i = 1./(h*h); // here we need the 'real' h (not the expanded search) // 
+    h *= hkernel_over_hsml_to_use; // make search area larger for kernel //
+    d_ij=h*dx_i; imin=(long)(i_x_flt-d_ij); imax=(long)(i_x_flt+d_ij)+1; if(imin<0) imin=0; if(imax>Xpixels-1) imax=Xpixels-1;
+    d_ij=h*dy_i; jmin=(long)(i_y_flt-d_ij); jmax=(long)(i_y_flt+d_ij)+1; if(jmin<0) jmin=0; if(jmax>Ypixels-1) jmax=Ypixels-1;
+
+    if((imin>=imax) || (jmin>=jmax)) continue;
+
+    // same walk as raytrace_rgb_tile so the sums agree to the last bit //
+    STENCIL = grow_stencil(STENCIL,&stencil_size,(imax-imin)*(jmax-jmin));
+    if(FAST_MATH) WT_SUM[p] = fill_kernel_stencil_fast(
+      x[p],y[p],h,h2_i,x_i,y_j,
+      imin,imax,jmin,jmax,
+      STENCIL);
+    else WT_SUM[p] = fill_kernel_stencil(
+      x[p],y[p],h,h2,h2_i,x_i,y_j,
+      imin,imax,jmin,jmax,
+      Kernel,kernel_spacing_inv,STENCIL);
+  } // for(n=0;n<N_xy;n++)
+
+  if(PROGRESS != NULL) PROGRESS(N_xy,N_xy);
+  free(STENCIL);
+  free(Kernel);
   return 1;
+} // closes normalization routine
+
+// changed to better fit python wrapper, not IDL //
+int raytrace_rgb(
+    int N_xy, // number of input particles/positions
+    float* x, float* y, // positions (assumed already sorted in z)
+    float* hsml, // smoothing lengths for each
+    float* Mass, // total weight for 'extinction' part of calculation
+    float* wt1, float* wt2, float* wt3, // weights for 'luminosities'
+    float KAPPA1, float KAPPA2, float KAPPA3, // opacities for each channel
+    float Xmin, float Xmax, float Ymin, float Ymax, // boundaries of output grid
+    int Xpixels, int Ypixels, // dimensions of grid
+    float* restrict OUT0, float* restrict OUT1, float* restrict OUT2, float* restrict OUT3, // output vectors with final weights
+    int FLAGS, // FLAG_SUBPIXEL_CIC | FLAG_FAST_MATH | FLAG_FRONT_TO_BACK
+    float MIN_TRANSMITTANCE, // transmittance below which FLAG_FRONT_TO_BACK stops at a pixel
+    progress_callback PROGRESS, long PROGRESS_INTERVAL) // progress report (or NULL) and how often to call it
+{
+  long n;
+
+  // zero out the output vectors before the main sum
+  for(n=0;n<Xpixels*Ypixels;n++)
+  {
+    OUT0[n]=0.0; OUT1[n]=0.0; OUT2[n]=0.0; OUT3[n]=0.0;
+  }
+
+  // the whole image is a single tile //
+  return raytrace_rgb_tile(
+    N_xy,x,y,hsml,Mass,wt1,wt2,wt3,
+    KAPPA1,KAPPA2,KAPPA3,
+    Xmin,Xmax,Ymin,Ymax,
+    Xpixels,Ypixels,
+    0,Xpixels,0,Ypixels,
+    NULL,
+    OUT0,OUT1,OUT2,OUT3,
+    FLAGS,MIN_TRANSMITTANCE,
+    PROGRESS,PROGRESS_INTERVAL);
 } // closes main program 
 
+// raytrace_rgb for any number of bands, see raytrace_nband_tile //
+int raytrace_nband(
+    int N_xy, // number of particles to trace
+    int* ORDER, // indices of the N_xy particles in z order, NULL if they're already sorted
+    int N, // number of particles in the arrays
+    float* x, float* y, // positions (sorted in z, or ordered by ORDER)
+    float* hsml, // smoothing lengths for each
+    float* Mass, // total weight for 'extinction' part of calculation
+    int Nbands, // number of bands
+    float* LUM, // weights for 'luminosities', Nbands x N
+    float* KAPPA, // opacities for each band
+    float Xmin, float Xmax, float Ymin, float Ymax, // boundaries of output grid
+    int Xpixels, int Ypixels, // dimensions of grid
+    float* restrict OUT0, float* restrict OUT, // output vectors with final weights, mass and Nbands x Xpixels x Ypixels
+    int FLAGS, // FLAG_SUBPIXEL_CIC | FLAG_FAST_MATH | FLAG_FRONT_TO_BACK
+    float MIN_TRANSMITTANCE, // transmittance below which FLAG_FRONT_TO_BACK stops at a pixel
+    progress_callback PROGRESS, long PROGRESS_INTERVAL) // progress report (or NULL) and how often to call it
+{
+  long n;
 
+  // zero out the output vectors before the main sum
+  for(n=0;n<Xpixels*Ypixels;n++) OUT0[n]=0.0;
+  for(n=0;n<(long)Nbands*Xpixels*Ypixels;n++) OUT[n]=0.0;
+
+  // the whole image is a single tile //
+  return raytrace_nband_tile(
+    N_xy,ORDER,N,x,y,hsml,Mass,
+    Nbands,LUM,KAPPA,
+    Xmin,Xmax,Ymin,Ymax,
+    Xpixels,Ypixels,
+    0,Xpixels,0,Ypixels,
+    NULL,
+    OUT0,OUT,
+    FLAGS,MIN_TRANSMITTANCE,
+    PROGRESS,PROGRESS_INTERVAL);
+}
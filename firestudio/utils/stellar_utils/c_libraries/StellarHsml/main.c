@@ -9,6 +9,20 @@ void allocate_3d(int Nsize);
 void set_particle_pointer(int Nsize, float* x, float* y, float* z);
 void free_memory_3d(int Nsize);
 
+/* 
+    progress reporting: every PROGRESS_INTERVAL particles stellarhsml calls PROGRESS 
+    (if it isn't NULL) with the number of particles done and the total. a nonzero 
+    return cancels the search, which stops and returns PROGRESS_CANCELLED (H_OUT is
+    then incomplete). nothing is printed.
+
+    warm starts: if H_GUESS isn't NULL, each particle's search starts from its 
+    H_GUESS (e.g. its smoothing length in the previous snapshot) if that's > 0, 
+    rather than from the previous particle's smoothing length. the smoothing 
+    lengths are the same, the search just converges in fewer iterations.
+*/
+typedef int (*progress_callback)(long ndone, long ntotal);
+#define PROGRESS_CANCELLED -1
+
 struct particle_3d 
 {
   float Pos[3];
@@ -17,41 +31,45 @@ struct particle_3d
 
 // revised call for python calling //
 //int stellarhsml(int argc,void *argv[])
-int stellarhsml(int N_in, float* x, float* y, float* z, int DesNgb, float Hmax, float* H_OUT)
+int stellarhsml(int N_in, float* x, float* y, float* z, int DesNgb, float Hmax, float* H_GUESS, float* H_OUT,
+  progress_callback PROGRESS, long PROGRESS_INTERVAL)
 {
   float h_guess, h2, xyz[3], dummy[3], h_guess_0;
-  int i, ngbfound;
+  int i, ngbfound, status=0;
+  long next_report = (PROGRESS != NULL && PROGRESS_INTERVAL > 0) ? PROGRESS_INTERVAL : -1;
   allocate_3d(N_in);
   float *r2list;
   int *ngblist;
 
-  printf("N=%d\n",N_in); printf("Hmax=%g\n",Hmax); printf("DesNgb=%d\n",DesNgb);
-
   ngb3d_treeallocate(N_in, 2*N_in);
   set_particle_pointer(N_in, x,y,z);
   ngb3d_treebuild((float **)&P3d[1], N_in, 0, dummy, dummy);
   h_guess = Hmax/150.0e0; h_guess_0=h_guess;
   for(i=0;i<N_in;i++)
   {
+    // report progress, stopping if asked to //
+    if(i == next_report)
+    {
+      if(PROGRESS(i,N_in)) {status=PROGRESS_CANCELLED; break;}
+      next_report += PROGRESS_INTERVAL;
+    }
+
 	  xyz[0]=P3d[i+1]->Pos[0]+1.0e-10;
 	  xyz[1]=P3d[i+1]->Pos[1]+1.0e-10;
 	  xyz[2]=P3d[i+1]->Pos[2]+1.0e-10;
+	  // start from this particle's own guess if there is one //
+	  if(H_GUESS != NULL && H_GUESS[i] > 0) h_guess = H_GUESS[i];
 	  h2=ngb3d_treefind( xyz, DesNgb ,1.04*h_guess, &ngblist, &r2list, Hmax, &ngbfound); 
 
-    if(!(i%10000))
-    {
-    printf("i=%d hmax=%g h_guess=%g h=%g xyz=%g|%g|%g ngb=%d \n",
-        i,Hmax,h_guess,sqrt(h2),xyz[0],xyz[1],xyz[2],ngbfound); fflush(stdout);
-    }
       H_OUT[i] = sqrt(h2);
       h_guess = H_OUT[i]; // use this value for next guess, should speed things up // 
       //if (h_guess>10.*h_guess_0) h_guess=2.*h_guess_0;
     } 
 
+  if(PROGRESS != NULL && status == 0) PROGRESS(N_in,N_in);
   ngb3d_treefree();
   free_memory_3d(N_in);
-  printf("done\n");
-  return 0;
+  return status;
 }
 
 
@@ -71,7 +89,6 @@ void set_particle_pointer(int Nsize, float* x, float* y, float* z)
 
 void allocate_3d(int Nsize)
 {
-  printf("allocating memory...\n");
   int i;
   if(Nsize>0)
     {
@@ -89,7 +106,6 @@ void allocate_3d(int Nsize)
       for(i=2;i<=Nsize;i++)   /* initiliaze pointer table */
 	P3d[i]=P3d[i-1]+1;
     }
-  printf("allocating memory...done\n");
 }
 
 
@@ -308,7 +308,6 @@ void ngb3d_treebuild(float **pospointer,int Npart,int MinMaxFlag,float XminOpt[3
   struct NODE *nfree,*th,*nn; 
 
 
-  printf("Begin tree construction.\n");
   if(Npart<2)
     {
       fprintf(stderr,"must be at least two particles in tree.\n");
@@ -350,7 +349,6 @@ void ngb3d_treebuild(float **pospointer,int Npart,int MinMaxFlag,float XminOpt[3
 
   len*=1.01;
 
-  printf("Enclosing max has length= %g\n",len); fflush(stdout);
 
 
   /* insert particle 1 in root node */
@@ -545,7 +543,6 @@ void ngb3d_treebuild(float **pospointer,int Npart,int MinMaxFlag,float XminOpt[3
     }
 
   
-  printf("Tree contruction finished. Number of nodes: %d\n",numnodes);
 }
 
 
@@ -1,8 +1,6 @@
 import os
 import numpy as np
 import math
-import scipy.ndimage.interpolation as interpolate
-import struct
 
 def colors_table(
     age_in_Gyr,
@@ -50,6 +48,21 @@ def colors_table(
         if RETURN_LAMBDA_EFF: 
             return lam_eff[BAND_ID]
     
+    ## look up the luminosity in this band, see colors_table_bands
+    return colors_table_bands(
+        age_in_Gyr,
+        metallicity_in_solar_units,
+        [BAND_ID],
+        SALPETER_IMF=SALPETER_IMF,CHABRIER_IMF=CHABRIER_IMF,
+        CRUDE=CRUDE,
+        UNITS_SOLAR_IN_BAND=UNITS_SOLAR_IN_BAND)[0]
+
+## parsed tables, keyed by filename, so each is only read once per process
+_colors_tables = {}
+
+def get_colors_table_fname(SALPETER_IMF=0,CHABRIER_IMF=1):
+    """ path to the binary table of L/M for the requested IMF """
+
     ## find directory of colors.dat file for a given IMF
     curpath = os.path.realpath(__file__)
     ##  split off this filename
@@ -57,52 +70,92 @@ def colors_table(
     ##  directory in which the data binaries are stored
     froot = os.path.join(curpath,'stellar_utils','colors_sps/') 
 
-    if (CHABRIER_IMF==1): 
-        fname=froot+'colors.chabrier.dat'
     if (SALPETER_IMF==1): 
-        fname=froot+'colors.salpeter.dat'
+        return froot+'colors.salpeter.dat'
+    if (CHABRIER_IMF==1): 
+        return froot+'colors.chabrier.dat'
+    raise ValueError("Choose an IMF, SALPETER_IMF=1 or CHABRIER_IMF=1")
+
+def load_colors_table(SALPETER_IMF=0,CHABRIER_IMF=1):
+    """ Reads the binary table of log10(L/M) for the requested IMF, once per 
+        process, extended with a column linearly extrapolated to extreme metallicities.
+
+        Input:
+
+            SALPETER_IMF = 0 -- flag to read the Salpeter IMF's table
+            CHABRIER_IMF = 1 -- flag to read the Chabrier IMF's table
+
+        Output:
+
+            age_grid -- (Na,) log10(age/yr) of the table's rows
+            z_grid -- (Nz+1,) metallicities (mass fractions) of the table's columns
+            l_all -- (Nl,Na,Nz+1) log10(L/M) in each band, age, and metallicity"""
+
+    fname = get_colors_table_fname(SALPETER_IMF,CHABRIER_IMF)
+    if fname in _colors_tables:
+        return _colors_tables[fname]
 
     ## read color data from binary 
-    ##  TODO consider rewriting these tables to disk as text...
     with open(fname,'rb') as lut:
-        lut_dat = lut.read();
-        Nl,Na,Nz = struct.unpack('3i',lut_dat[0:12])
-        z_grid = np.array(struct.unpack(str(Nz)+'d',lut_dat[12:12+8*Nz]))
-        age_grid = np.array(struct.unpack(str(Na)+'d',lut_dat[12+8*Nz:12+8*Nz+8*Na]))
-        l_all_l = np.array(struct.unpack(str(Nl*Na*Nz)+'d',lut_dat[12+8*Nz+8*Na:12+8*Nz+8*Na+8*Nl*Na*Nz]))
-        l_all = np.transpose(l_all_l.reshape(Nz,Na,Nl))
-    
-    ## pick the luminosity in this band
-    l_band = np.zeros((Na,Nz),dtype=np.float64);
-    for iz in range(Nz): 
-        l_band[:,iz]=l_all[BAND_ID,:,iz]
-    ## TODO i think this is the same as l_band = l_all[band]...
-    
+        Nl,Na,Nz = np.fromfile(lut,dtype=np.int32,count=3)
+        z_grid = np.fromfile(lut,dtype=np.float64,count=Nz)
+        age_grid = np.fromfile(lut,dtype=np.float64,count=Na)
+        ## stored (Nz,Na,Nl), make it band major
+        l_all_l = np.fromfile(lut,dtype=np.float64,count=Nl*Na*Nz).reshape(Nz,Na,Nl)
+
+    l_all = np.empty((Nl,Na,Nz+1),dtype=np.float64)
+    l_all[...,:Nz] = np.transpose(l_all_l,(2,1,0))
+
     # allow for extreme metallicities (extrapolate linearly past table)
-    push_metals = 1;
-    if (push_metals==1):
-        Nz = Nz + 1;
-        z_ext = [1000.0];
-        z_grid = np.concatenate([z_grid,z_ext])
-        lb1 = l_band[:,Nz-3]
-        lb2 = l_band[:,Nz-2]
-        lbx = np.zeros((Na,Nz),dtype=np.float64)
-        lbx[:,0:Nz-1] = l_band
-        lbx[:,Nz-1] = ( (lb2 - lb1) / 
-            np.log10(z_grid[Nz-2]/z_grid[Nz-3]) * 
-            np.log10(z_grid[Nz-1]/z_grid[Nz-2]) ) 
-        l_band = lbx;
+    z_grid = np.concatenate([z_grid,[1000.0]])
+    lb1 = l_all[...,Nz-2]
+    lb2 = l_all[...,Nz-1]
+    l_all[...,Nz] = ( (lb2 - lb1) / 
+        np.log10(z_grid[Nz-1]/z_grid[Nz-2]) * 
+        np.log10(z_grid[Nz]/z_grid[Nz-1]) ) 
+
+    ## these are shared, don't let anyone change them
+    for arr in (age_grid,z_grid,l_all):
+        arr.flags.writeable = False
+
+    _colors_tables[fname] = age_grid,z_grid,l_all
+    return _colors_tables[fname]
+
+def colors_table_indices(
+    age_in_Gyr,
+    metallicity_in_solar_units,
+    SALPETER_IMF=0,CHABRIER_IMF=1,
+    CRUDE=0):
+    """ Locates stars on the L/M table, to look up any number of bands with 
+        colors_table_bands without locating them again.
+
+        Input:
+
+            age_in_Gyr -- ages of the stars
+            metallicity_in_solar_units -- metallicities of the stars
+            SALPETER_IMF = 0, CHABRIER_IMF = 1 -- flags for the table's IMF
+            CRUDE = 0 -- flag to map stars to the nearest table entry rather 
+                than bilinearly interpolate
+
+        Output:
+
+            flat_indices -- (Ncorners,Nstars) indices into a band of the 
+                (flattened) table, Ncorners is 1 if CRUDE else 4
+            weights -- (Ncorners,Nstars) weight of each of them, None if CRUDE"""
+
+    age_grid,z_grid,l_all = load_colors_table(SALPETER_IMF,CHABRIER_IMF)
+    Na,Nz = l_all.shape[1:]
+
+    age_in_Gyr=np.array(age_in_Gyr,ndmin=1)
+    metallicity_in_solar_units=np.array(metallicity_in_solar_units,ndmin=1)
 
     # get the x-axis (age) locations of input points
+    # this returns the boundary values for points outside of them (no extrapolation)
     ia_pts=np.interp(
         np.log10(age_in_Gyr)+9.0,
         age_grid,
         np.arange(0,Na,1))
 
-    # this returns the boundary values for points outside of them (no extrapolation)
-    #f=interp.interp1d(age_grid,np.arange(0,Na,1),kind='linear'); 
-    #ia_pts=f(np.log10(age_in_Gyr)+9.0);
-
     # get the y-axis (metallicity) locations of input points
     zsun = 0.02;
     iz_pts=np.interp(
@@ -110,25 +163,77 @@ def colors_table(
         np.log10(z_grid),
         np.arange(0,Nz,1))
 
-    #f=interp.interp1d(np.log10(z_grid),np.arange(0,Nz,1),kind='linear'); 
-    #iz_pts=f(np.log10(metallicity_in_solar_units*zsun));
-
-    ## map requested points to their location on the grid.
-    ##  TODO i think these are index maps, in which case 
-    ##  np.digitize would do this
     if (CRUDE==1):
+        ## nearest table entry
         ia_pts=np.around(ia_pts).astype(int)
         iz_pts=np.around(iz_pts).astype(int)
-        l_b=l_band[ia_pts,iz_pts]
+        return (ia_pts*Nz+iz_pts)[None],None
+
+    ## lower corner of each star's cell, the last cell includes its upper edge
+    ia_lo = np.minimum(ia_pts.astype(int),Na-2)
+    iz_lo = np.minimum(iz_pts.astype(int),Nz-2)
+    fa = ia_pts-ia_lo
+    fz = iz_pts-iz_lo
+    flat_lo = ia_lo*Nz+iz_lo
+
+    flat_indices = np.array([flat_lo,flat_lo+1,flat_lo+Nz,flat_lo+Nz+1])
+    weights = np.array([(1-fa)*(1-fz),(1-fa)*fz,fa*(1-fz),fa*fz])
+    return flat_indices,weights
+
+def colors_table_bands(
+    age_in_Gyr,
+    metallicity_in_solar_units,
+    BAND_IDS,
+    SALPETER_IMF=0,CHABRIER_IMF=1,
+    CRUDE=0,
+    UNITS_SOLAR_IN_BAND=0,
+    indices=None):
+    """ Vectorized colors_table, L/M of stars in any number of bands at once 
+        from the (cached) table.
+
+        Input:
+
+            age_in_Gyr -- ages of the stars
+            metallicity_in_solar_units -- metallicities of the stars
+            BAND_IDS -- indices of the bands, see colors_table
+            SALPETER_IMF = 0, CHABRIER_IMF = 1 -- flags for the table's IMF
+            CRUDE = 0 -- flag to map stars to the nearest table entry rather 
+                than bilinearly interpolate
+            UNITS_SOLAR_IN_BAND = 0 -- flag to return L/M in L_sun in the band 
+                rather than L_sun,bolometric 
+            indices = None -- (flat_indices,weights) from colors_table_indices, 
+                to skip locating the stars on the table again
+
+        Output:
+
+            l_b -- (Nbands,Nstars) L/M in each band"""
+
+    BAND_IDS = np.array(BAND_IDS,dtype=int,ndmin=1)
+    l_all = load_colors_table(SALPETER_IMF,CHABRIER_IMF)[2]
+    l_bands = l_all[BAND_IDS].reshape(BAND_IDS.size,-1)
+
+    if indices is None:
+        indices = colors_table_indices(
+            age_in_Gyr,
+            metallicity_in_solar_units,
+            SALPETER_IMF=SALPETER_IMF,CHABRIER_IMF=CHABRIER_IMF,
+            CRUDE=CRUDE)
+    flat_indices,weights = indices
+
+    if weights is None:
+        l_b = l_bands[:,flat_indices[0]]
     else:
-        l_b = interpolate.map_coordinates(l_band, (ia_pts,iz_pts), order=1)
+        ## sum the corners of each star's cell
+        l_b = l_bands[:,flat_indices[0]]*weights[0]
+        for flat_index,weight in zip(flat_indices[1:],weights[1:]):
+            l_b += l_bands[:,flat_index]*weight
     l_b = 10.**l_b
 	
     # at this point, output is currently L/M in L_sun_IN_THE_BAND_OF_INTEREST/M_sun, 
     # but we want our default to be L/M in units of L_bolometric/M_sun = 3.9e33/2.0e33, so 
     #   need to get rid fo the L_sun_IN_THE_BAND_OF_INTEREST/L_bolometric
     if not UNITS_SOLAR_IN_BAND:
-        l_b = renormalize_band_luminosity(l_b,BAND_ID)
+        l_b = renormalize_band_luminosity(l_b,BAND_IDS)
 
     return l_b
 
@@ -174,6 +279,9 @@ def renormalize_band_luminosity(l_b,BAND_ID):
     nulnu_sun_band = lnu_sun_band * nu_eff; # multiply by nu_eff to get nu*L_nu
     l_bol_sun = nulnu_sun_band[0];
 
-    l_b *= nulnu_sun_band[BAND_ID] / l_bol_sun;
+    ## BAND_ID can be an array of bands, one for each row of l_b
+    l_b *= np.reshape(
+        nulnu_sun_band[BAND_ID] / l_bol_sun,
+        np.shape(BAND_ID)+(1,)*(np.ndim(l_b)-np.ndim(BAND_ID)));
 
     return l_b
@@ -5,6 +5,9 @@ import os.path
 import struct
 import array
 
+from firestudio.utils import kernel_bindings
+from firestudio.utils.hsml_cache import match_hsml
+
 def checklen(x):
     return len(np.array(x,ndmin=1));
 def fcor(x):
@@ -18,25 +21,67 @@ def ok_scan(input,xmax=1.0e10,pos=0):
     else:
         return (np.isnan(input)==False) & (abs(input)<=xmax);
 
-def get_particle_hsml( x, y, z, DesNgb=32, Hmax=0.):
+def get_particle_hsml( x, y, z, DesNgb=32, Hmax=0., h_guess=None, out=None):
+    """ Distance to each particle's DesNgb-th nearest neighbor, see 
+        kernel_bindings.stellarhsml. Returns (and fills out with) one smoothing
+        length per particle, 0 for particles with non-finite positions, which
+        are left out of the search."""
     x=fcor(x); y=fcor(y); z=fcor(z); N=checklen(x); 
+    hsml, = kernel_bindings.get_output_buffers(out,[(N,)])
     ok=(ok_scan(x) & ok_scan(y) & ok_scan(z)); x=x[ok]; y=y[ok]; z=z[ok];
     if(Hmax==0.):
         dx=np.max(x)-np.min(x); dy=np.max(y)-np.min(y); dz=np.max(z)-np.min(z); ddx=np.max([dx,dy,dz]); 
-        Hmax=5.*ddx*(np.float(N)**(-1./3.)); ## mean inter-particle spacing
-
-    ## load the routine we need
-    curpath = os.path.realpath(__file__)
-    curpath = curpath[:len("utils")+curpath.index("utils")] #split off this filename
-    exec_call=os.path.join(curpath,'stellar_utils/c_libraries/StellarHsml/starhsml.so')
-    h_routine=ctypes.cdll[exec_call];
-
-    h_out_cast=ctypes.c_float*N; H_OUT=h_out_cast();
-    ## main call to the hsml-finding routine
-    h_routine.stellarhsml( ctypes.c_int(N), \
-        vfloat(x), vfloat(y), vfloat(z), ctypes.c_int(DesNgb), \
-        ctypes.c_float(Hmax), ctypes.byref(H_OUT) )
-
-    ## now put the output arrays into a useful format 
-    h = np.ctypeslib.as_array(np.copy(H_OUT));
-    return h;
+        Hmax=5.*ddx*(float(N)**(-1./3.)); ## mean inter-particle spacing
+    ## warm start each particle's search, e.g. from the previous snapshot
+    if h_guess is not None:
+        h_guess=fcor(h_guess)[ok]
+
+    ## main call to the hsml-finding routine, straight into hsml if none are cut
+    h = kernel_bindings.stellarhsml(
+        x,y,z,
+        DesNgb,
+        Hmax,
+        h_guess=h_guess,
+        out=hsml if np.all(ok) else None)
+    if not np.all(ok):
+        hsml[ok] = h
+    return hsml;
+
+def iter_particle_hsml(snapshots, DesNgb=32, Hmax=0.):
+    """ Streams through a sequence of (consecutive) snapshots, finding the 
+        smoothing lengths of each one's particles with get_particle_hsml. Each
+        particle's search is warm started from its smoothing length in the 
+        previous snapshot, matched by particle key, which converges in far fewer
+        iterations when the particles haven't moved much (and gives the same 
+        smoothing lengths as starting cold).
+
+        Input:
+
+            snapshots -- iterable of (x,y,z,keys) of each snapshot, read lazily,
+                keys from hsml_cache.get_particle_keys (e.g. of ParticleIDs)
+            DesNgb = 32 -- number of neighbors
+            Hmax = 0. -- largest smoothing length to search to, 0 picks one
+                for each snapshot
+
+        Output (yields):
+
+            hsml -- smoothing lengths of each snapshot's particles, 0 for 
+                those with non-finite positions (like get_particle_hsml)"""
+
+    sorted_keys = sorted_hsml = None
+    for x,y,z,keys in snapshots:
+        keys = np.asarray(keys).astype(np.uint64)
+
+        ## the previous snapshot's smoothing lengths, 0 for new particles
+        h_guess = None
+        if sorted_keys is not None:
+            h_guess = match_hsml(keys,sorted_keys,sorted_hsml)
+
+        h = get_particle_hsml(x,y,z,DesNgb=DesNgb,Hmax=Hmax,h_guess=h_guess)
+
+        ## keep them, by key, to start the next snapshot's search from
+        ##  (the 0s of particles that were cut start cold)
+        order = np.argsort(keys)
+        sorted_keys,sorted_hsml = keys[order],h[order]
+
+        yield h
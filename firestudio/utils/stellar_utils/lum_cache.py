@@ -0,0 +1,109 @@
+""" Per-snapshot cache of the stars' luminosity per unit mass in each band, keyed
+    by particle ID. The luminosities only depend on the stars' ages and
+    metallicities, so they're looked up on the SPS tables once per snapshot and
+    later frames (angles, zooms, ...) only memory-map the cache and gather the
+    stars in the frame.
+
+    Each band (and IMF) is cached in its own .npy file, a (2,N) uint64 array whose
+    first row is the particle keys, in the snapshot's order, and second row the
+    float64 L/M of each of them (as raw bits), so a single file is replaced
+    atomically. Keeping the snapshot's order makes the gather a plain mask rather
+    than a search, the keys are only checked to still match the snapshot's."""
+
+import os
+import numpy as np
+
+from firestudio.utils.hsml_cache import get_particle_keys
+
+def get_lum_cache_fname(cache_dir,BAND_ID,IMF_SALPETER=0):
+    """ path to the cache file of a band (and IMF) """
+
+    return os.path.join(cache_dir,'band%02d_%s.npy'%(
+        BAND_ID,'salpeter' if IMF_SALPETER else 'chabrier'))
+
+def load_cached_band_lums(fname,keys,frame_mask=None):
+    """ Gathers the cached L/M of the particles in a frame, memory-mapping the cache.
+
+        Input:
+
+            fname -- path to the cache file, see get_lum_cache_fname
+            keys -- particle keys of every particle in the snapshot,
+                see hsml_cache.get_particle_keys
+            frame_mask = None -- boolean mask (or indices) of the particles in
+                the frame, None for all of them
+
+        Output:
+
+            lums_per_mass -- float64 L/M of the particles in the frame, None if
+                there's no cache of these particles"""
+
+    if not os.path.isfile(fname):
+        return None
+
+    cache = np.load(fname,mmap_mode='r')
+
+    ## the cache has to be of this very snapshot, in the same order
+    keys = np.asarray(keys).astype(np.uint64)
+    if cache.shape[1] != keys.size or not np.array_equal(cache[0],keys):
+        return None
+
+    if frame_mask is None:
+        frame_mask = slice(None)
+    return np.asarray(cache[1][frame_mask]).view(np.float64)
+
+def save_cached_band_lums(fname,keys,lums_per_mass):
+    """ Caches the L/M of every particle in the snapshot, replacing the cache file."""
+
+    cache = np.array([
+        np.asarray(keys).astype(np.uint64),
+        np.asarray(lums_per_mass,dtype=np.float64).view(np.uint64)],dtype=np.uint64)
+
+    ## write it next to the old one and swap them, so a reader that has
+    ##  the old one memory-mapped still sees a whole file
+    os.makedirs(os.path.dirname(fname),exist_ok=True)
+    tmp_fname = fname[:-len('.npy')]+'.tmp%d.npy'%os.getpid()
+    np.save(tmp_fname,cache)
+    os.replace(tmp_fname,fname)
+
+def get_band_lums_per_mass(
+    cache_dir,
+    BAND_IDS,
+    keys,
+    frame_mask,
+    compute_band_lums_per_mass,
+    IMF_SALPETER=0):
+    """ L/M of the stars in a frame in each band, from the cache. Bands that aren't
+        cached for this snapshot are looked up for every star in it (so later
+        frames find them) and saved.
+
+        Input:
+
+            cache_dir -- directory of the snapshot's cache files
+            BAND_IDS -- indices of the bands
+            keys -- particle keys of every star in the snapshot
+            frame_mask -- boolean mask (or indices) of the stars in the frame
+            compute_band_lums_per_mass -- function of a list of BAND_IDS that
+                returns the (Nbands,Nstars) L/M of every star in the snapshot
+            IMF_SALPETER = 0 -- flag for the Salpeter IMF's cache rather than Chabrier's
+
+        Output:
+
+            lums_per_mass -- (Nbands,Nframe) float64 L/M of the stars in the frame"""
+
+    lums_per_mass = [
+        load_cached_band_lums(
+            get_lum_cache_fname(cache_dir,BAND_ID,IMF_SALPETER),
+            keys,frame_mask)
+        for BAND_ID in BAND_IDS]
+
+    missing = [i_band for i_band in range(len(BAND_IDS)) if lums_per_mass[i_band] is None]
+    if len(missing):
+        ## look up every star in the snapshot, so the cache covers any frame
+        all_lums_per_mass = compute_band_lums_per_mass([BAND_IDS[i_band] for i_band in missing])
+        for i_band,band_lums_per_mass in zip(missing,all_lums_per_mass):
+            save_cached_band_lums(
+                get_lum_cache_fname(cache_dir,BAND_IDS[i_band],IMF_SALPETER),
+                keys,band_lums_per_mass)
+            lums_per_mass[i_band] = band_lums_per_mass[frame_mask]
+
+    return np.array(lums_per_mass,dtype=np.float64,ndmin=2)
@@ -1,9 +1,12 @@
 import os
 import numpy as np
 import math
-import ctypes
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
-from firestudio.utils.stellar_utils.colors_sps.colors_table import colors_table
+from firestudio.utils import kernel_bindings
+from firestudio.utils.gas_utils.projection import get_tile_edges,get_pixel_footprints
+from firestudio.utils.stellar_utils.colors_sps.colors_table import colors_table,colors_table_bands
 from firestudio.utils.stellar_utils.attenuation.cross_section import opacity_per_solar_metallicity
 
 import scipy
@@ -11,7 +14,7 @@ import scipy
 def checklen(x):
     return len(np.array(x,ndmin=1));
 def int_round(x):
-    return np.int(np.round(x));
+    return int(np.round(x));
 def ok_scan(input,xmax=1.0e30,pos=0):
     if (pos==0):
         return (np.isnan(input)==False) & (np.isfinite(input)) & (np.fabs(input)<=xmax);
@@ -21,8 +24,95 @@ def ok_scan(input,xmax=1.0e30,pos=0):
         return (np.isnan(input)==False) & (np.isfinite(input)) & (np.fabs(input)<=xmax) & (input >= 0.);
 def fcor(x):
     return np.array(x,dtype='f',ndmin=1)
-def vfloat(x):
-    return x.ctypes.data_as(ctypes.POINTER(ctypes.c_float));
+
+class RaytraceStaging(object):
+    """ Keeps the z order, and the sorted float32 copies, of the particles the last 
+        raytrace_projection_compute call staged, to reuse for the next frame of a 
+        movie. The sorted copies are gathered into the same buffers every frame 
+        (rather than masking, sorting, and casting 8 arrays into 24 new ones), and 
+        frames with the same particles at the same depths (re-rendering with other
+        bands, opacities, pixels, ...) reuse the previous order without sorting.
+
+        Particles are matched between frames by their ids, e.g. their index in the 
+        (uncut) snapshot.
+
+        stellar_raytrace also keeps the (unsorted) float32 particle buffer it 
+        stages the stars and gas in here, see get_particle_buffer."""
+
+    def __init__(self):
+        ## ids and depths of the particles the previous order sorts
+        self.ids = None
+        self.z = None
+        self.order = None
+        ## float32 buffers the sorted arrays are gathered into
+        self.buffers = []
+        ## float32 buffer stellar_raytrace stages the particles in
+        self.particle_buffer = np.zeros(0,dtype=np.float32)
+
+    def get_particle_buffer(self,nrows,N):
+        """ (nrows,N) float32 view of this staging's particle buffer, grown if it's 
+            too small. Only valid until the next call."""
+
+        if self.particle_buffer.size < nrows*N:
+            ## drop the old buffer before allocating the new one
+            self.particle_buffer = None
+            self.particle_buffer = np.zeros(int(1.1*nrows*N)+1,dtype=np.float32)
+        return self.particle_buffer[:nrows*N].reshape(nrows,N)
+
+    def argsort(self,z,ids):
+        """ Indices that sort z, the previous call's if it had the same particles
+            at the same depths.
+
+            Input:
+
+                z -- depths of the particles
+                ids -- unique integer ids of the particles
+
+            Output:
+
+                order -- indices that sort z"""
+
+        if (self.order is not None and 
+            np.array_equal(ids,self.ids) and 
+            np.array_equal(z,self.z)):
+            return self.order
+
+        ## NOTE: reusing the previous order when the camera moves doesn't pay,
+        ##  numpy's argsort is faster than fixing it up: neighbors in depth 
+        ##  swap places under the smallest rotation
+        self.order = np.argsort(z)
+        self.ids = np.array(ids)
+        self.z = np.array(z)
+        return self.order
+
+    def stage(self,order,*arrays):
+        """ Gathers each array in order, cast to float32, into this staging's buffers.
+            An (Nbands,N) array, or a list of Nbands arrays, is gathered row by row 
+            into an (Nbands,order.size) buffer. The returned arrays are views of 
+            the buffers, so they're only valid until the next call."""
+
+        staged = []
+        for i,array in enumerate(arrays):
+            single = isinstance(array,np.ndarray) and array.ndim == 1
+            rows = [array] if single else list(array)
+            size = len(rows)*order.size
+
+            if i == len(self.buffers):
+                self.buffers.append(np.zeros(0,dtype=np.float32))
+            ## grow the buffer (with some room to spare) if it's too small
+            if self.buffers[i].size < size:
+                self.buffers[i] = np.zeros(int(1.1*size)+1,dtype=np.float32)
+            buffer = self.buffers[i][:size].reshape(len(rows),order.size)
+
+            for row,buffer_row in zip(rows,buffer):
+                row = np.asarray(row)
+                ## np.take gathers faster than fancy indexing
+                if row.dtype == np.float32:
+                    np.take(row,order,out=buffer_row)
+                else:
+                    buffer_row[:] = np.take(row,order)
+            staged.append(buffer[0] if single else buffer)
+        return staged
 
 
 ## 
@@ -76,6 +166,34 @@ def gas_raytrace_temperature( TEMPERATURE_CUTS, \
 ##   the bands of interest in cgs (cm^2/g), must be converted to match units of input 
 ##   mass and size. the default it to assume gadget units (M=10^10 M_sun, l=kpc)
 ##
+def lookup_band_lums_per_mass(
+    BAND_IDS,
+    stellar_age,stellar_metallicity,
+    IMF_CHABRIER=1,
+    IMF_SALPETER=0):
+    """ L/M of stars in each band, as read_band_lums_from_tables looks them up.
+
+        Input:
+
+            BAND_IDS -- indices of the bands, see colors_table
+            stellar_age -- ages of the stars in Gyr
+            stellar_metallicity -- metallicities (mass fractions) of the stars
+            IMF_CHABRIER = 1, IMF_SALPETER = 0 -- flags for the IMF
+
+        Output:
+
+            lums_per_mass -- (Nbands,Nstars) ((L_star)_band / L_sun) / M_sun"""
+
+    return colors_table_bands(
+        stellar_age, ## ages in Gyr
+        stellar_metallicity/0.02,  ## metallicity in solar
+        BAND_IDS, ## band indices
+        CHABRIER_IMF=IMF_CHABRIER, ## imf flags
+        SALPETER_IMF=IMF_SALPETER, ## imf flags
+        CRUDE=1, ## map particles to nearest table entry rather than interpolate
+        UNITS_SOLAR_IN_BAND=1, ## return ((L_star)_band / L_sun) / M_sun
+        ) 
+
 def read_band_lums_from_tables(
     BAND_IDS, 
     stellar_mass,stellar_age,stellar_metallicity,
@@ -85,21 +203,16 @@ def read_band_lums_from_tables(
     QUIET=False,
     IMF_CHABRIER=1,
     IMF_SALPETER=0):
-        
-    if nu_effs is None:
-        nu_effs = [None,None,None]
 
     ## count particles we're using
     Nstars=len(np.array(stellar_mass))
 
-    ## count how many bands we're attenuating
+    ## count how many bands we're attenuating, the three band images
+    ##  need 3 of them but stellar_raytrace(band_cube=True) takes any number
     Nbands=len(np.array(BAND_IDS))
 
-    ## require that we attenuate 3 bands to combine since attenuation
-    ##  routine is hardcoded to accept 3 weights
-    if (Nbands != 3): 
-        print("stellar_raytrace needs 3 bands, you gave",Nbands)
-        return -1,-1,-1;
+    if nu_effs is None:
+        nu_effs = [None]*Nbands
 
     ## check if stellar metallicity is a matrix
     ##  i.e. mass fraction of many species. If so,
@@ -115,8 +228,8 @@ def read_band_lums_from_tables(
         ## verify shape of lums is correct
         if lums.shape != (Nbands,Nstars):
             raise ValueError(
-                "Shape (%d,%d) of lums does not match (3,%d)"%(
-                lums.shape[0],lums.shape[1],Nstars))
+                "Shape (%d,%d) of lums does not match (%d,%d)"%(
+                lums.shape[0],lums.shape[1],Nbands,Nstars))
 
     for i_band in range(Nbands):
         if nu_effs[i_band] is None:
@@ -140,25 +253,22 @@ def read_band_lums_from_tables(
         kappa[i_band] = opacity_per_solar_metallicity(
             nu_effs[i_band])
 
-        these_lums = lums[i_band]
-        ## if lums were not passed in for this band
-        if np.all( these_lums == 0):
-            ## lookup the luminosity/mass in this band
-            ##  given stellar ages and metallicities
-            these_lums[:] = colors_table(
-                stellar_age, ## ages in Gyr
-                stellar_metallicity/0.02,  ## metallicity in solar
-                BAND_ID=BAND_IDS[i_band], ## band index
-                CHABRIER_IMF=IMF_CHABRIER, ## imf flags
-                SALPETER_IMF=IMF_SALPETER, ## imf flags
-                CRUDE=1, ## map particles to nearest table entry rather than interpolate
-                UNITS_SOLAR_IN_BAND=1, ## return ((L_star)_band / L_sun) / M_sun
-                QUIET=QUIET
-                ) 
+    ## bands whose lums were not passed in
+    lookup = [i_band for i_band in range(Nbands) if np.all(lums[i_band] == 0)]
+    if len(lookup):
+        if not QUIET:
+            print('Calculating L/M in bands',[BAND_IDS[i_band] for i_band in lookup])
+        ## lookup the luminosity/mass in these bands all at once
+        ##  given stellar ages and metallicities
+        lums[lookup] = lookup_band_lums_per_mass(
+            [BAND_IDS[i_band] for i_band in lookup],
+            stellar_age,stellar_metallicity,
+            IMF_CHABRIER=IMF_CHABRIER,
+            IMF_SALPETER=IMF_SALPETER)
 
-        #these_lums[these_lums >= 300.] = 300. ## just to prevent crazy values here 
-        #these_lums[these_lums <= 0.] = 0. ## just to prevent crazy values here 
-        lums[i_band] = stellar_mass * these_lums 
+    #lums[lums >= 300.] = 300. ## just to prevent crazy values here 
+    #lums[lums <= 0.] = 0. ## just to prevent crazy values here 
+    lums *= stellar_mass 
 
     return kappa,lums
 
@@ -176,7 +286,16 @@ def stellar_raytrace(
     zlim=0,
     pixels=720, 
     KAPPA_UNITS=2.08854068444, ## cm^2/g -> kpc^2/mcode
-    QUIET=False):
+    QUIET=False,
+    hybrid=False, ## cloud-in-cell deposit particles smaller than a pixel
+    fast_math=False, ## vectorized kernel and attenuation
+    nthreads=1, ## threads to raytrace image tiles with
+    front_to_back=False, ## composite nearest first, stopping at opaque pixels
+    min_transmittance=kernel_bindings.MIN_TRANSMITTANCE, ## transmittance of an opaque pixel
+    staging=None, ## RaytraceStaging to reuse the z order from the previous frame
+    ids=None, ## ids of the stars then the gas, to match them between frames
+    band_cube=False, ## return the mass map and an (Nbands,...) cube, for any number of bands
+    out=None): ## mass map and 3 band maps (or band cube) to fill in place
 
     ## check if stellar metallicity is a matrix
     ##  i.e. mass fraction of many species. If so,
@@ -192,73 +311,402 @@ def stellar_raytrace(
     #stellar_age += ADD_BASE_AGE;
 
     ## count particles we're using
-    Nstars=len(np.array(stellar_mass))
-    Ngas=len(np.array(gas_mass))
+    Nstars=np.size(stellar_mass)
+    Ngas=np.size(gas_mass)
+    Nbands=len(lums)
 
-    ## dummy values to use for source and attenuation terms 
-    gas_lum=np.zeros(Ngas) ## gas has no 'source term' for this calculation
-    stellar_mass_attenuation = np.zeros(Nstars) ## stars have no 'attenuation term'
+    if not band_cube and Nbands != 3:
+        raise ValueError(
+            "stellar_raytrace needs 3 bands for the three band maps, "+
+            "you gave %d (use band_cube=True)"%Nbands)
 
     ## convert units
-    gas_mass_metal = gas_mass * (gas_metallicity/0.02)
     kappa *= KAPPA_UNITS
-    
-    ## combine the relevant arrays so it can all be fed into the ray-tracing
-    ##  positions
-    x=np.concatenate([stellar_x,gas_x])
-    y=np.concatenate([stellar_y,gas_y])
-    z=np.concatenate([stellar_z,gas_z])
-    
-    ##  masses for attenuation purposes
-    mass=np.concatenate([stellar_mass_attenuation,gas_mass_metal])
-    ##  smoothing lengths 
-    hsml=np.concatenate([stellar_hsml,gas_hsml])
-
-    ##  source terms in each band
-    wt1=np.concatenate([lums[0,:],gas_lum])
-    wt2=np.concatenate([lums[1,:],gas_lum])
-    wt3=np.concatenate([lums[2,:],gas_lum])
-
-    ## opacity in each band
-    k1,k2,k3=kappa
+
+    ## stage the stars then the gas in a single float32 (5+Nbands,N) buffer,
+    ##  the ray-tracer masks and sorts them through an index array rather than copies
+    particles = stage_stellar_particles(
+        stellar_x,stellar_y,stellar_z,
+        stellar_hsml,lums,
+        gas_x,gas_y,gas_z,
+        gas_hsml,gas_mass,gas_metallicity,
+        out=None if staging is None else staging.get_particle_buffer(5+Nbands,Nstars+Ngas))
+    x,y,z,hsml,mass = particles[:5]
+    wts = particles[5:]
         
     if not QUIET:
         print("Projecting with attenuation...")
         print('total lum before attenuation in each band (Lsun/1e10):',np.sum(lums,axis=1))
         print('opacity in each band:',kappa)
-        print('total gas mass:',np.sum(gas_mass_metal))
-    return raytrace_projection_compute(
+        print('total gas mass:',np.sum(mass[Nstars:]))
+
+    ## fill a band cube, and copy it into the three band maps after
+    band_out = get_band_cube_out(out,band_cube)
+
+    out_0,out_bands = raytrace_bands_compute(
         x,y,z,
         hsml,mass,
-        wt1,wt2,wt3,
-        k1,k2,k3,
+        wts,kappa,
         xlim=xlim,ylim=ylim,zlim=zlim,
         pixels=pixels,
-        TRIM_PARTICLES=1)
-##
-##  Wrapper for raytrace_rgb, program which does a simply line-of-sight projection 
-##    with multi-color source and self-extinction along the sightline: here called 
-##    from python in its most general form: from the c-code itself:
-##
-##  int raytrace_rgb(
-##    int N_xy, // number of input particles/positions
-##    float *x, float *y, // positions (assumed already sorted in z)
-##    float *hsml, // smoothing lengths for each
-##    float *Mass, // total weight for 'extinction' part of calculation
-##    float *wt1, float *wt2, float *wt3, // weights for 'luminosities'
-##    float KAPPA1, float KAPPA2, float KAPPA3, // opacities for each channel
-##    float Xmin, float Xmax, float Ymin, float Ymax, // boundaries of output grid
-##    int Xpixels, int Ypixels, // dimensions of grid
-##    float *OUT0, float *OUT1, float *OUT2, float*OUT3 ) // output vectors with final weights
-##
-def raytrace_projection_compute(
+        TRIM_PARTICLES=1,
+        hybrid=hybrid,
+        fast_math=fast_math,
+        nthreads=nthreads,
+        front_to_back=front_to_back,
+        min_transmittance=min_transmittance,
+        staging=staging,
+        ids=ids,
+        gather=False, ## trace through the z order, without copying the particles
+        out=band_out)
+
+    return split_band_cube(out_0,out_bands,band_cube,out)
+
+def get_band_cube_out(out,band_cube):
+    """ the (mass map, band cube) buffers to fill for out, which is a mass 
+        map and 3 band maps (copied from the cube after) unless band_cube """
+
+    if band_cube or out is None:
+        return out
+    return (out[0],np.zeros((3,)+np.shape(out[0]),dtype=np.float32))
+
+def split_band_cube(out_0,out_bands,band_cube,out):
+    """ returns the mass map and band cube, or unless band_cube the mass map and 
+        three band maps (filling those in out) """
+
+    ## no particles to raytrace
+    if np.ndim(out_bands) == 0:
+        return (out_0,out_bands) if band_cube else (-1,-1,-1,-1)
+
+    if band_cube:
+        return out_0,out_bands
+
+    if out is None:
+        return out_0,out_bands[0],out_bands[1],out_bands[2]
+
+    for out_band,band in zip(out[1:],out_bands):
+        out_band[...] = band
+    return tuple(out)
+
+def stage_stellar_particles(
+    stellar_x,stellar_y,stellar_z,
+    stellar_hsml,lums,
+    gas_x,gas_y,gas_z,
+    gas_hsml,gas_mass,gas_metallicity,
+    out=None):
+    """ Stages the stars then the gas in the single float32 structure-of-arrays 
+        buffer stellar_raytrace traces: rows x,y,z,hsml, the attenuating mass 
+        (the gas' metal mass, stars have none) and the luminosity in each band 
+        (gas has none).
+
+        Input:
+
+            stellar_x,stellar_y,stellar_z -- positions of the stars
+            stellar_hsml -- smoothing lengths of the stars
+            lums -- (Nbands,Nstars) luminosities of the stars
+            gas_x,gas_y,gas_z -- positions of the gas
+            gas_hsml -- smoothing lengths of the gas
+            gas_mass -- masses of the gas
+            gas_metallicity -- metallicities (mass fractions) of the gas
+            out = None -- (5+Nbands,Nstars+Ngas) float32 buffer to fill
+
+        Output:
+
+            particles -- (5+Nbands,Nstars+Ngas) float32 particles"""
+
+    ## take the total metallicity if it's a matrix of species
+    if (len(np.shape(gas_metallicity))>1): 
+        gas_metallicity=gas_metallicity[:,0];
+
+    Nstars=np.size(stellar_x)
+    Nbands=len(lums)
+    shape=(5+Nbands,Nstars+np.size(gas_x))
+
+    if out is None:
+        particles = np.empty(shape,dtype=np.float32)
+    elif out.shape != shape or out.dtype != np.float32:
+        raise ValueError("Expected a float32 %s buffer, got %s %s"%(shape,out.dtype,out.shape))
+    else:
+        particles = out
+    x,y,z,hsml,mass = particles[:5]
+    wts = particles[5:]
+
+    ##  positions and smoothing lengths
+    for row,star_values,gas_values in zip(
+        [x,y,z,hsml],
+        [stellar_x,stellar_y,stellar_z,stellar_hsml],
+        [gas_x,gas_y,gas_z,gas_hsml]):
+        row[:Nstars] = star_values
+        row[Nstars:] = gas_values
+
+    ##  masses for attenuation purposes, stars have no 'attenuation term'
+    mass[:Nstars] = 0
+    mass[Nstars:] = gas_mass * (gas_metallicity/0.02)
+
+    ##  source terms in each band, gas has no 'source term' for this calculation
+    wts[:,:Nstars] = lums
+    wts[:,Nstars:] = 0
+
+    return particles
+
+def iter_stellar_particle_chunks(
+    stellar_x,stellar_y,stellar_z,
+    stellar_hsml,lums,
+    gas_x,gas_y,gas_z,
+    gas_hsml,gas_mass,gas_metallicity,
+    chunk_size=2**20):
+    """ Stages the stars then the gas chunk_size particles at a time, the
+        particle_chunks stellar_raytrace_streaming takes for particles that
+        are already in memory (only a chunk is ever copied into float32).
+
+        Input:
+
+            see stage_stellar_particles
+            chunk_size = 2**20 -- number of particles in a chunk
+
+        Output (yields):
+
+            chunk -- (5+Nbands,n) float32 particles, see stage_stellar_particles"""
+
+    ## take the total metallicity if it's a matrix of species
+    if (len(np.shape(gas_metallicity))>1):
+        gas_metallicity=gas_metallicity[:,0];
+
+    lums = np.asarray(lums)
+    Nstars = np.size(stellar_x)
+    Ngas = np.size(gas_x)
+    no_lums = np.zeros((lums.shape[0],0),dtype=np.float32)
+    no_particles = np.zeros(0,dtype=np.float32)
+
+    for start in range(0,Nstars,chunk_size):
+        stars = slice(start,start+chunk_size)
+        yield stage_stellar_particles(
+            stellar_x[stars],stellar_y[stars],stellar_z[stars],
+            stellar_hsml[stars],lums[:,stars],
+            no_particles,no_particles,no_particles,
+            no_particles,no_particles,no_particles)
+
+    for start in range(0,Ngas,chunk_size):
+        gas = slice(start,start+chunk_size)
+        yield stage_stellar_particles(
+            no_particles,no_particles,no_particles,
+            no_particles,no_lums,
+            gas_x[gas],gas_y[gas],gas_z[gas],
+            gas_hsml[gas],gas_mass[gas],gas_metallicity[gas])
+
+def iter_depth_slabs(particle_chunks,zedges,tmpdir=None):
+    """ Partitions particles, read a chunk at a time, into slabs of depth. Each
+        slab is spooled to its own files on disk, so only one chunk (and then
+        one slab) is ever in memory, and the slabs are yielded far (low z) to near.
+
+        Input:
+
+            particle_chunks -- iterable of (K,n) float32 chunks of particles, with
+                z in row 2 (e.g. from stage_stellar_particles), read lazily
+            zedges -- the nslabs-1 (increasing) depths between the slabs, particles 
+                beyond the first/last go in the first/last slab
+            tmpdir = None -- directory to spool the slabs in, defaults to the 
+                system's temporary directory
+
+        Output (yields):
+
+            slab -- (K,nslab) float32 particles of each (nonempty) slab, far to near"""
+
+    zedges = np.asarray(zedges,dtype=np.float32)
+    counts = np.zeros(zedges.size+1,dtype=int)
+    nrows = None
+
+    with tempfile.TemporaryDirectory(dir=tmpdir) as spool:
+        def slab_fname(islab,irow):
+            return os.path.join(spool,'slab%d_row%d.f32'%(islab,irow))
+
+        ## append each chunk's rows to the files of the slabs they fall in
+        for chunk in particle_chunks:
+            chunk = np.asarray(chunk,dtype=np.float32)
+            if nrows is None:
+                nrows = chunk.shape[0]
+            elif chunk.shape[0] != nrows:
+                raise ValueError("Chunk has %d rows, not %d"%(chunk.shape[0],nrows))
+
+            slab_index = np.searchsorted(zedges,chunk[2],side='right')
+            for islab in np.unique(slab_index):
+                in_slab = slab_index == islab
+                for irow in range(nrows):
+                    with open(slab_fname(islab,irow),'ab') as handle:
+                        chunk[irow,in_slab].tofile(handle)
+                counts[islab] += np.sum(in_slab)
+            del chunk,slab_index
+
+        ## read each slab back, far to near, straight into its buffer
+        for islab in range(counts.size):
+            if not counts[islab]:
+                continue
+            slab = np.empty((nrows,counts[islab]),dtype=np.float32)
+            for irow in range(nrows):
+                with open(slab_fname(islab,irow),'rb') as handle:
+                    handle.readinto(memoryview(slab[irow]))
+                os.remove(slab_fname(islab,irow))
+            yield slab
+            del slab
+
+def stellar_raytrace_streaming(
+    particle_chunks,
+    kappa,
+    xlim,ylim,zlim,
+    nslabs=8,
+    pixels=720,
+    KAPPA_UNITS=2.08854068444, ## cm^2/g -> kpc^2/mcode
+    QUIET=False,
+    hybrid=False,
+    fast_math=False,
+    nthreads=1,
+    band_cube=False,
+    tmpdir=None,
+    out=None):
+    """ Out-of-core version of stellar_raytrace, for frames with more particles
+        than fit in memory. The attenuation is composited in depth order, so the 
+        particles are partitioned into nslabs slabs of depth (spooled to disk, see
+        iter_depth_slabs), and each slab is sorted on its own and raytraced, far 
+        to near, into the same maps. Memory is set by the size of a chunk or a 
+        slab rather than the number of particles, and the maps are the same as 
+        stellar_raytrace makes them (it's always composited far to near, there's 
+        no front_to_back).
+
+        Input:
+
+            particle_chunks -- iterable of (5+Nbands,n) chunks of stars and gas, 
+                as staged by stage_stellar_particles (in the frame of the camera),
+                read lazily e.g. from a generator over the files of a snapshot
+            kappa -- opacity in each band, in cm^2/g
+            xlim,ylim,zlim -- limits of the box
+            nslabs = 8 -- number of slabs of depth
+            pixels = 720 -- number of pixels along x
+            KAPPA_UNITS = 2.08854068444 -- cm^2/g -> kpc^2/mcode
+            QUIET = False -- flag to not print
+            hybrid = False -- cloud-in-cell deposit particles smaller than a pixel
+            fast_math = False -- vectorized kernel and attenuation
+            nthreads = 1 -- threads to raytrace image tiles (of each slab) with
+            band_cube = False -- flag to return the mass map and the (Nbands,...) 
+                cube, for any number of bands, rather than three band maps
+            tmpdir = None -- directory to spool the slabs in
+            out = None -- mass map and 3 band maps (or band cube) to fill in place
+
+        Output:
+
+            out_0 -- attenuating mass in each pixel
+            out_1,out_2,out_3 -- attenuated luminosity in each pixel in each band,
+                or out_bands -- (Nbands,Xpixels,Ypixels) if band_cube"""
+
+    kappa = np.array(kappa,dtype=np.float64,ndmin=1)*KAPPA_UNITS
+    if not band_cube and kappa.size != 3:
+        raise ValueError(
+            "stellar_raytrace_streaming needs 3 bands for the three band maps, "+
+            "you gave %d (use band_cube=True)"%kappa.size)
+
+    ## the shape of the image, as select_raytrace_particles computes it
+    Xpixels=int_round(pixels)
+    Ypixels=int_round((ylim[1]-ylim[0])/(xlim[1]-xlim[0])*float(Xpixels))
+    outs = kernel_bindings.get_output_buffers(
+        get_band_cube_out(out,band_cube),
+        [(Xpixels,Ypixels),(kappa.size,Xpixels,Ypixels)])
+
+    ## slabs evenly spaced in depth, the first and last also take the particles beyond
+    zedges = np.linspace(zlim[0],zlim[1],nslabs+1)[1:-1]
+
+    nparticles = 0
+    for slab in iter_depth_slabs(particle_chunks,zedges,tmpdir=tmpdir):
+        if slab.shape[0] != 5+kappa.size:
+            raise ValueError("Slab has %d bands, but there are %d opacities"%(
+                slab.shape[0]-5,kappa.size))
+        x,y,z,hsml,mass = slab[:5]
+
+        ## keep the particles in the box and sort them in z, through their indices
+        particles = select_raytrace_particles(
+            x,y,z,
+            hsml,mass,
+            slab[5:],
+            xlim=xlim,ylim=ylim,zlim=zlim,
+            pixels=pixels,
+            TRIM_PARTICLES=1,
+            gather=False,
+            min_particles=1)
+        if particles is None:
+            continue
+        x,y,hsml,mass,lums,order,(xmin,xmax,ymin,ymax),Xpixels,Ypixels = particles
+        nparticles += order.size
+
+        ## composite this slab on top of the ones behind it
+        raytrace_nband_tiled(
+            x,y,hsml,
+            mass,
+            lums,kappa,
+            xmin,xmax,ymin,ymax,
+            Xpixels,Ypixels,
+            nthreads=nthreads,
+            subpixel_cic=hybrid,
+            fast_math=fast_math,
+            order=order,
+            accumulate=True,
+            out=outs)
+
+    if not QUIET:
+        print('raytraced',nparticles,'particles in',nslabs,'slabs')
+
+    if not nparticles:
+        print(
+            'UH-OH: EXPECT ERROR NOW',
+            'there are no valid source/gas particles to send!')
+        return (-1,-1) if band_cube else (-1,-1,-1,-1)
+
+    return split_band_cube(outs[0],outs[1],band_cube,out)
+
+def select_raytrace_particles(
     x,y,z,
     hsml,mass,
-    wt1,wt2,wt3,
-    kappa_1,kappa_2,kappa_3,
+    lums,
     xlim=0,ylim=0,zlim=0,
     pixels=720,
-    TRIM_PARTICLES=1):
+    TRIM_PARTICLES=1,
+    staging=None,
+    ids=None,
+    gather=True,
+    min_particles=2):
+    """ Re-centers the particles on the box, keeps those inside it (with a
+        valid smoothing length and some mass or light), and sorts them in z, 
+        in the single precision the ray-tracer takes. With gather=False they're
+        only sorted through an index array, without copying them.
+
+        Input:
+
+            x,y,z -- positions of the particles, re-centered in place
+            hsml -- smoothing lengths of the particles
+            mass -- attenuating masses of the particles
+            lums -- luminosities of the particles, an (Nbands,N) array or 
+                a list of Nbands arrays
+            xlim,ylim,zlim -- limits of the box, 0 to fit the particles
+            pixels = 720 -- number of pixels along x
+            TRIM_PARTICLES = 1 -- flag to only keep particles (nearly) inside the box
+            staging = None -- RaytraceStaging to sort with and gather into
+            ids = None -- ids of the particles, to match them to the staging's
+                previous frame
+            gather = True -- flag to gather copies of the kept particles in z 
+                order, rather than return the indices that order them. the 
+                particles must then be contiguous float32 arrays, with lums an
+                (Nbands,N) array
+            min_particles = 2 -- fewest particles in the box worth raytracing
+
+        Output:
+
+            x,y,hsml,mass -- the kept particles, sorted in z (all the 
+                particles, as passed, if not gather)
+            lums -- (Nbands,Nkept) luminosities of the kept particles 
+                ((Nbands,N) if not gather)
+            order -- int32 indices of the kept particles in z order, 
+                None if gather
+            limits -- (xmin,xmax,ymin,ymax) of the image, about the box's center
+            Xpixels,Ypixels -- shape of the image
+
+            or None if there are fewer than min_particles to raytrace"""
 
     ## define bounaries
     if(checklen(xlim)<=1): 
@@ -292,22 +740,17 @@ def raytrace_projection_compute(
     dy=ylen*(1.+tolfac*2.)
     dz=zlen*(1.+tolfac*2.)
 
+    ## total weight of each particle, summed in band order
+    total=mass
+    for lum in lums:
+        total=total+lum
+
     ## produce an 'in-box' "ok" mask
     ok=(ok_scan(x,xmax=dx) & 
         ok_scan(y,xmax=dy) & 
         ok_scan(z,xmax=dz) & 
         ok_scan(hsml,pos=1) & 
-        ok_scan(mass+wt1+wt2+wt3,pos=1))
-
-    ## apply "ok" mask
-    x=x[ok]
-    y=y[ok]
-    z=z[ok]
-    hsml=hsml[ok]
-    mass=mass[ok]
-    wt1=wt1[ok]
-    wt2=wt2[ok]
-    wt3=wt3[ok]
+        ok_scan(total,pos=1))
 
     ## limits of box
     xmin=-xlen
@@ -315,74 +758,532 @@ def raytrace_projection_compute(
     ymin=-ylen
     ymax=ylen
 
-    N_p=checklen(x)
-    if(N_p<=1): 
+    N_p=np.sum(ok)
+    if(N_p<min_particles): 
+        return None
+
+    if not gather:
+        ## sort the "ok" particles in z (this is critical!), just their indices
+        ok=np.flatnonzero(ok)
+        if staging is None:
+            s=ok[np.argsort(z[ok])]
+        else:
+            ## starting from the previous frame's order, matching particles by id
+            if ids is None:
+                ids=np.arange(checklen(x))
+            s=ok[staging.argsort(z[ok],np.asarray(ids)[ok])]
+        order=s.astype(np.int32)
+    elif staging is None:
+        order=None
+
+        ## apply "ok" mask
+        x=x[ok]
+        y=y[ok]
+        z=z[ok]
+        hsml=hsml[ok]
+        mass=mass[ok]
+
+        ## now sort these in z (this is critical!)
+        ##  get sort indices
+        s=np.argsort(z);
+
+        ##  apply sort indices
+        x,y,z=x[s],y[s],z[s]
+        mass=mass[s]
+        hsml=hsml[s]
+        lums=[np.asarray(lum)[ok][s] for lum in lums]
+
+        ## cast new copies to ensure the correct formatting when fed to the c-routine:
+        ##  cast to single precision
+        x,y,z=fcor(x),fcor(y),fcor(z)
+        mass=fcor(mass)
+        hsml=fcor(hsml)
+        lums=np.array(lums,dtype=np.float32,ndmin=2)
+    else:
+        order=None
+
+        ## sort the "ok" particles in z (this is critical!) starting from 
+        ##  the previous frame's order, matching particles by id
+        ok=np.flatnonzero(ok)
+        if ids is None:
+            ids=np.arange(checklen(x))
+        s=ok[staging.argsort(z[ok],np.asarray(ids)[ok])]
+
+        ## gather them, in single precision, into the staging's buffers
+        x,y,hsml,mass,lums=staging.stage(s,x,y,hsml,mass,lums)
+
+    ## cast the variables to store the results
+    aspect_ratio=ylen/xlen
+    Xpixels=int_round(pixels)
+    Ypixels=int_round(aspect_ratio*float(Xpixels))
+
+    return x,y,hsml,mass,lums,order,(xmin,xmax,ymin,ymax),Xpixels,Ypixels
+
+##
+##  Wrapper for raytrace_rgb, program which does a simply line-of-sight projection 
+##    with multi-color source and self-extinction along the sightline: here called 
+##    from python in its most general form: from the c-code itself:
+##
+##  int raytrace_rgb(
+##    int N_xy, // number of input particles/positions
+##    float *x, float *y, // positions (assumed already sorted in z)
+##    float *hsml, // smoothing lengths for each
+##    float *Mass, // total weight for 'extinction' part of calculation
+##    float *wt1, float *wt2, float *wt3, // weights for 'luminosities'
+##    float KAPPA1, float KAPPA2, float KAPPA3, // opacities for each channel
+##    float Xmin, float Xmax, float Ymin, float Ymax, // boundaries of output grid
+##    int Xpixels, int Ypixels, // dimensions of grid
+##    float *OUT0, float *OUT1, float *OUT2, float*OUT3, // output vectors with final weights
+##    int FLAGS) // FLAG_SUBPIXEL_CIC | FLAG_FAST_MATH
+##
+def raytrace_projection_compute(
+    x,y,z,
+    hsml,mass,
+    wt1,wt2,wt3,
+    kappa_1,kappa_2,kappa_3,
+    xlim=0,ylim=0,zlim=0,
+    pixels=720,
+    TRIM_PARTICLES=1,
+    hybrid=False,
+    fast_math=False,
+    nthreads=1,
+    front_to_back=False,
+    min_transmittance=kernel_bindings.MIN_TRANSMITTANCE,
+    staging=None,
+    ids=None,
+    out=None):
+
+    ## keep the particles in the box, sorted in z, in single precision
+    particles = select_raytrace_particles(
+        x,y,z,
+        hsml,mass,
+        [wt1,wt2,wt3],
+        xlim=xlim,ylim=ylim,zlim=zlim,
+        pixels=pixels,
+        TRIM_PARTICLES=TRIM_PARTICLES,
+        staging=staging,
+        ids=ids)
+
+    if particles is None: 
         print(
             'UH-OH: EXPECT ERROR NOW',
             'there are no valid source/gas particles to send!')
         return -1,-1,-1,-1;
 
-    ## now sort these in z (this is critical!)
-    ##  get sort indices
-    s=np.argsort(z);
-
-    ##  apply sort indices
-    x,y,z=x[s],y[s],z[s]
-    mass=mass[s]
-    hsml=hsml[s]
-    wt1,wt2,wt3=wt1[s],wt2[s],wt3[s]
-
-    ## cast new copies to ensure the correct formatting when fed to the c-routine:
-    ##  cast to single precision
-    x,y,z=fcor(x),fcor(y),fcor(z)
-    mass=fcor(mass)
-    hsml=fcor(hsml)
-    wt1,wt2,wt3=fcor(wt1),fcor(wt2),fcor(wt3)
-
-    ## load the routine we need
-    curpath = os.path.realpath(__file__)
-    curpath = curpath[:len("utils")+curpath.index("utils")] #split off this filename
-    exec_call=os.path.join(curpath,'stellar_utils/c_libraries/RayTrace_RGB/raytrace_rgb.so')
-    routine=ctypes.cdll[exec_call];
-    
-    ## cast the variables to store the results
-    aspect_ratio=ylen/xlen
-    Xpixels=int_round(pixels)
-    Ypixels=int_round(aspect_ratio*np.float(Xpixels))
-    N_pixels=Xpixels*Ypixels
-
-    ## create output array pointers
-    out_cast=ctypes.c_float*N_pixels
-    out_0=out_cast() ## mass map
-    out_1=out_cast() ## band 1 
-    out_2=out_cast() ## band 2
-    out_3=out_cast() ## band 3
-
-    ## main call to the attenuation routine in C
-    routine.raytrace_rgb( 
-        ctypes.c_int(N_p), ## number of star + gas particles
-        vfloat(x),vfloat(y), ## x-y positions of star + gas particles
-        vfloat(hsml),  ## smoothing lengths of star + gas particles
-        vfloat(mass), ## attenuation masses of star + gas particles, stars are 0 
+    x,y,hsml,mass,(wt1,wt2,wt3),order,(xmin,xmax,ymin,ymax),Xpixels,Ypixels = particles
+
+    ## main call to the attenuation routine in C, fills
+    ##  (and zeroes first) the output maps in out if they're passed
+    out_0, out_1, out_2, out_3 = raytrace_rgb_tiled(
+        x,y, ## x-y positions of star + gas particles
+        hsml,  ## smoothing lengths of star + gas particles
+        mass, ## attenuation masses of star + gas particles, stars are 0 
         ## emission in each band of star+gas particles, gas is 0 
-        vfloat(wt1),vfloat(wt2),vfloat(wt3),  
+        wt1,wt2,wt3,
         ## opacity in each band
-        ctypes.c_float(kappa_1),ctypes.c_float(kappa_2),ctypes.c_float(kappa_3), 
+        kappa_1,kappa_2,kappa_3, 
         ## x-y limits of the image
-        ctypes.c_float(xmin),ctypes.c_float(xmax),ctypes.c_float(ymin),ctypes.c_float(ymax), 
-        ctypes.c_int(Xpixels),ctypes.c_int(Ypixels), ## output shape
-        ctypes.byref(out_0), ## mass map
-        ctypes.byref(out_1),ctypes.byref(out_2),ctypes.byref(out_3) ) ## band maps
-
-    ## now put the output arrays into a useful format 
-    out_0 = np.copy(np.ctypeslib.as_array(out_0));
-    out_1 = np.copy(np.ctypeslib.as_array(out_1));
-    out_2 = np.copy(np.ctypeslib.as_array(out_2));
-    out_3 = np.copy(np.ctypeslib.as_array(out_3));
-    out_0 = out_0.reshape([Xpixels,Ypixels]);
-    out_1 = out_1.reshape([Xpixels,Ypixels]);
-    out_2 = out_2.reshape([Xpixels,Ypixels]);
-    out_3 = out_3.reshape([Xpixels,Ypixels]);
+        xmin,xmax,ymin,ymax, 
+        Xpixels,Ypixels, ## output shape
+        ## sub-pixel particles skip the kernel loop (still in z order)
+        subpixel_cic=hybrid,
+        ## evaluate the kernel and exp(-tau) in vectorized loops
+        fast_math=fast_math,
+        ## raytrace image tiles concurrently
+        nthreads=nthreads,
+        ## composite nearest first, skipping what's behind opaque pixels
+        front_to_back=front_to_back,
+        min_transmittance=min_transmittance,
+        out=out) ## mass map and band maps
 
     return out_0, out_1, out_2, out_3;
 
+def raytrace_bands_compute(
+    x,y,z,
+    hsml,mass,
+    lums,kappas,
+    xlim=0,ylim=0,zlim=0,
+    pixels=720,
+    TRIM_PARTICLES=1,
+    hybrid=False,
+    fast_math=False,
+    nthreads=1,
+    front_to_back=False,
+    min_transmittance=kernel_bindings.MIN_TRANSMITTANCE,
+    staging=None,
+    ids=None,
+    gather=True,
+    out=None):
+    """ raytrace_projection_compute for any number of bands, traced together in a 
+        single pass through the z-sorted particles. Each band of the cube is the
+        same as raytrace_projection_compute makes it, so any three of them can 
+        be combined into an image without raytracing again.
+
+        Input:
+
+            lums -- (Nbands,N) luminosities of the particles, or a list of Nbands arrays
+            kappas -- opacity in each band
+            gather = True -- flag to copy the particles in the box in z order, 
+                rather than trace them through their indices, which needs the
+                particles in contiguous float32 arrays (see select_raytrace_particles)
+
+            the rest as raytrace_projection_compute
+
+        Output:
+
+            out_0 -- attenuating mass in each pixel
+            out_bands -- (Nbands,Xpixels,Ypixels) attenuated luminosity in each 
+                pixel in each band"""
+
+    ## keep the particles in the box, sorted in z, in single precision
+    particles = select_raytrace_particles(
+        x,y,z,
+        hsml,mass,
+        lums,
+        xlim=xlim,ylim=ylim,zlim=zlim,
+        pixels=pixels,
+        TRIM_PARTICLES=TRIM_PARTICLES,
+        staging=staging,
+        ids=ids,
+        gather=gather)
+
+    if particles is None: 
+        print(
+            'UH-OH: EXPECT ERROR NOW',
+            'there are no valid source/gas particles to send!')
+        return -1,-1
+
+    x,y,hsml,mass,lums,order,(xmin,xmax,ymin,ymax),Xpixels,Ypixels = particles
+
+    return raytrace_nband_tiled(
+        x,y, ## x-y positions of star + gas particles
+        hsml,  ## smoothing lengths of star + gas particles
+        mass, ## attenuation masses of star + gas particles, stars are 0 
+        lums, ## emission in each band of star+gas particles, gas is 0 
+        kappas, ## opacity in each band
+        xmin,xmax,ymin,ymax, ## x-y limits of the image
+        Xpixels,Ypixels, ## output shape
+        subpixel_cic=hybrid,
+        fast_math=fast_math,
+        nthreads=nthreads,
+        front_to_back=front_to_back,
+        min_transmittance=min_transmittance,
+        order=order, ## z order of the particles in the box, if they weren't gathered
+        out=out) ## mass map and band cube
+
+def raytrace_tiles(
+    x,y,hsml,
+    Xmin,Xmax,
+    Ymin,Ymax,
+    Xpixels,Ypixels,
+    raytrace_tile,
+    nthreads=1,
+    ntiles=None,
+    subpixel_cic=False,
+    fast_math=False,
+    order=None):
+    """ Splits the image into tiles and calls raytrace_tile(indices,tile,wt_sums) 
+        for each, concurrently, with the (z ordered) indices of the particles whose
+        kernel overlaps the tile, its pixel bounds (ilo,ihi,jlo,jhi), and the 
+        kernel normalizations of every particle. The normalizations are computed 
+        once over each particle's full footprint (in parallel chunks of particles)
+        and shared by every tile it touches. The particles are traced in the
+        order they're stored, or only those in order (int32 indices), in that
+        order."""
+
+    if ntiles is None:
+        ntiles = int(np.ceil(np.sqrt(4*nthreads)))
+
+    iedges = get_tile_edges(Xpixels,ntiles)
+    jedges = get_tile_edges(Ypixels,ntiles)
+
+    imin,imax,jmin,jmax = get_pixel_footprints(
+        x,y,hsml,
+        Xmin,Xmax,Ymin,Ymax,
+        Xpixels,Ypixels)
+
+    ## compute each particle's kernel normalization once, in parallel
+    ##  chunks of particles, rather than once per tile it touches
+    wt_sums = np.zeros(x.size,dtype=np.float64)
+    def normalize_chunk(chunk):
+        lo,hi = chunk
+        if order is None:
+            kernel_bindings.raytrace_rgb_normalization(
+                x[lo:hi],y[lo:hi], ## x-y positions
+                hsml[lo:hi], ## smoothing lengths
+                Xmin,Xmax, ## x limits of the full image
+                Ymin,Ymax, ## y limits of the full image
+                Xpixels,Ypixels, ## shape of the full image
+                subpixel_cic=subpixel_cic, ## sub-pixel particles don't need a normalization
+                fast_math=fast_math, ## must match the raytrace
+                out=wt_sums[lo:hi])
+        else:
+            ## each chunk fills the normalizations of its own particles
+            kernel_bindings.raytrace_rgb_normalization(
+                x,y,hsml,
+                Xmin,Xmax,
+                Ymin,Ymax,
+                Xpixels,Ypixels,
+                subpixel_cic=subpixel_cic,
+                fast_math=fast_math,
+                order=order[lo:hi],
+                out=wt_sums)
+
+    def raytrace_indices(tile):
+        ilo,ihi,jlo,jhi = tile
+
+        overlaps = ((imin < ihi) & (imax > ilo) &
+            (jmin < jhi) & (jmax > jlo))
+
+        ## np.flatnonzero is sorted, so each tile keeps the particles in z order
+        if order is None:
+            indices = np.flatnonzero(overlaps)
+        else:
+            indices = order[np.flatnonzero(overlaps[order])]
+
+        if indices.size == 0:
+            return 0
+
+        ## ctypes releases the GIL for the duration of the call
+        raytrace_tile(indices,tile,wt_sums)
+        return indices.size
+
+    tiles = [
+        (iedges[ii],iedges[ii+1],jedges[jj],jedges[jj+1])
+        for ii in range(iedges.size-1)
+        for jj in range(jedges.size-1)]
+
+    chunk_edges = get_tile_edges(x.size if order is None else order.size,max(nthreads,1))
+    chunks = list(zip(chunk_edges[:-1],chunk_edges[1:]))
+
+    if nthreads <= 1:
+        for chunk in chunks:
+            normalize_chunk(chunk)
+        for tile in tiles:
+            raytrace_indices(tile)
+    else:
+        with ThreadPoolExecutor(max_workers=nthreads) as executor:
+            list(executor.map(normalize_chunk,chunks))
+            list(executor.map(raytrace_indices,tiles))
+
+def raytrace_rgb_tiled(
+    x,y,hsml,
+    mass,
+    wt1,wt2,wt3,
+    kappa_1,kappa_2,kappa_3,
+    Xmin,Xmax,
+    Ymin,Ymax,
+    Xpixels,Ypixels,
+    nthreads=1,
+    ntiles=None,
+    subpixel_cic=False,
+    fast_math=False,
+    front_to_back=False,
+    min_transmittance=kernel_bindings.MIN_TRANSMITTANCE,
+    out=None):
+    """ Thread-parallel version of kernel_bindings.raytrace_rgb. The attenuation 
+        is per-pixel, so the image is split into tiles that are each handed the 
+        particles whose kernel overlaps them, still in z order, and raytraced 
+        concurrently. Each particle's kernel normalization is computed once over its
+        full footprint (in parallel chunks of particles) and shared by every tile 
+        it touches, so the output is bitwise identical to the serial raytrace.
+
+        Input:
+
+            x,y -- projected positions of the particles, sorted in z
+            hsml -- smoothing lengths of the particles
+            mass -- attenuating masses of the particles
+            wt1,wt2,wt3 -- luminosities of the particles in each band
+            kappa_1,kappa_2,kappa_3 -- opacities in each band
+            Xmin,Xmax,Ymin,Ymax -- boundaries of the image
+            Xpixels,Ypixels -- shape of the image
+            nthreads = 1 -- number of threads to raytrace tiles with
+            ntiles = None -- number of tiles in each direction, defaults
+                to ~2 tiles per thread in each direction
+            subpixel_cic = False -- cloud-in-cell deposit particles smaller than a pixel
+            fast_math = False -- evaluate the kernel and exp(-tau) in vectorized loops
+            front_to_back = False -- composite the nearest particles first, tracking
+                each pixel's transmittance, and stop depositing into pixels (and skip
+                particles that only cover pixels) that have become opaque. much 
+                cheaper behind optically thick gas, see kernel_bindings.raytrace_rgb
+            min_transmittance = kernel_bindings.MIN_TRANSMITTANCE -- transmittance 
+                (in every band) below which front_to_back treats a pixel as opaque
+            out = None -- mass map and 3 band maps to fill (and zero first) in place
+
+        Output:
+
+            out_0 -- attenuating mass in each pixel
+            out_1,out_2,out_3 -- attenuated luminosity in each pixel in each band"""
+
+    if nthreads <= 1 and ntiles is None:
+        return kernel_bindings.raytrace_rgb(
+            x,y,hsml,
+            mass,
+            wt1,wt2,wt3,
+            kappa_1,kappa_2,kappa_3,
+            Xmin,Xmax,
+            Ymin,Ymax,
+            Xpixels,Ypixels,
+            subpixel_cic=subpixel_cic,
+            fast_math=fast_math,
+            front_to_back=front_to_back,
+            min_transmittance=min_transmittance,
+            out=out)
+
+    ## cast to single precision for the c-routine
+    x,y,hsml = fcor(x),fcor(y),fcor(hsml)
+    mass,wt1,wt2,wt3 = fcor(mass),fcor(wt1),fcor(wt2),fcor(wt3)
+    Xmin,Xmax,Ymin,Ymax = float(Xmin),float(Xmax),float(Ymin),float(Ymax)
+
+    ## output arrays, tiles fill disjoint pieces of them
+    outs = kernel_bindings.get_output_buffers(out,[(Xpixels,Ypixels)]*4)
+
+    def raytrace_tile(indices,tile,wt_sums):
+        ilo,ihi,jlo,jhi = tile
+        kernel_bindings.raytrace_rgb_tile(
+            x[indices],y[indices], ## x-y positions
+            hsml[indices], ## smoothing lengths
+            mass[indices], ## attenuating masses
+            wt1[indices],wt2[indices],wt3[indices], ## luminosities in each band
+            kappa_1,kappa_2,kappa_3, ## opacities in each band
+            Xmin,Xmax, ## x limits of the full image
+            Ymin,Ymax, ## y limits of the full image
+            Xpixels,Ypixels, ## shape of the full image
+            ilo,ihi, ## x pixel range of this tile
+            jlo,jhi, ## y pixel range of this tile
+            wt_sums[indices], ## kernel normalizations
+            subpixel_cic=subpixel_cic, ## cloud-in-cell deposit sub-pixel particles
+            fast_math=fast_math, ## vectorized kernel and attenuation
+            front_to_back=front_to_back, ## nearest first, stopping at opaque pixels
+            min_transmittance=min_transmittance, ## transmittance of an opaque pixel
+            out=outs)
+
+    raytrace_tiles(
+        x,y,hsml,
+        Xmin,Xmax,
+        Ymin,Ymax,
+        Xpixels,Ypixels,
+        raytrace_tile,
+        nthreads=nthreads,
+        ntiles=ntiles,
+        subpixel_cic=subpixel_cic,
+        fast_math=fast_math)
+
+    return outs
+
+def raytrace_nband_tiled(
+    x,y,hsml,
+    mass,
+    lums,kappas,
+    Xmin,Xmax,
+    Ymin,Ymax,
+    Xpixels,Ypixels,
+    nthreads=1,
+    ntiles=None,
+    subpixel_cic=False,
+    fast_math=False,
+    front_to_back=False,
+    min_transmittance=kernel_bindings.MIN_TRANSMITTANCE,
+    order=None,
+    accumulate=False,
+    out=None):
+    """ raytrace_rgb_tiled for any number of bands, see kernel_bindings.raytrace_nband.
+
+        Input:
+
+            lums -- (Nbands,N) luminosities of the particles in each band
+            kappas -- opacity in each band
+            order = None -- int32 indices of the particles to trace, in z order, 
+                so they needn't be sorted (or copied) first
+            accumulate = False -- flag to composite the particles on top of the
+                maps in out rather than zero them first, e.g. to raytrace 
+                consecutive slabs of depth, far to near
+            out = None -- mass map and (Nbands,Xpixels,Ypixels) band cube to 
+                fill (and zero first) in place
+
+            the rest as raytrace_rgb_tiled
+
+        Output:
+
+            out_0 -- attenuating mass in each pixel
+            out_bands -- (Nbands,Xpixels,Ypixels) attenuated luminosity in each 
+                pixel in each band"""
+
+    if nthreads <= 1 and ntiles is None and not accumulate:
+        return kernel_bindings.raytrace_nband(
+            x,y,hsml,
+            mass,
+            lums,kappas,
+            Xmin,Xmax,
+            Ymin,Ymax,
+            Xpixels,Ypixels,
+            subpixel_cic=subpixel_cic,
+            fast_math=fast_math,
+            front_to_back=front_to_back,
+            min_transmittance=min_transmittance,
+            order=order,
+            out=out)
+
+    if nthreads <= 1 and ntiles is None:
+        ## the whole image as a single tile, which isn't zeroed, 
+        ##  normalizing each particle as it's traced
+        return kernel_bindings.raytrace_nband_tile(
+            x,y,hsml,
+            mass,
+            lums,kappas,
+            Xmin,Xmax,
+            Ymin,Ymax,
+            Xpixels,Ypixels,
+            0,Xpixels,0,Ypixels,
+            None,
+            subpixel_cic=subpixel_cic,
+            fast_math=fast_math,
+            front_to_back=front_to_back,
+            min_transmittance=min_transmittance,
+            order=order,
+            out=out)
+
+    ## single precision for the c-routine, without copying arrays that already are
+    x,y,hsml,mass = [kernel_bindings.farray(array) for array in (x,y,hsml,mass)]
+    lums,kappas = kernel_bindings.get_band_arrays(lums,kappas,x.size)
+    Xmin,Xmax,Ymin,Ymax = float(Xmin),float(Xmax),float(Ymin),float(Ymax)
+
+    ## output arrays, tiles fill disjoint pieces of them
+    outs = kernel_bindings.get_output_buffers(
+        out,[(Xpixels,Ypixels),(lums.shape[0],Xpixels,Ypixels)],zero=not accumulate)
+
+    def raytrace_tile(indices,tile,wt_sums):
+        ilo,ihi,jlo,jhi = tile
+        ## traced through their indices, rather than copies
+        kernel_bindings.raytrace_nband_tile(
+            x,y, ## x-y positions
+            hsml, ## smoothing lengths
+            mass, ## attenuating masses
+            lums, ## luminosities in each band
+            kappas, ## opacities in each band
+            Xmin,Xmax, ## x limits of the full image
+            Ymin,Ymax, ## y limits of the full image
+            Xpixels,Ypixels, ## shape of the full image
+            ilo,ihi, ## x pixel range of this tile
+            jlo,jhi, ## y pixel range of this tile
+            wt_sums, ## kernel normalizations, of every particle
+            subpixel_cic=subpixel_cic, ## cloud-in-cell deposit sub-pixel particles
+            fast_math=fast_math, ## vectorized kernel and attenuation
+            front_to_back=front_to_back, ## nearest first, stopping at opaque pixels
+            min_transmittance=min_transmittance, ## transmittance of an opaque pixel
+            order=indices, ## the tile's particles, in z order
+            out=outs)
+
+    raytrace_tiles(
+        x,y,hsml,
+        Xmin,Xmax,
+        Ymin,Ymax,
+        Xpixels,Ypixels,
+        raytrace_tile,
+        nthreads=nthreads,
+        ntiles=ntiles,
+        subpixel_cic=subpixel_cic,
+        fast_math=fast_math,
+        order=order)
+
+    return outs
@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+from firestudio.utils import kernel_bindings
+from firestudio.utils.gas_utils import projection
+
+@pytest.fixture(scope='module')
+def particles():
+    ## particles inside the image, from about a pixel (of 128) to 20 pixels
+    rng = np.random.default_rng(5)
+    npart = 20000
+    x = rng.uniform(-0.6,0.6,npart).astype(np.float32)
+    y = rng.uniform(-0.6,0.6,npart).astype(np.float32)
+    z = rng.normal(0,0.4,npart)
+    hsml = (2/128*10**rng.uniform(0,np.log10(20),npart)).astype(np.float32)
+    mass = (rng.random(npart)/npart).astype(np.float32)
+    lums = (rng.random((3,npart))*(rng.random(npart)<0.3)).astype(np.float32)
+    return x,y,np.argsort(z).astype(np.int32),hsml,mass,lums
+
+@pytest.mark.parametrize('subpixel_cic',[False,True])
+def test_projection_fast_math_error(particles,subpixel_cic):
+    x,y,order,hsml,mass,lums = particles
+
+    error = kernel_bindings.get_fast_math_error(
+        x,y,hsml,mass,
+        -1,1,-1,1,
+        128,128,
+        subpixel_cic=subpixel_cic)
+
+    ## the same kernel on both paths, only the rounding differs
+    assert 0 <= error < kernel_bindings.FAST_MATH_TOLERANCE
+
+## optical depths up to ~0.01, 1, and 10
+@pytest.mark.parametrize('kappa',[0.01,1,10])
+@pytest.mark.parametrize('front_to_back',[False,True])
+def test_raytrace_fast_math_error(particles,kappa,front_to_back):
+    x,y,order,hsml,mass,lums = particles
+
+    error = kernel_bindings.get_fast_math_error(
+        x,y,hsml,mass,
+        -1,1,-1,1,
+        128,128,
+        lums=lums,kappas=np.full(3,kappa),
+        order=order,
+        front_to_back=front_to_back)
+
+    assert 0 < error < kernel_bindings.FAST_MATH_TOLERANCE
+
+@pytest.mark.parametrize('hooked',[False,True])
+def test_out_of_memory_raises(monkeypatch,hooked):
+    ## a kernel that couldn't allocate its work buffers
+    monkeypatch.setattr(kernel_bindings,'get_function',
+        lambda library_name,function_name: lambda *args: kernel_bindings.OUT_OF_MEMORY)
+    with pytest.raises(MemoryError):
+        if hooked:
+            with kernel_bindings.progress_hook(callback=lambda kernel_name,ndone,ntotal: False):
+                kernel_bindings.call_kernel('hsml_project','hsml_project_tile')
+        else:
+            kernel_bindings.call_kernel('hsml_project','hsml_project_tile')
+
+def test_timeout_cancels_projection(particles):
+    x,y,order,hsml,mass,lums = particles
+
+    with pytest.raises(TimeoutError):
+        with kernel_bindings.progress_hook(interval=1000,timeout=0):
+            projection.hsml_project_tiled(
+                x,y,hsml,mass,mass,
+                -1,1,-1,1,
+                128,128)
+
+def test_find_hsml_and_project_reports_when_done(particles):
+    x,y,order,hsml,mass,lums = particles
+    pos = np.stack([x,y,np.zeros_like(x)],axis=1)
+
+    ## the neighbor search can't be stopped, but is cancelled once it's done
+    reports = []
+    def cancel(kernel_name,ndone,ntotal):
+        reports.append((kernel_name,ndone,ntotal))
+        return True
+    with pytest.raises(kernel_bindings.KernelCancelled):
+        with kernel_bindings.progress_hook(cancel):
+            projection.find_hsml(10,-1,1,-1,1,-1,1,pos)
+    assert reports == [('findHsmlAndProject',x.size,x.size)]
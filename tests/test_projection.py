@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+
+from firestudio.utils.gas_utils import projection
+from firestudio.utils.gas_utils.volume_grid import VolumeGrid
+
+@pytest.fixture(scope='module')
+def particles():
+    ## a blob of gas that reaches past the edges of the image, with 
+    ##  smoothing lengths spanning many levels of the image pyramid
+    rng = np.random.default_rng(1)
+    npart = 50000
+    x = rng.normal(0,0.6,npart).astype(np.float32)
+    y = rng.normal(0,0.6,npart).astype(np.float32)
+    hsml = (10**rng.uniform(-3,-0.3,npart)).astype(np.float32)
+    mass = rng.uniform(0,1,npart).astype(np.float32)
+    quantity = rng.uniform(1,2,npart).astype(np.float32)
+    return x,y,hsml,mass,quantity
+
+@pytest.mark.parametrize('mip_tolerance',[4,8])
+def test_pyramid_matches_tiled_at_edges(particles,mip_tolerance):
+    x,y,hsml,mass,quantity = particles
+    npix = 128
+
+    massMap,_ = projection.hsml_project_tiled(
+        x,y,hsml,mass,quantity,
+        -1,1,-1,1,
+        npix,npix)
+    pyramidMassMap,_ = projection.hsml_project_pyramid(
+        x,y,hsml,mass,quantity,
+        -1,1,-1,1,
+        npix,npix,
+        mip_tolerance=mip_tolerance)
+
+    ## the weight of kernels past the image's edges is lost on every level
+    assert pyramidMassMap.sum() == pytest.approx(massMap.sum(),rel=1e-3)
+
+    ## the edges, including the last row and column
+    for edge in [np.s_[0,:],np.s_[:,0],np.s_[-1,:],np.s_[:,-1]]:
+        assert pyramidMassMap[edge].sum() == pytest.approx(massMap[edge].sum(),rel=0.01)
+
+    ## and the corners
+    assert pyramidMassMap[:4,:4].sum() == pytest.approx(massMap[:4,:4].sum(),rel=0.01)
+
+    assert np.max(np.abs(pyramidMassMap-massMap)) < 0.01*np.max(massMap)
+
+@pytest.mark.parametrize('nthreads',[1,3])
+def test_tiled_matches_find_hsml_and_project(nthreads):
+    ## particles past the edges of the image, with smoothing lengths from a
+    ##  fraction of a pixel to ~40 pixels (below findHsmlAndProject's Hmax)
+    rng = np.random.default_rng(2)
+    npart = 20000
+    npix = 128
+    pos = np.zeros((npart,3),dtype=np.float32)
+    pos[:,:2] = rng.uniform(-1.2,1.2,(npart,2))
+    pos[:,2] = rng.uniform(-0.5,0.5,npart)
+    hsml = (10**rng.uniform(-3,-0.5,npart)).astype(np.float32)
+    mass = rng.uniform(0,1,npart).astype(np.float32)
+    quantity = rng.uniform(1,2,npart).astype(np.float32)
+
+    massMap,quantityMap = projection.find_hsml_and_project(
+        10,
+        -1,1,-1,1,-1,1,
+        npix,npix,
+        pos,hsml.copy(),mass,quantity)
+
+    tiledMassMap,tiledWeightedQuantityMap = projection.hsml_project_tiled(
+        pos[:,0],pos[:,1],hsml,mass,quantity,
+        -1,1,-1,1,
+        npix,npix,
+        nthreads=nthreads)
+
+    ## the same deposit, summed in a different order, up to the last row and column
+    assert np.any(tiledMassMap[-1]) and np.any(tiledMassMap[:,-1])
+    assert tiledMassMap.sum() == pytest.approx(massMap.sum(),rel=1e-5)
+    assert np.max(np.abs(tiledMassMap-massMap)) < 1e-5*np.max(massMap)
+
+    ## findHsmlAndProject returns the mass weighted average
+    weightedQuantityMap = quantityMap*massMap
+    assert (np.max(np.abs(tiledWeightedQuantityMap-weightedQuantityMap)) < 
+        1e-5*np.max(weightedQuantityMap))
+
+def test_volume_grid_second_moments(particles):
+    x,y,hsml,mass,quantity = particles
+    pos = np.stack([x,y,0.5*x*y],axis=1)
+    frame = ([0,0,0],0,0,0,-0.5,0.5,-0.5,0.5,-0.5,0.5,64,64)
+
+    grid = VolumeGrid(pos,hsml,mass,quantity,[0,0,0],1,ngrid=32,second_moments=True)
+    massMap,weightedQuantityMaps = grid.project(*frame)
+    assert weightedQuantityMaps.shape == (2,64,64)
+
+    ## the same maps as grids of quantity and of quantity^2
+    for power,weightedQuantityMap in zip([1,2],weightedQuantityMaps):
+        powerGrid = VolumeGrid(pos,hsml,mass,quantity**power,[0,0,0],1,ngrid=32)
+        powerMassMap,powerWeightedQuantityMap = powerGrid.project(*frame)
+        assert np.array_equal(powerMassMap,massMap)
+        assert np.allclose(
+            weightedQuantityMap,powerWeightedQuantityMap,
+            rtol=1e-5,atol=1e-6*np.max(powerWeightedQuantityMap))
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+from firestudio.utils.stellar_utils import raytrace_projection
+
+@pytest.fixture(scope='module')
+def particles():
+    ## stars embedded in a dusty blob of gas, some beyond the box
+    rng = np.random.default_rng(3)
+    nstars,ngas = 4000,8000
+    stellar_pos = rng.normal(0,1,(3,nstars)).astype(np.float32)
+    stellar_hsml = (10**rng.uniform(-2,-0.5,nstars)).astype(np.float32)
+    lums = rng.random((3,nstars)).astype(np.float32)
+    gas_pos = rng.normal(0,1,(3,ngas)).astype(np.float32)
+    gas_hsml = (10**rng.uniform(-2,-0.5,ngas)).astype(np.float32)
+    gas_mass = (rng.random(ngas)*1e-3).astype(np.float32)
+    gas_metallicity = np.full(ngas,0.02,dtype=np.float32)
+    return (stellar_pos,stellar_hsml,lums,
+        gas_pos,gas_hsml,gas_mass,gas_metallicity)
+
+@pytest.mark.parametrize('nslabs',[1,3,8])
+@pytest.mark.parametrize('kwargs',[{},{'hybrid':True,'nthreads':2}])
+def test_streaming_matches_in_memory(particles,nslabs,kwargs):
+    (stellar_pos,stellar_hsml,lums,
+        gas_pos,gas_hsml,gas_mass,gas_metallicity) = particles
+    kappa = np.array([300.,200.,100.])
+    limits = dict(
+        xlim=[-1.5,1.5],ylim=[-1.5,1.5],zlim=[-3,3],
+        pixels=64,QUIET=True,**kwargs)
+
+    maps = raytrace_projection.stellar_raytrace(
+        *stellar_pos.copy(),
+        stellar_hsml,stellar_hsml,stellar_hsml,
+        stellar_hsml,
+        *gas_pos.copy(),
+        gas_mass,gas_metallicity,
+        gas_hsml,
+        kappa.copy(),lums,
+        **limits)
+
+    ## a few chunks of each, so the slabs are filled from several of them
+    streamed_maps = raytrace_projection.stellar_raytrace_streaming(
+        raytrace_projection.iter_stellar_particle_chunks(
+            *stellar_pos,
+            stellar_hsml,lums,
+            *gas_pos,
+            gas_hsml,gas_mass,gas_metallicity,
+            chunk_size=1500),
+        kappa,
+        nslabs=nslabs,
+        **limits)
+
+    assert len(streamed_maps) == 4
+    for image,streamed_image in zip(maps,streamed_maps):
+        assert np.any(image)
+        np.testing.assert_allclose(
+            streamed_image,image,
+            rtol=0,atol=1e-5*np.max(np.abs(image)))